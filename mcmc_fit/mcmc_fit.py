@@ -1,4 +1,3 @@
-from astrodbkit import astrodb
 import synth_fit.utilities as u
 import pickle
 import logging
@@ -7,9 +6,10 @@ import cPickle
 import itertools
 import astropy.units as q
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 import synth_fit.bdfit
+from synth_fit.lazy_grid import model_from_database
+from synth_fit.quantized_grid import quantize_grid
+from spectra import SpectrumStore
 
 
 def pd_interp_models(params, coordinates, model_grid, smoothing=1):
@@ -39,6 +39,7 @@ def pd_interp_models(params, coordinates, model_grid, smoothing=1):
 
     """
 
+    import pandas as pd
     from scipy.interpolate import LinearNDInterpolator
 
     # Make sure the model grid is a DataFrame
@@ -69,7 +70,7 @@ def pd_interp_models(params, coordinates, model_grid, smoothing=1):
 
 def make_model_db(model_grid_name, model_atmosphere_db, model_grid=None, grid_data='spec',
                   param_lims=[('teff', 400, 1600, 50), ('logg', 3.5, 5.5, 0.5)], fill_holes=True, bands=[],
-                  rebin_models=True, use_pandas=False):
+                  rebin_models=True, use_pandas=False, lazy=False, flux_dtype=None, quantize=None):
     """
     Given a **model_grid_name**, returns the grid from the model_atmospheres.db as a Pandas DataFrame
 
@@ -94,6 +95,18 @@ def make_model_db(model_grid_name, model_atmosphere_db, model_grid=None, grid_da
         may need to update u.rebin_spec if not working.
     use_pandas: bool
         Default is False. Uses a pandas dataframe as output.
+    lazy: bool
+        Default is False. Only reads the parameter table now, and returns a model dictionary whose flux rows are read
+        from **model_atmosphere_db** as the fit uses them (see synth_fit.lazy_grid), so param_lims can cover the whole
+        grid. fill_holes, grid_data='phot' and use_pandas are not available.
+    flux_dtype: numpy dtype
+        Default is None (float64). The dtype to return the model flux in, e.g. np.float32 to halve the memory the grid
+        takes (see synth_fit.make_model.check_flux_dtype for the accuracy). Not used with use_pandas.
+    quantize: str
+        Default is None. 'log' (or True) returns the model flux encoded as 16-bit integers (a quarter of the float64
+        size), decoded as the fit uses them, with the relative error bounded at every pixel. 'linear' encodes the flux
+        itself, which only bounds the error relative to each spectrum's peak. See synth_fit.quantized_grid. With
+        lazy=True, the rows are read from the database and encoded a chunk at a time. Not used with use_pandas.
     Returns
     -------
     models: Pandas DataFrame
@@ -101,9 +114,18 @@ def make_model_db(model_grid_name, model_atmosphere_db, model_grid=None, grid_da
 
     """
 
+    if lazy:
+        M = model_from_database(model_atmosphere_db, model_grid_name, param_lims=param_lims,
+                                wavelength=rebin_models if isinstance(rebin_models, (list, np.ndarray)) else None,
+                                dtype=flux_dtype or np.float64)
+        if quantize:
+            M = quantize_grid(M, log=quantize != 'linear', dtype=flux_dtype or np.float64)
+        return M
+
     # If not using model grid form a pickle file, load the model_atmospheres database and pull all the data from
     # the specified table
     if model_grid == None:
+        from astrodbkit import astrodb
         ma_db = astrodb.Database(model_atmosphere_db)
         if param_lims:
             limit_text = ' AND '.join(
@@ -113,6 +135,7 @@ def make_model_db(model_grid_name, model_atmosphere_db, model_grid=None, grid_da
             model_grid = ma_db.dict("SELECT * FROM {}".format(model_grid_name)).fetchall()
 
     # Load the model atmospheres into a data frame and define the parameters
+    import pandas as pd
     models = pd.DataFrame(model_grid)
     params = [p for p in models.columns.values.tolist() if p in ['teff', 'logg', 'f_sed', 'k_zz']]
 
@@ -197,6 +220,10 @@ def make_model_db(model_grid_name, model_atmosphere_db, model_grid=None, grid_da
     if not use_pandas:
         M = {k: models[k].values for k in models.columns.values}
         M['flux'] = q.erg / q.AA / q.cm ** 2 / q.s * np.asarray(M['flux'])
+        if quantize:
+            M = quantize_grid(M, log=quantize != 'linear', dtype=flux_dtype or np.float64)
+        elif flux_dtype is not None:
+            M['flux'] = M['flux'].astype(flux_dtype)
         M['wavelength'] = q.um * M['wavelength'][0]
         return M
 
@@ -234,7 +261,8 @@ def fit_spectrum(raw_spectrum, model_grid, model_grid_name, shortname, walkers,
         Tuples of wavelength ranges to exclude in the model fits, e.g. mask=[(1.12,1.16),(1.35,1.42)] for J-H-K water
         absorption bands
     db: instance
-        The pre-loaded BDNYCdb.astrodb.get_db() database instance to pull the spectrum from
+        The pre-loaded BDNYCdb.astrodb.get_db() database instance to pull the spectrum from, or a
+        mcmc_fit.spectra.SpectrumStore (e.g. prefetched with all the ids of a batch)
     extents:
         Default is None. Not sure what this does.
     object_name: str
@@ -255,6 +283,8 @@ def fit_spectrum(raw_spectrum, model_grid, model_grid_name, shortname, walkers,
     bdsamp: object
         The MCMC result instance
     """
+    from synth_fit.plotting import pyplot
+    plt = pyplot()
 
     if log:
         logging.basicConfig(level=logging.DEBUG)
@@ -262,15 +292,10 @@ def fit_spectrum(raw_spectrum, model_grid, model_grid_name, shortname, walkers,
 
     # Input can be [W,F,E] or an id from the SPECTRUM table of the BDNYC Data Archive
     if isinstance(raw_spectrum, int):
-        query_spectrum = db.dict("SELECT * from spectra where id={}".format(raw_spectrum)).fetchone()
-# TODO: Is this for the Data Database? If so should the line above not be commented out?
-        # Turn into a dictionary with astropy units quantities
-        wave_unit = q.Unit(query_spectrum['wavelength_units'])
-        flux_unit = q.Unit(query_spectrum['flux_units'].replace("ergss", "erg s").replace('ergs', 'erg s').replace('Wm',
-                                                                                                                   'W m').replace(
-            "A", "AA"))
-        spectrum = {'wavelength': query_spectrum['wavelength'] * wave_unit, 'flux': query_spectrum['flux'] * flux_unit,
-                    'unc': query_spectrum['unc'] * flux_unit}
+        # Turn into a dictionary with astropy units quantities (pass a SpectrumStore as db to reuse its connection
+        # and cache across fits)
+        store = db if isinstance(db, SpectrumStore) else SpectrumStore(db)
+        spectrum = store.get(raw_spectrum)
 
 
     else:
@@ -337,7 +362,7 @@ def fit_spectrum(raw_spectrum, model_grid, model_grid_name, shortname, walkers,
     fb.close()
 
     # Make bestfit plot
-    w, f, e = raw_spectrum[0].value, raw_spectrum[1].value, raw_spectrum[2].value
+    w, f, e = spectrum['wavelength'].value, spectrum['flux'].value, spectrum['unc'].value
     #   best_fit_spectrum = bdsamp.best_fit_spectrum
     #   mult1 = float(sum(f*best_fit_spectrum[1]/(e**2)))
     #   mult = float(sum(best_fit_spectrum[1]*best_fit_spectrum[1]/(e**2)))
@@ -427,6 +452,8 @@ def model_grid_smoothness_test(models, param_lims={'teff': (0, 800), 'logg': (4.
     """
     Given a **model_grid_name**, returns the grid from the model_atmospheres.db in the proper format to work with fit_spectrum()
     """
+    from synth_fit.plotting import pyplot
+    plt = pyplot()
 
     for g in list(set(models['logg'])):
         plt.figure()
@@ -460,6 +487,8 @@ def model_grid_interp_test(model_grid, teff, logg):
     -------
     None
     """
+    from synth_fit.plotting import pyplot
+    plt = pyplot()
 
     # Get the upper, lower and target teff and logg values
     (t1, g1), (t2, g2), (t3, g3) = [(teff[0] + (teff[1] * i), logg[0] + (logg[1] * i)) for i in [-1., 0., 1.]]
@@ -0,0 +1,154 @@
+"""
+Data access for spectra stored in the BDNYC database: many spectra are fetched per query over one connection, unit
+strings are parsed once each, and spectra are cached (in memory, and optionally on disk) so they are only fetched once.
+"""
+import cPickle
+import logging
+import os
+import re
+
+import astropy.units as q
+import numpy as np
+
+# Keep the number of ? parameters per query under SQLite's default limit of 999
+max_query_ids = 900
+
+# Only the columns needed to build a spectrum are fetched
+spectrum_columns = ['id', 'wavelength_units', 'flux_units', 'wavelength', 'flux', 'unc']
+
+_units = {}
+
+
+def parse_unit(unit_string):
+    """
+    Turns a unit string from the SPECTRA table into an astropy unit, fixing the spellings used in the database
+    ('ergs' for 'erg s', 'Wm' for 'W m' and 'A' for Angstrom). Each distinct string is only parsed once.
+
+    Parameters
+    ----------
+    unit_string: str
+        e.g. 'ergs-1cm-2A-1' or 'um'
+
+    Returns
+    -------
+    unit: astropy.units.Unit
+    """
+    if unit_string not in _units:
+        fixed = unit_string.replace("ergss", "erg s").replace('ergs', 'erg s').replace('Wm', 'W m')
+        fixed = re.sub(r'(?<!A)A(?!A)', 'AA', fixed)
+        _units[unit_string] = q.Unit(fixed)
+    return _units[unit_string]
+
+
+class SpectrumStore(object):
+    """
+    Fetches spectra from the SPECTRA table of the BDNYC database by id, many at a time, and keeps them.
+
+    Call as:
+        store = SpectrumStore(db, cache_dir='spectrum_cache')
+        store.prefetch(ids)                  # one query per 900 ids
+        spectra = [(str(i), i) for i in ids]
+        synth_fit.batch.fit_batch(model, spectra, loader=store.get)
+
+    SQLite connections can only be used from the thread that opened them, so fetch spectra (prefetch) in that thread
+    before handing store.get to loader threads; get() then only reads from the cache.
+
+    Parameters
+    ----------
+    db: str, astrodbkit.astrodb.Database or sqlite3.Connection
+        The database (or its path, opened once when first needed). The ARRAY columns must be converted to arrays,
+        as astrodbkit does.
+    cache_dir: str (optional)
+        Directory to keep a copy of every fetched spectrum in, so later runs don't query the database for them again
+    table: str
+        The table of spectra, 'spectra' by default
+    """
+
+    def __init__(self, db, cache_dir=None, table='spectra'):
+        self.db = db
+        self.cache_dir = cache_dir
+        self.table = table
+        self.n_queries = 0
+        self._spectra = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _execute(self, sql, args):
+        if isinstance(self.db, basestring):
+            from astrodbkit import astrodb
+            self.db = astrodb.Database(self.db)
+        if hasattr(self.db, 'dict'):
+            # astrodbkit's db.dict is cursor.execute; BDdb's is the cursor
+            execute = getattr(self.db.dict, 'execute', self.db.dict)
+        else:
+            execute = self.db.execute
+        self.n_queries += 1
+        return execute(sql, args).fetchall()
+
+    def _cache_file(self, spectrum_id):
+        return os.path.join(self.cache_dir, 'spectrum_{}.pkl'.format(spectrum_id))
+
+    def _add(self, spectrum_id, record):
+        """ Keeps a spectrum given as plain arrays and unit strings """
+        wave_unit, flux_unit = parse_unit(record['wavelength_units']), parse_unit(record['flux_units'])
+        self._spectra[spectrum_id] = {'wavelength': q.Quantity(record['wavelength'], wave_unit, copy=False),
+                                      'flux': q.Quantity(record['flux'], flux_unit, copy=False),
+                                      'unc': q.Quantity(record['unc'], flux_unit, copy=False)}
+
+    def prefetch(self, ids):
+        """
+        Makes sure the spectra with the given ids are available, reading them from the disk cache or fetching the
+        rest from the database in as few queries as possible
+
+        Parameters
+        ----------
+        ids: sequence of int
+            ids in the SPECTRA table
+
+        Returns
+        -------
+        missing: list of int
+            ids that are not in the database
+        """
+        needed = [i for i in sorted(set(int(i) for i in ids)) if i not in self._spectra]
+
+        if self.cache_dir is not None:
+            for spectrum_id in list(needed):
+                if os.path.exists(self._cache_file(spectrum_id)):
+                    with open(self._cache_file(spectrum_id), 'rb') as cache_file:
+                        self._add(spectrum_id, cPickle.load(cache_file))
+                    needed.remove(spectrum_id)
+
+        for start in range(0, len(needed), max_query_ids):
+            chunk = needed[start:start + max_query_ids]
+            rows = self._execute("SELECT {} FROM {} WHERE id IN ({})".format(
+                ', '.join(spectrum_columns), self.table, ','.join('?' * len(chunk))), chunk)
+            for row in rows:
+                # Plain sqlite3 connections return tuples, in the order of the columns selected
+                if isinstance(row, tuple):
+                    record = dict(zip(spectrum_columns, row))
+                else:
+                    record = {k: row[k] for k in spectrum_columns}
+                for k in ['wavelength', 'flux', 'unc']:
+                    record[k] = np.asarray(record[k], dtype=np.float64)
+                self._add(record['id'], record)
+                if self.cache_dir is not None:
+                    with open(self._cache_file(record['id']), 'wb') as cache_file:
+                        cPickle.dump(record, cache_file, cPickle.HIGHEST_PROTOCOL)
+
+        missing = [i for i in needed if i not in self._spectra]
+        if missing:
+            logging.info('no spectra with ids {}'.format(missing))
+        return missing
+
+    def get(self, spectrum_id):
+        """
+        Returns the spectrum with the given id as a dictionary of 'wavelength', 'flux' and 'unc' Quantities,
+        fetching it first if it hasn't been yet
+        """
+        spectrum_id = int(spectrum_id)
+        if spectrum_id not in self._spectra:
+            self.prefetch([spectrum_id])
+        if spectrum_id not in self._spectra:
+            raise KeyError("no spectrum with id {}".format(spectrum_id))
+        return dict(self._spectra[spectrum_id])
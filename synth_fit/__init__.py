@@ -1 +1,31 @@
-import bdfit, calc_chisq, make_model, smooth
+# Fitting spectra against grids of model atmospheres with emcee. The
+# submodules are imported on first use (synth_fit.bdfit, ...), so that
+# importing the package, or just the likelihood code in
+# synth_fit.make_model, doesn't pull in emcee, matplotlib or the plotting
+# code; worker processes and short batch jobs start up faster
+################################################################################
+
+import importlib
+import sys
+import types
+
+__all__ = ['bdfit', 'calc_chisq', 'make_model', 'smooth']
+
+
+class _LazyPackage(types.ModuleType):
+    """ the synth_fit package, importing its submodules when first used """
+
+    def __getattr__(self, name):
+        if name in self.__all__:
+            return importlib.import_module('.' + name, self.__name__)
+        raise AttributeError("'module' object has no attribute '{}'".format(
+            name))
+
+
+## Python 2 modules can't change class, so the package in sys.modules is
+## replaced by a _LazyPackage with the same contents (the original is kept
+## so that its globals stay alive)
+_package = _LazyPackage(__name__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._original = sys.modules[__name__]
+sys.modules[__name__] = _package
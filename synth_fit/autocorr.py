@@ -0,0 +1,99 @@
+# Module containing functions for estimating the integrated autocorrelation
+# time of emcee chains, used to decide burn-in, thinning and when a run
+# has converged
+################################################################################
+
+import logging
+
+import numpy as np
+
+
+def next_pow_two(n):
+    """ returns the smallest power of two >= n """
+    i = 1
+    while i < n:
+        i = i << 1
+    return i
+
+
+def autocorr_function(chain):
+    """
+    Calculates the normalized autocorrelation function of a set of chains
+    with an FFT, averaged over the walkers
+
+    Parameters
+    ----------
+    chain: array_like (nwalkers, nsteps, ndim)
+        the walker positions, as in sampler.chain
+
+    Returns
+    -------
+    acf: array (nsteps, ndim)
+        the autocorrelation function for each parameter, acf[0]==1
+
+    """
+    chain = np.asarray(chain, dtype=np.float64)
+    nsteps = chain.shape[1]
+
+    ## Zero-pad to twice the (power of two) length so the FFT gives the
+    ## linear, not circular, autocorrelation
+    n = 2 * next_pow_two(nsteps)
+    x = chain - np.mean(chain, axis=1)[:, np.newaxis, :]
+    f = np.fft.rfft(x, n=n, axis=1)
+    acf = np.fft.irfft(f * np.conjugate(f), n=n, axis=1)[:, :nsteps, :]
+
+    ## Normalize each walker separately; a walker that never moved has no
+    ## autocorrelation information, so it is left out of the average
+    var = acf[:, 0, :]
+    moving = var > 0
+    acf[:, :, :] = np.where(moving[:, np.newaxis, :],
+        acf / np.where(moving, var, 1.0)[:, np.newaxis, :], 0.0)
+    n_moving = np.sum(moving, axis=0)
+    acf = np.sum(acf, axis=0) / np.maximum(n_moving, 1)
+    acf[0, n_moving==0] = 1.0
+
+    return acf
+
+
+def integrated_time(chain, c=5.0):
+    """
+    Estimates the integrated autocorrelation time of each parameter,
+    using Sokal's automatic windowing: the sum over the autocorrelation
+    function is truncated at the smallest lag M with M >= c*tau(M)
+
+    Parameters
+    ----------
+    chain: array_like (nwalkers, nsteps, ndim)
+        the walker positions, as in sampler.chain
+
+    c: float (default=5)
+        window constant; larger values give less biased but noisier
+        estimates
+
+    Returns
+    -------
+    tau: array (ndim)
+        integrated autocorrelation time (in steps) for each parameter
+
+    """
+    acf = autocorr_function(chain)
+    nsteps = acf.shape[0]
+
+    taus = 2.0 * np.cumsum(acf, axis=0) - 1.0
+    window = np.arange(nsteps)[:, np.newaxis] >= c * taus
+    found = np.any(window, axis=0)
+    m = np.where(found, np.argmax(window, axis=0), nsteps - 1)
+    if np.all(found)==False:
+        logging.debug('autocorrelation window not reached for %d params',
+            np.sum(found==False))
+
+    tau = taus[m, np.arange(taus.shape[1])]
+    return np.maximum(tau, 1.0)
+
+
+def effective_samples(nwalkers, nsteps, tau):
+    """
+    Returns the effective number of independent samples in nsteps
+    steps of nwalkers walkers, for the slowest-mixing parameter
+    """
+    return nwalkers * nsteps / np.max(tau)
@@ -0,0 +1,310 @@
+# Module containing storage for emcee chains: an on-disk store written 
+# block by block while the sampler runs, so that a killed run can be 
+# resumed, and a compact preallocated in-memory buffer
+################################################################################
+
+import logging
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+
+
+class ChainBackend(object):
+    """
+    Append-only file of chain blocks. Every block is flushed to disk as
+    soon as it is written, so a run that is killed loses at most the
+    block in progress, and the sampler state stored with each block is
+    enough to resume the run (see BDSampler.mcmc_go).
+
+    The file is a stream of pickled records: one header (nwalkers, ndim,
+    parameter names, run settings) followed by one record per block,
+    holding the block's chain (nwalkers, nblock, ndim) and lnprob
+    (nwalkers, nblock) arrays, which phase of the run it belongs to
+    ('burn', 'run' or 'converge'), and the sampler state at the end of the
+    block: walker positions, their lnprob and the random number generator
+    state. A record cut short by a crash is ignored on reading, and
+    removed before the next block is appended.
+
+    Call as:
+       from synth_fit.backend import ChainBackend
+       backend = ChainBackend('obj_chains.chain')
+       x.mcmc_go(backend=backend)
+       # after a crash, with the same BDSampler setup
+       x.mcmc_go(backend=backend, resume=True)
+
+    Parameters for __init__
+    -----------------------
+    filename: string
+        the chain file; it is only created or overwritten by reset()
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._checked = False
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def reset(self, nwalkers, ndim, **meta):
+        """
+        Starts a new chain file (overwriting any existing one)
+
+        Parameters
+        ----------
+        nwalkers, ndim: integers
+
+        **meta: anything else to keep in the header (e.g. parameter names)
+
+        """
+        header = dict(meta)
+        header['nwalkers'] = nwalkers
+        header['ndim'] = ndim
+        open_file = open(self.filename, 'wb')
+        pickle.dump({'kind':'header', 'header':header}, open_file,
+            pickle.HIGHEST_PROTOCOL)
+        self._sync(open_file)
+        open_file.close()
+        self._checked = True
+        logging.info('started chain file %s', self.filename)
+
+    def append(self, phase, chain, lnprob, pos, prob, rstate,
+               iterations=None):
+        """
+        Appends one block of samples, and the sampler state at its end
+
+        Parameters
+        ----------
+        phase: string
+            'burn', 'run' or 'converge'
+
+        chain: array (nwalkers, nblock, ndim)
+
+        lnprob: array (nwalkers, nblock)
+
+        pos, prob, rstate:
+            walker positions, their lnprob and the random state, as
+            yielded by emcee's EnsembleSampler.sample
+
+        iterations: integer (optional)
+            number of sampler steps the block covers, if the chain was 
+            thinned (or not stored at all); defaults to nblock
+
+        """
+        if iterations is None:
+            iterations = np.shape(chain)[1]
+        if self._checked==False:
+            ## Cut off a record left half-written by a crash
+            good_size = self._read()[2]
+            if os.path.getsize(self.filename) > good_size:
+                logging.info('truncating %s to %d bytes', self.filename,
+                    good_size)
+                open_file = open(self.filename, 'r+b')
+                open_file.truncate(good_size)
+                open_file.close()
+            self._checked = True
+
+        record = {'kind':'block', 'phase':phase,
+                  'chain':np.asarray(chain), 'lnprob':np.asarray(lnprob),
+                  'pos':np.asarray(pos), 'prob':np.asarray(prob),
+                  'rstate':rstate, 'iterations':iterations}
+        open_file = open(self.filename, 'ab')
+        pickle.dump(record, open_file, pickle.HIGHEST_PROTOCOL)
+        self._sync(open_file)
+        open_file.close()
+
+    def _sync(self, open_file):
+        open_file.flush()
+        os.fsync(open_file.fileno())
+
+    def _read(self):
+        """ returns the header, the complete blocks and their size in bytes """
+        header, blocks = None, []
+        open_file = open(self.filename, 'rb')
+        good_size = 0
+        while True:
+            try:
+                record = pickle.load(open_file)
+            except EOFError:
+                break
+            except Exception:
+                logging.info('ignoring incomplete record in %s after %d '
+                    'bytes', self.filename, good_size)
+                break
+            good_size = open_file.tell()
+            if record['kind']=='header':
+                header = record['header']
+            else:
+                blocks.append(record)
+        open_file.close()
+        if header is None:
+            raise IOError("{} is not a chain file".format(self.filename))
+        return header, blocks, good_size
+
+    def read(self):
+        """
+        Returns
+        -------
+        header: dictionary
+
+        blocks: list of dictionaries (see append)
+
+        """
+        header, blocks, good_size = self._read()
+        return header, blocks
+
+    def get_chain(self, phase='run'):
+        """
+        Returns the chain (nwalkers, nsteps, ndim) stored for phase, or
+        None if there are no blocks for it
+        """
+        blocks = [b['chain'] for b in self.read()[1] if b['phase']==phase]
+        if len(blocks)==0:
+            return None
+        return np.concatenate(blocks, axis=1)
+
+    def get_lnprob(self, phase='run'):
+        """ Returns the lnprob (nwalkers, nsteps) stored for phase, or None """
+        blocks = [b['lnprob'] for b in self.read()[1] if b['phase']==phase]
+        if len(blocks)==0:
+            return None
+        return np.concatenate(blocks, axis=1)
+
+    def get_state(self):
+        """
+        Returns
+        -------
+        state: dictionary
+            'header'; 'nsteps' (dictionary of the number of sampler steps
+            run for each phase); 'phase', 'pos', 'prob' and 'rstate' of the
+            last block (None if no blocks have been written yet)
+
+        """
+        header, blocks = self.read()
+        state = {'header':header, 'nsteps':{}, 'phase':None, 'pos':None,
+                 'prob':None, 'rstate':None}
+        for block in blocks:
+            state['nsteps'][block['phase']] = (
+                state['nsteps'].get(block['phase'], 0) +
+                block.get('iterations', block['chain'].shape[1]))
+        if len(blocks) > 0:
+            for key in ['phase', 'pos', 'prob', 'rstate']:
+                state[key] = blocks[-1][key]
+        return state
+
+
+class ChainBuffer(object):
+    """
+    Preallocated in-memory store for the samples of a run, thinned as 
+    they are recorded and kept (by default) in float32. Samples are held
+    step-major, (nsteps, nwalkers, ndim), so that both the usual 
+    (nwalkers, nsteps, ndim) chain and the flattened chain are views on
+    the same buffer rather than copies.
+
+    Parameters for __init__
+    -----------------------
+    nwalkers, ndim: integers
+
+    nsteps: integer
+        number of sampler steps expected; the buffer holds nsteps/thin
+        samples, and doubles in size if more are recorded
+
+    thin: integer (default=1)
+        keep only every thin-th step
+
+    dtype: numpy dtype (default=np.float32)
+
+    Creates
+    -------
+    samples (array; (capacity, nwalkers, ndim))
+    lnprob (array; (capacity, nwalkers))
+    nstored (integer) : number of samples kept so far
+    iterations (integer) : number of sampler steps recorded so far
+
+    """
+
+    def __init__(self, nwalkers, ndim, nsteps, thin=1, dtype=np.float32):
+        self.thin = thin
+        capacity = max(-(-nsteps // thin), 1)
+        self.samples = np.empty((capacity, nwalkers, ndim), dtype)
+        self.lnprob = np.empty((capacity, nwalkers), dtype)
+        self.nstored = 0
+        self.iterations = 0
+
+    def _grow(self, size):
+        capacity = max(2 * len(self.samples), size)
+        samples = np.empty((capacity,) + self.samples.shape[1:],
+            self.samples.dtype)
+        samples[:self.nstored] = self.samples[:self.nstored]
+        lnprob = np.empty((capacity,) + self.lnprob.shape[1:],
+            self.lnprob.dtype)
+        lnprob[:self.nstored] = self.lnprob[:self.nstored]
+        self.samples, self.lnprob = samples, lnprob
+
+    def record(self, pos, prob):
+        """ records one sampler step (keeping it if it isn't thinned out) """
+        if self.iterations % self.thin==0:
+            if self.nstored==len(self.samples):
+                self._grow(self.nstored + 1)
+            self.samples[self.nstored] = pos
+            self.lnprob[self.nstored] = prob
+            self.nstored += 1
+        self.iterations += 1
+
+    def extend(self, chain, lnprob, iterations):
+        """
+        Adds already-thinned samples, e.g. read back from a ChainBackend
+        when resuming a run
+
+        Parameters
+        ----------
+        chain: array (nwalkers, n, ndim)
+
+        lnprob: array (nwalkers, n)
+
+        iterations: integer
+            number of sampler steps those samples were thinned from
+
+        """
+        n = np.shape(chain)[1]
+        if self.nstored + n > len(self.samples):
+            self._grow(self.nstored + n)
+        self.samples[self.nstored:self.nstored + n] = np.swapaxes(chain, 0, 1)
+        self.lnprob[self.nstored:self.nstored + n] = np.transpose(lnprob)
+        self.nstored += n
+        self.iterations += iterations
+
+    def keep(self, start, step):
+        """
+        Drops the first start samples and keeps every step-th one of the
+        rest, moving them to the front of the buffer in place
+        """
+        kept = range(start, self.nstored, step)
+        for j, i in enumerate(kept):
+            self.samples[j] = self.samples[i]
+            self.lnprob[j] = self.lnprob[i]
+        self.nstored = len(kept)
+
+    def block(self, start):
+        """ returns the chain and lnprob of the samples stored from start """
+        return (self.chain[:, start:, :], self.lnprobability[:, start:])
+
+    @property
+    def chain(self):
+        """ view of the samples as (nwalkers, nstored, ndim) """
+        return np.swapaxes(self.samples[:self.nstored], 0, 1)
+
+    @property
+    def flatchain(self):
+        """ view of the samples as (nstored*nwalkers, ndim) """
+        return self.samples[:self.nstored].reshape((-1, self.samples.shape[2]))
+
+    @property
+    def lnprobability(self):
+        """ view of the lnprob values as (nwalkers, nstored) """
+        return np.transpose(self.lnprob[:self.nstored])
@@ -0,0 +1,415 @@
+# Module for fitting many spectra against one model grid: the grid is
+# loaded and set up once, handed to a pool of worker processes, and the
+# results of all the fits are collected into one table. Loading, fitting
+# and writing outputs run as overlapping stages.
+################################################################################
+
+import argparse
+import collections
+import cPickle
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+import numpy as np
+from astropy import units as u
+from astropy.table import Table
+
+from make_model import ModelGrid
+from bdfit import BDSampler
+
+## Units assumed for grids and spectra stored without them
+default_wave_unit = u.um
+default_flux_unit = u.erg / u.AA / u.cm**2 / u.s
+
+## Model parameters fit by default (as in mcmc_fit.fit_spectrum)
+grid_params = ['teff', 'logg', 'f_sed', 'k_zz']
+
+
+def load_grid(filename, wave_unit=default_wave_unit,
+              flux_unit=default_flux_unit):
+    """
+    Loads a pickled model dictionary (e.g. the output of
+    mcmc_fit.make_model_db), giving the wavelength and flux arrays units
+    if they were pickled without them
+    """
+    open_file = open(filename, 'rb')
+    model = cPickle.load(open_file)
+    open_file.close()
+    if isinstance(model['wavelength'], u.Quantity)==False:
+        model['wavelength'] = np.asarray(model['wavelength']) * wave_unit
+    if isinstance(model['flux'], u.Quantity)==False:
+        model['flux'] = np.asarray(model['flux']) * flux_unit
+    return model
+
+
+def load_spectrum(filename, wave_unit=default_wave_unit,
+                  flux_unit=default_flux_unit):
+    """
+    Loads a text file with wavelength, flux and uncertainty columns
+    into a spectrum dictionary of Quantities
+    """
+    w, f, e = np.loadtxt(filename, unpack=True, usecols=(0, 1, 2))
+    return {'wavelength':w * wave_unit, 'flux':f * flux_unit,
+            'unc':e * flux_unit}
+
+
+def fit_object(grid, name, spectrum, outdir='.', return_sampler=False,
+               **mcmc_kwargs):
+    """
+    Runs one fit with a ModelGrid that is already set up, and summarizes
+    it as a row of the results table. A fit that fails is reported in the
+    row (status and error) rather than raised, so that one bad spectrum
+    doesn't stop a batch.
+
+    Parameters
+    ----------
+    grid: ModelGrid instance
+
+    name: string
+        identifier for the object; output files are named after it
+
+    spectrum: dictionary
+        contains 'wavelength','flux','unc' arrays (astropy.units Quantities)
+
+    outdir: string (default='.')
+        directory for the chain files of each fit
+
+    return_sampler: boolean (default=False)
+        also return the BDSampler (None if the fit failed)
+
+    **mcmc_kwargs: passed to BDSampler.mcmc_go
+
+    Returns
+    -------
+    row: OrderedDict
+        'name', 'status', 'error', 'time', and for a fit that ran, the
+        50th quantile of every parameter with its '_plus' and '_minus'
+        uncertainties, 'min_chisq' and 'max_tau'
+
+    """
+    start_time = time.time()
+    row = collections.OrderedDict([('name', name), ('status', 'ok'),
+                                   ('error', '')])
+    bdsamp = None
+    try:
+        bdsamp = BDSampler(name, spectrum, grid, grid.params,
+            plot_title=os.path.join(outdir, name), snap=grid.snap)
+        bdsamp.mcmc_go(**mcmc_kwargs)
+        error_and_unc = bdsamp.get_error_and_unc()
+        for i, param in enumerate(bdsamp.all_params):
+            row[param] = error_and_unc[i, 1]
+            row[param + '_plus'] = error_and_unc[i, 0]
+            row[param + '_minus'] = error_and_unc[i, 2]
+        row['min_chisq'] = np.nan if bdsamp.min_chi is None else float(bdsamp.min_chi)
+        row['max_tau'] = np.max(bdsamp.tau)
+    except Exception as err:
+        logging.exception('fit of %s failed', name)
+        row['status'] = 'failed'
+        row['error'] = '{}: {}'.format(type(err).__name__, err)
+        bdsamp = None
+    row['time'] = time.time() - start_time
+    if return_sampler:
+        return row, bdsamp
+    return row
+
+
+def write_outputs(bdsamp, outdir='.', plot=True):
+    """
+    Writes the outputs of one finished fit (besides the chain file that
+    mcmc_go writes): a pickle of [start_p, all_params, 50th quantiles,
+    error_and_unc] like mcmc_fit.fit_spectrum, and with plot=True, the
+    triangle and chain plots as PDFs
+    """
+    base = os.path.join(outdir, bdsamp.name)
+    open_file = open(base + '_results.pkl', 'wb')
+    cPickle.dump([bdsamp.start_p, bdsamp.all_params,
+        bdsamp.all_quantiles.T[1], bdsamp.error_and_unc], open_file)
+    open_file.close()
+
+    if plot:
+        ## pyplot keeps global state, so plots are made one at a time
+        from plotting import pyplot
+        plt = pyplot()
+        bdsamp.plot_triangle()
+        plt.savefig(base + '_triangle.pdf')
+        plt.close('all')
+        bdsamp.plot_chains()
+        plt.savefig(base + '_chains.pdf')
+        plt.close('all')
+
+
+## The grid each worker process fits against, set when the pool starts
+_worker_grid = None
+
+
+def _init_worker(grid):
+    global _worker_grid
+    _worker_grid = grid
+
+
+def _fit_job(job):
+    index, name, spectrum, kwargs = job
+    row, bdsamp = fit_object(_worker_grid, name, spectrum,
+        return_sampler=True, **kwargs)
+    if bdsamp is not None:
+        ## The parent process only needs the results, not the grid
+        bdsamp.model = None
+    return index, row, bdsamp
+
+
+def _load_job(job):
+    index, name, source, loader = job
+    start_time = time.time()
+    try:
+        if isinstance(source, dict):
+            spectrum = source
+        else:
+            spectrum = loader(source)
+        error = None
+    except Exception as err:
+        logging.exception('loading %s failed', name)
+        spectrum = None
+        error = '{}: {}'.format(type(err).__name__, err)
+    logging.debug('loaded %s in %.2f s', name, time.time() - start_time)
+    return index, name, spectrum, error
+
+
+def results_table(rows):
+    """
+    Collects result rows (from fit_object) into an astropy Table, with
+    values missing from failed fits set to NaN
+    """
+    first = ['name', 'status']
+    last = ['min_chisq', 'max_tau', 'time', 'error']
+    names = []
+    for row in rows:
+        for key in row.keys():
+            if (key not in names) and (key not in first + last):
+                names.append(key)
+    names = first + names + last
+
+    columns = []
+    for key in names:
+        if key in ['name', 'status', 'error']:
+            columns.append([str(row.get(key, '')) for row in rows])
+        else:
+            columns.append([row.get(key, np.nan) for row in rows])
+    return Table(columns, names=names)
+
+
+def fit_batch(model, spectra, params=None, outfile='fit_results.csv',
+              processes=None, outdir='.', loader=load_spectrum, plot=False,
+              io_threads=2, **mcmc_kwargs):
+    """
+    Fits many spectra against one model grid. The grid is set up once
+    (a ModelGrid, with its parameter limits and coverage check), placed
+    in shared memory, and every fit in the worker pool reuses it; the
+    results of all fits are written to a single table.
+
+    The work is pipelined: threads load the spectra ahead of the fits, 
+    each spectrum goes to the process pool as soon as it is loaded, and 
+    each finished fit's outputs (see write_outputs) are written by an 
+    output thread while the other fits are still sampling.
+
+    Call as:
+       from synth_fit import batch
+       model = batch.load_grid('grid.pkl')
+       spectra = [(name, filename) for ...]
+       table = batch.fit_batch(model, spectra, ['teff','logg'], processes=4)
+
+    Parameters
+    ----------
+    model: dictionary or ModelGrid instance
+        the model grid (see ModelGrid)
+
+    spectra: list of (name, source) pairs
+        source is a spectrum dictionary ('wavelength','flux','unc'
+        arrays), or anything loader accepts (e.g. a filename)
+
+    params: list of strings (default=None)
+        parameters to vary in the fits; defaults to the grid's keys among
+        'teff', 'logg', 'f_sed' and 'k_zz' (not used if model is a ModelGrid)
+
+    outfile: string (default='fit_results.csv')
+        file for the results table (any format astropy.table can write;
+        None to not write it)
+
+    processes: integer (default=None)
+        number of worker processes (None means one per cpu; 0 runs
+        everything in this process, one object after the other)
+
+    outdir: string (default='.')
+        directory for the chain files and other outputs of each fit
+
+    loader: function (default=load_spectrum)
+        turns a source into a spectrum dictionary
+
+    plot: boolean (default=False)
+        save triangle and chain plots of every fit
+
+    io_threads: integer (default=2)
+        number of threads loading spectra
+
+    **mcmc_kwargs: passed to BDSampler.mcmc_go for every fit
+
+    Returns
+    -------
+    table: astropy.table.Table
+        one row per spectrum, in the order given (see fit_object)
+
+    """
+    if len(spectra)==0:
+        raise ValueError("no spectra to fit")
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(spectra))
+    if os.path.isdir(outdir)==False:
+        os.makedirs(outdir)
+    kwargs = dict(mcmc_kwargs, outdir=outdir)
+    rows = [None] * len(spectra)
+
+    def failed_row(name, stage, error):
+        return collections.OrderedDict([('name', name), ('status', 'failed'),
+            ('error', '{}: {}'.format(stage, error))])
+
+    def get_grid(spectrum):
+        if isinstance(model, ModelGrid):
+            return model
+        grid_keys = params
+        if grid_keys is None:
+            grid_keys = [p for p in grid_params if p in model]
+        return ModelGrid(spectrum, model, grid_keys)
+
+    load_jobs = [(i, name, source, loader)
+                 for i, (name, source) in enumerate(spectra)]
+    grid = None
+
+    if processes==0:
+        for job in load_jobs:
+            index, name, spectrum, error = _load_job(job)
+            if error is not None:
+                rows[index] = failed_row(name, 'load', error)
+                continue
+            if grid is None:
+                grid = get_grid(spectrum)
+            rows[index], bdsamp = fit_object(grid, name, spectrum,
+                return_sampler=True, **kwargs)
+            if bdsamp is not None:
+                write_outputs(bdsamp, outdir, plot)
+            logging.info('finished %s (%d/%d)', name, index + 1, len(rows))
+        return _write_table(rows, outfile)
+
+    io_pool = ThreadPool(io_threads)
+    output_pool = ThreadPool(1)
+    fit_pool, shared = None, None
+    fit_results, output_results = [], []
+
+    def fitted(result):
+        ## Runs in the fit pool's result thread; hands off to the writer
+        index, row, bdsamp = result
+        rows[index] = row
+        logging.info('finished %s (%d/%d)', row['name'],
+            len([r for r in rows if r is not None]), len(rows))
+        if bdsamp is not None:
+            output_results.append((index, output_pool.apply_async(
+                write_outputs, (bdsamp, outdir, plot))))
+
+    try:
+        for index, name, spectrum, error in io_pool.imap(_load_job,
+                                                         load_jobs):
+            if error is not None:
+                rows[index] = failed_row(name, 'load', error)
+                continue
+            if fit_pool is None:
+                ## Workers attach to the shared grid rather than copying it
+                grid = get_grid(spectrum)
+                if grid.shared is None:
+                    shared = grid.share()
+                fit_pool = multiprocessing.Pool(processes, _init_worker,
+                    (grid,))
+            fit_results.append(fit_pool.apply_async(_fit_job,
+                ((index, name, spectrum, kwargs),), callback=fitted))
+        for result in fit_results:
+            result.get()
+        if fit_pool is not None:
+            fit_pool.close()
+        output_pool.close()
+        output_pool.join()
+    except:
+        if fit_pool is not None:
+            fit_pool.terminate()
+        output_pool.terminate()
+        raise
+    finally:
+        io_pool.terminate()
+        if fit_pool is not None:
+            fit_pool.join()
+        if shared is not None:
+            shared.unlink()
+
+    for index, result in output_results:
+        try:
+            result.get()
+        except Exception as err:
+            logging.exception('writing outputs of %s failed',
+                rows[index]['name'])
+            rows[index]['error'] = 'output: {}: {}'.format(
+                type(err).__name__, err)
+    return _write_table(rows, outfile)
+
+
+def _write_table(rows, outfile):
+    table = results_table(rows)
+    if outfile is not None:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        if outfile.endswith('.csv'):
+            table.write(outfile, format='ascii.csv')
+        else:
+            table.write(outfile)
+        logging.info('wrote results for %d spectra to %s', len(rows), outfile)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit many spectra "
+        "against one model grid and write a table of the results")
+    parser.add_argument('grid', help="pickled model dictionary")
+    parser.add_argument('spectra', nargs='+', help="text files with "
+        "wavelength, flux and uncertainty columns")
+    parser.add_argument('--params', nargs='+', default=None,
+        help="parameters to fit (default: all grid parameters)")
+    parser.add_argument('--table', default='fit_results.csv',
+        help="results table (default: fit_results.csv)")
+    parser.add_argument('--outdir', default='.',
+        help="directory for the chain files, plots and other outputs")
+    parser.add_argument('--processes', type=int, default=None,
+        help="worker processes (default: one per cpu; 0 for none)")
+    parser.add_argument('--plot', action='store_true',
+        help="save triangle and chain plots of every fit")
+    parser.add_argument('--walkers', type=int, default=20,
+        help="walkers per dimension (nwalk_mult)")
+    parser.add_argument('--steps', type=int, default=50,
+        help="steps per dimension (nstep_mult)")
+    parser.add_argument('--converge', action='store_true',
+        help="run each fit until its chains converge")
+    parser.add_argument('--compact', action='store_true',
+        help="keep the chains in compact float32 buffers")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    model = load_grid(args.grid)
+    spectra = [(os.path.splitext(os.path.basename(filename))[0], filename)
+               for filename in args.spectra]
+    table = fit_batch(model, spectra, args.params, outfile=args.table,
+        processes=args.processes, outdir=args.outdir, plot=args.plot,
+        nwalk_mult=args.walkers, nstep_mult=args.steps,
+        converge=args.converge, compact=args.compact)
+    table.pprint(max_lines=-1, max_width=-1)
+
+
+if __name__=='__main__':
+    main()
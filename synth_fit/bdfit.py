@@ -5,22 +5,29 @@
 
 import datetime
 import logging
+import time
 
-## Third-party
-import matplotlib
+import cPickle
 
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+## Third-party
 import numpy as np
+from astropy import units as u
 import emcee
 
-from plotting.emcee_plot import emcee_plot
-# https://github.com/adrn/streams/blob/master/streams/plot/emcee.py
-# Want to update ^ so it shows the burn_in cut
-from plotting import triangle
-from make_model import *
-from calc_chisq import *
+## Plotting (matplotlib, emcee_plot and triangle) is imported in the
+## plotting methods, so fitting doesn't pay for it
+from make_model import ModelGrid
+from calc_chisq import test_all, subsample_grid
+from lazy_grid import LazyFlux
+from autocorr import integrated_time, effective_samples
+from backend import ChainBackend, ChainBuffer
+from quantiles import QuantileSketch
+from quantiles import quantiles as partition_quantiles
+from instrument import stats
+from progress import ProgressMonitor
+
+## Most models test_all scans for the starting point of a LazyFlux grid
+lazy_scan_models = 100
 
 
 class BDSampler(object):
@@ -45,6 +52,8 @@ class BDSampler(object):
         keys 'wsyn' and 'fsyn' should correspond to model wavelength and 
         flux arrays, and those should be astropy.units Quantities
         other keys should correspond to params
+        (or a ModelGrid already set up for this grid, e.g. when fitting 
+        many objects; its own smooth, snap and wavelength_bins are used)
 
     params: list of strings
         parameters to vary in fit, must be keys of model
@@ -57,6 +66,12 @@ class BDSampler(object):
         title for any plots created; also used as part of filenames for 
         output files
 
+    start_p: array (optional)
+        starting values of params; if not given they are found with 
+        test_all, which scans every model - or, for a grid whose flux is
+        read from the database as needed (LazyFlux), a subsample of at 
+        most lazy_scan_models of them (see calc_chisq.subsample_grid)
+
     Creates
     -------
     date (string)
@@ -68,9 +83,11 @@ class BDSampler(object):
     all_params (list) : all parameters (model params + ln(s))
     ndim (int) : total number of parameters
 
-    mcmc_go(nwalk_mult=20, nstep_mult=50, outfile=None):
+    mcmc_go(nwalk_mult=20, nstep_mult=50, outfile=None, pool=None,
+            converge=False, ...):
         chain (array_like)
         cropchain (array_like)
+        tau (array_like)
 
     plot_triangle():
         corner_fig (pyplot figure)
@@ -91,7 +108,7 @@ class BDSampler(object):
     """
 
     def __init__(self, obj_name, spectrum, model, params, smooth=False,
-                 plot_title='None', snap=False, wavelength_bins=[0.9, 1.4, 1.9, 2.5] * u.um):
+                 plot_title='None', snap=False, wavelength_bins=[0.9, 1.4, 1.9, 2.5] * u.um, start_p=None):
         """
         Parameters 
         ----------
@@ -106,6 +123,7 @@ class BDSampler(object):
             keys 'wsyn' and 'fsyn' should correspond to model wavelength and 
             flux arrays, and those should be astropy.units Quantities
             other keys should correspond to params
+            (or a ModelGrid instance, see above)
         
         params: list of strings
             parameters to vary in fit, must be keys of model
@@ -118,9 +136,16 @@ class BDSampler(object):
             title for any plots created; also used as part of filenames for 
             output files. If none is provided, object name and date are used
 
+        start_p: array (optional)
+            starting values of params (instead of a test_all scan)
+
 
         """
 
+        ## Totals so far, so the timing report only covers this run
+        self._stats_mark = stats.snapshot()
+        init_started = stats.start()
+
         ## date string to version output files for a particular run
         self.date = datetime.date.isoformat(datetime.date.today())
         # Eventually - Add a timestamp?
@@ -138,8 +163,15 @@ class BDSampler(object):
         ## Set up the ModelGrid instance (this contains the data and 
         ## model dictionary. It is passed to emcee, and is used to 
         ## calculate the probabilities during the MCMC run)
-        self.model = ModelGrid(spectrum, model, params, smooth=smooth,
-                               snap=snap, wavelength_bins=wavelength_bins)
+        ## An existing ModelGrid is reused for this spectrum, grid setup and all
+        if isinstance(model, ModelGrid):
+            self.model = model.for_spectrum(spectrum)
+            model = self.model.model
+            wavelength_bins = self.model.wavelength_bins
+            smooth = self.model.smooth
+        else:
+            self.model = ModelGrid(spectrum, model, params, smooth=smooth,
+                                   snap=snap, wavelength_bins=wavelength_bins)
         # print spectrum.keys()
         logging.info('Set model')
 
@@ -150,8 +182,17 @@ class BDSampler(object):
 
         ## Calculate starting parameters for the emcee walkers 
         ## by minimizing chi-squared just using the grid of synthetic spectra
-        self.start_p, self.min_chi = test_all(spectrum['wavelength'], spectrum['flux'],
-                                              spectrum['unc'], model, params, smooth=smooth, shortname=obj_name)
+        ## (a lazily read grid is only scanned coarsely, so starting the fit
+        ## doesn't read the whole grid from the database)
+        started = stats.start()
+        if start_p is not None:
+            self.start_p, self.min_chi = np.array(start_p, np.float64), None
+        else:
+            if isinstance(model['flux'], LazyFlux):
+                model = subsample_grid(model, params, lazy_scan_models)
+            self.start_p, self.min_chi = test_all(spectrum['wavelength'], spectrum['flux'],
+                                                  spectrum['unc'], model, params, smooth=smooth, shortname=obj_name)
+        stats.stop('test_all', started)
         for i in range(self.model_ndim):
             if (self.start_p[i] >= self.model.plims[params[i]]['max']):
                 self.start_p[i] = self.start_p[i] * 0.95
@@ -185,8 +226,13 @@ class BDSampler(object):
         ## The total number of dimensions for the fit is the number of
         ## parameters for the model plus any additional parameters added above
         self.ndim = len(self.all_params)
+        stats.stop('BDSampler.__init__', init_started)
 
-    def mcmc_go(self, nwalk_mult=20, nstep_mult=50, outfile=None):
+    def mcmc_go(self, nwalk_mult=20, nstep_mult=50, outfile=None, pool=None,
+                converge=False, block_steps=100, target_ess=2000,
+                tau_factor=50, max_steps=100000, max_time=None,
+                max_evals=None, backend=None, resume=False, compact=False,
+                thin=1, summarize=False, progress=None):
         """
         Sets up and calls emcee to carry out the MCMC algorithm
 
@@ -197,19 +243,105 @@ class BDSampler(object):
 
         nstep_mult: integer (default=50)
             multiplied by ndim to get the number of steps
+            (not used if converge=True; see max_steps)
 
         outfile: string (default=None)
             filename for any output files; if none is provided, use plot_title
 
+        pool: (default=None)
+            a pool with a map method (e.g. multiprocessing.Pool) that emcee
+            uses to compute lnprob for the walkers in parallel. Share the
+            grid first, so the workers attach to one copy of it instead of
+            each unpickling their own, and remove it when finished:
+               with x.model.share():
+                   x.mcmc_go(pool=pool)
+            (the shared files are also removed when this process exits)
+
+        converge: boolean (default=False)
+            rather than a fixed burn-in and run length, sample in blocks 
+            and stop once the chains have converged (see below); burn-in 
+            and thinning are then chosen from the autocorrelation time
+
+        block_steps: integer (default=100)
+            number of steps per block; convergence checks (converge=True)
+            and checkpoints (backend) happen after every block
+
+        target_ess: integer (default=2000)
+            number of effective (independent) samples to collect after
+            burn-in before stopping (converge=True)
+
+        tau_factor: float (default=50)
+            the autocorrelation time estimate is only trusted once the 
+            chain is longer than tau_factor*tau (converge=True)
+
+        max_steps: integer (default=100000)
+            upper limit on the number of steps (converge=True); normally
+            convergence or the time/evaluation budget comes first
+
+        max_time: float (default=None)
+            wall-clock budget in seconds (converge=True)
+
+        max_evals: integer (default=None)
+            budget of lnprob evaluations (converge=True)
+
+        backend: string or synth_fit.backend.ChainBackend (default=None)
+            chain file to checkpoint to: every block of the chain and its 
+            lnprob is appended as soon as it is sampled, together with the
+            walker positions and random state needed to resume
+
+        resume: boolean (default=False)
+            continue the run stored in backend instead of starting a new 
+            one (the BDSampler and the mcmc_go arguments should be the 
+            same as for the interrupted run)
+
+        compact: boolean (default=False)
+            keep the samples in a single preallocated float32 buffer 
+            (synth_fit.backend.ChainBuffer) instead of emcee's float64 
+            chain; burn-in steps are not stored at all, and self.chain and 
+            self.cropchain are views on the buffer
+
+        thin: integer (default=1)
+            keep only every thin-th step while sampling (converge=False;
+            with converge=True the thinning is chosen from tau)
+
+        summarize: boolean (default=False)
+            keep a streaming summary of the samples (self.sketch, a 
+            synth_fit.quantiles.QuantileSketch) that is updated after every
+            block, so running_quantiles() can be read while the run is 
+            still going; with converge=True it also covers the steps that
+            end up cut as burn-in
+
+        progress: (default=None)
+            report on the run after every block of steps (evaluations per
+            second, acceptance fraction, running autocorrelation time and
+            projected finishing time; see synth_fit.progress): True to log
+            the reports, a filename to also append them to it as lines of 
+            JSON, a function to call with each one, or a ProgressMonitor
+
         Creates
         -------
         self.chain (output of all chains)
         self.cropchain (cuts out the first 10% of the steps, 
             then flattens the chain)
+        self.tau (integrated autocorrelation time for each parameter)
+        self.backend (ChainBackend instance or None)
+        self.buffer (ChainBuffer instance, or None unless compact=True)
+        self.sketch (QuantileSketch instance, or None unless summarize=True)
+        self.progress (ProgressMonitor instance, or None) : holds the reports
+        self.timing (dictionary; only with synth_fit.instrument.stats enabled)
+            stage timings and counters for this run (see Instrumentation.report),
+            also written to plot_title + '_timing.json'
+
+        if converge=True:
+        self.burn_in, self.thin (steps cut from the start of the chain, 
+            and the thinning applied to the rest)
+        self.converged (boolean; False if a budget ran out first)
+        self.n_evals (number of lnprob evaluations)
         """
 
         nwalkers, nsteps = self.ndim * nwalk_mult, self.ndim * nstep_mult
         logging.info('%d walkers, %d steps', nwalkers, nsteps)
+        mcmc_started = stats.start()
 
         ## Initialize the walkers in a gaussian ball around start_p
         ## start_p was set in __init, with the minimum chi-squared model
@@ -221,45 +353,152 @@ class BDSampler(object):
                                     self.start_p)
             logging.debug('p0[%s] shape %s', i, str(p0[i]))
 
+        ## Set up the checkpoint file, or pick up where it stopped
+        if isinstance(backend, basestring):
+            backend = ChainBackend(backend)
+        self.backend = backend
+        done = {}
+        pos, prob, state = p0, None, None
+        if resume:
+            if backend is None or backend.exists()==False:
+                raise IOError("resume=True needs an existing backend file")
+            saved = backend.get_state()
+            if ((saved['header']['nwalkers']!=nwalkers) or 
+                (saved['header']['ndim']!=self.ndim)):
+                raise ValueError("{} holds a run with {} walkers and {} "
+                    "dimensions, not {} and {}".format(backend.filename,
+                    saved['header']['nwalkers'], saved['header']['ndim'],
+                    nwalkers, self.ndim))
+            done = saved['nsteps']
+            if saved['pos'] is not None:
+                pos, prob, state = saved['pos'], saved['prob'], saved['rstate']
+            logging.info('resuming from {} after {}'.format(
+                backend.filename, done))
+        elif backend is not None:
+            backend.reset(nwalkers, self.ndim, params=self.all_params,
+                name=self.name, converge=converge, nsteps=nsteps)
+
+        ## Streaming summary, including any steps already in the backend
+        self.sketch = None
+        if summarize:
+            phase = 'converge' if converge else 'run'
+            self.sketch = QuantileSketch(self.ndim)
+            if done.get(phase, 0) > 0:
+                self.sketch.update(backend.get_chain(phase).reshape(
+                    (-1, self.ndim)))
+
+        ## Progress reports after every block
+        if (progress is None) or (progress is False):
+            self.progress = None
+        elif isinstance(progress, ProgressMonitor):
+            self.progress = progress
+        elif isinstance(progress, basestring):
+            self.progress = ProgressMonitor(filename=progress)
+        elif callable(progress):
+            self.progress = ProgressMonitor(callback=progress)
+        else:
+            self.progress = ProgressMonitor()
+        if self.progress is not None:
+            if converge:
+                self.progress.start(nwalkers, max_steps, done.get('converge', 0))
+            else:
+                self.progress.start(nwalkers, nsteps / 10 + nsteps,
+                    done.get('burn', 0) + done.get('run', 0))
+
         ## Set up the sampler
-        sampler = emcee.EnsembleSampler(nwalkers, self.ndim, self.model)
+        sampler = emcee.EnsembleSampler(nwalkers, self.ndim, self.model,
+                                        pool=pool)
         logging.info('sampler set')
 
-        ## Burn in the walkers
-        pos, prob, state = sampler.run_mcmc(p0, nsteps / 10)
-        logging.debug('pos %s', str(pos))
-        logging.debug('prob %s', str(prob))
-        logging.debug('state %s', str(state))
-
-        ## Reset the walkers, so the burn-in steps aren't included in analysis
-        ## Now the walkers start at the position from the end of the burn-in
-        ## Then run the actual MCMC run
-        sampler.reset()
-        logging.info('sampler reset')
-        pos, prob, state = sampler.run_mcmc(pos, nsteps)
-        logging.info('sampler completed')
-        logging.info("avg accept {}".format(np.average(
-            sampler.acceptance_fraction)))
-        # logging.info("avg autocorrelation length {}".format(np.average(
-        #    sampler.acor)))
-
-        ## store chains for plotting/analysis
-        ## Chains contains the positions for each parameter, for each walker
-        self.chain = sampler.chain
-
-        ## cut out the burn-in samples (first 10%, for now)
-        burn_in = np.floor(nsteps * 0.1)
-        self.cropchain = sampler.chain[:, int(burn_in):, :].reshape(
-            (-1, self.ndim))
-
-        if self.snap:
-            chain_shape = np.shape(self.chain[:, burn_in:, :])
-            logging.debug("starting to snap {}".format(chain_shape))
-            self.cropchain = self.model.snap_full_run(self.cropchain)
-            logging.debug("Snapped cropchains {} to {}".format(
-                chain_shape, np.shape(self.cropchain)))
-            self.chain = self.cropchain.reshape(chain_shape)
-            logging.debug("Snapped chains")
+        ## With compact=True, samples go into one preallocated buffer 
+        ## (filled with any steps already in the backend when resuming)
+        self.buffer = None
+        if compact:
+            phase = 'converge' if converge else 'run'
+            if converge:
+                self.buffer = ChainBuffer(nwalkers, self.ndim, block_steps)
+            else:
+                self.buffer = ChainBuffer(nwalkers, self.ndim, nsteps, thin)
+            if done.get(phase, 0) > 0:
+                self.buffer.extend(backend.get_chain(phase),
+                    backend.get_lnprob(phase), done[phase])
+            storage = self.buffer
+        else:
+            storage = 'emcee'
+
+        if converge:
+            ## Burn-in and thinning are cut out by _run_until_converged
+            self.chain = self._run_until_converged(sampler, pos, prob, state,
+                done.get('converge', 0), max_steps, block_steps, target_ess,
+                tau_factor, max_time, max_evals, storage)
+            logging.info("avg accept {}".format(np.average(
+                sampler.acceptance_fraction)))
+            if compact:
+                self.cropchain = self.buffer.flatchain
+            else:
+                self.cropchain = self.chain.reshape((-1, self.ndim))
+
+            if self.snap:
+                self.cropchain = self.model.snap_full_run(self.cropchain)
+                self.chain = self.cropchain.reshape(np.shape(self.chain))
+                logging.debug("Snapped chains")
+        else:
+            ## Burn in the walkers
+            ## (in compact mode the burn-in steps aren't kept anywhere)
+            nburn = nsteps / 10
+            if done.get('run', 0)==0 and done.get('burn', 0) < nburn:
+                pos, prob, state = self._sample_blocks(sampler, pos, prob,
+                    state, nburn - done.get('burn', 0), 'burn', block_steps,
+                    None if compact else 'emcee')
+            logging.info('burn-in completed')
+
+            ## Reset the walkers, so the burn-in steps aren't included in analysis
+            ## Now the walkers start at the position from the end of the burn-in
+            ## Then run the actual MCMC run
+            sampler.reset()
+            logging.info('sampler reset')
+            pos, prob, state = self._sample_blocks(sampler, pos, prob, state,
+                nsteps - done.get('run', 0), 'run', block_steps, storage, thin)
+            logging.info('sampler completed')
+            logging.info("avg accept {}".format(np.average(
+                sampler.acceptance_fraction)))
+
+            ## store chains for plotting/analysis
+            ## Chains contains the positions for each parameter, for each walker
+            ## (a resumed run also needs the steps from before the restart)
+            if compact:
+                self.chain = self.buffer.chain
+            elif done.get('run', 0) > 0:
+                self.chain = backend.get_chain('run')
+            else:
+                self.chain = sampler.chain
+            self.tau = integrated_time(self.chain) * thin
+            logging.info("avg autocorrelation length {}".format(np.average(
+                self.tau)))
+
+            ## cut out the burn-in samples (first 10%, for now)
+            burn_in = int(np.floor(self.chain.shape[1] * 0.1))
+            full_chain = self.chain
+
+            ## (the cropped copy is only made for snapping; a compact chain
+            ## is a strided view, so reshaping it copies the whole chain)
+            if self.snap:
+                self.cropchain = full_chain[:, burn_in:, :].reshape(
+                    (-1, self.ndim))
+                chain_shape = np.shape(self.chain[:, burn_in:, :])
+                logging.debug("starting to snap {}".format(chain_shape))
+                self.cropchain = self.model.snap_full_run(self.cropchain)
+                logging.debug("Snapped cropchains {} to {}".format(
+                    chain_shape, np.shape(self.cropchain)))
+                self.chain = self.cropchain.reshape(chain_shape)
+                logging.debug("Snapped chains")
+
+            ## Reshape the chains (don't need to crop out burn-in b/c that's done)
+            ## This makes one array with all the samples for each parameter
+            if compact:
+                self.cropchain = self.buffer.flatchain
+            else:
+                self.cropchain = full_chain.reshape((-1, self.ndim))
 
         ## Save the chains to a pkl file for any diagnostics
         if outfile == None:
@@ -268,15 +507,186 @@ class BDSampler(object):
         cPickle.dump(self.chain, open_outfile)
         open_outfile.close()
 
-        ## Reshape the chains (don't need to crop out burn-in b/c that's done)
-        ## This makes one array with all the samples for each parameter
-        self.cropchain = sampler.chain.reshape((-1, self.ndim))
         self.get_quantiles()
 
+        ## With synth_fit.instrument.stats enabled, report on this run
+        stats.stop('mcmc_go', mcmc_started)
+        if stats.enabled:
+            self.timing = stats.report(getattr(self, '_stats_mark', None))
+            logging.info('timing of %s:\n%s', self.name,
+                stats.format_report(self.timing))
+            stats.write('{}_timing.json'.format(self.plot_title), self.timing)
+
+    def _sample_blocks(self, sampler, pos, prob, state, iterations, phase,
+                       block_steps, storage='emcee', thin=1):
+        """
+        Advances the sampler by iterations steps, in blocks of block_steps
+        when there is a backend to checkpoint each block to, a sketch to
+        update or progress to report (in one go otherwise, since every 
+        call to emcee's sample grows its chain)
+
+        storage: 'emcee' (emcee's own chain, thinned by thin), a 
+            ChainBuffer to record the steps in (thinned by the buffer), or
+            None to not store the steps at all
+
+        Returns
+        -------
+        pos, prob, state: the sampler state after the last step
+
+        """
+        buffered = isinstance(storage, ChainBuffer)
+        sketch = getattr(self, 'sketch', None)
+        if phase=='burn':
+            sketch = None
+        progress = getattr(self, 'progress', None)
+        if self.backend is None and sketch is None and progress is None:
+            block_steps = iterations
+        elif storage=='emcee':
+            ## emcee thins within each call, so blocks must keep in step
+            block_steps = max(block_steps // thin, 1) * thin
+        nstep = 0
+        while nstep < iterations:
+            n = min(block_steps, iterations - nstep)
+            if buffered:
+                start = storage.nstored
+            elif storage=='emcee':
+                start = sampler.chain.shape[1]
+            if progress is not None:
+                accepted = np.copy(sampler.naccepted)
+                block_start = time.time()
+            for pos, prob, state in sampler.sample(pos, lnprob0=prob,
+                    rstate0=state, iterations=n, thin=thin,
+                    storechain=(storage=='emcee')):
+                if buffered:
+                    storage.record(pos, prob)
+            nstep += n
+            if buffered:
+                chain, lnprob = storage.block(start)
+            elif storage=='emcee':
+                chain = sampler.chain[:, start:, :]
+                lnprob = sampler.lnprobability[:, start:]
+            else:
+                chain = np.zeros((sampler.k, 0, self.ndim))
+                lnprob = np.zeros((sampler.k, 0))
+            if sketch is not None:
+                sketch.update(chain.reshape((-1, self.ndim)))
+            if self.backend is not None:
+                self.backend.append(phase, chain, lnprob, pos, prob, state,
+                    iterations=n)
+            if progress is not None:
+                if buffered:
+                    phase_chain = storage.chain
+                elif storage=='emcee':
+                    phase_chain = sampler.chain
+                else:
+                    phase_chain = None
+                progress.update(phase, sampler, n, time.time() - block_start,
+                    accepted, phase_chain)
+        return pos, prob, state
+
+    def _run_until_converged(self, sampler, pos, prob, state, nstep,
+                             max_steps, block_steps, target_ess, tau_factor,
+                             max_time, max_evals, storage='emcee'):
+        """
+        Runs the sampler in blocks of block_steps, re-estimating the 
+        integrated autocorrelation time tau after every block (from the 
+        second half of the chain, so the initial transient doesn't inflate
+        it). Stops once the chain is longer than tau_factor*tau and holds 
+        target_ess effective samples after burn-in, or when max_steps, 
+        max_time or max_evals is reached; max_steps and max_evals are
+        never exceeded.
+
+        nstep is the number of steps already in self.backend, when 
+        resuming a run; pos, prob and state are the sampler state after 
+        them. storage is 'emcee' or a ChainBuffer (already holding those
+        steps); a ChainBuffer is cut down in place to the returned chain.
+
+        Burn-in is set to 2*max(tau) and thinning to min(tau)/2.
+
+        Returns
+        -------
+        chain: array_like (nwalkers, nkept, ndim)
+            the chain with burn-in removed and thinning applied
+
+        """
+        nwalkers = sampler.k
+        start_time = time.time()
+        buffered = isinstance(storage, ChainBuffer)
+        previous, chain = None, None
+        if buffered and nstep > 0:
+            chain = storage.chain
+        elif nstep > 0:
+            previous = chain = self.backend.get_chain('converge')
+        if chain is not None:
+            self._convergence_stats(chain, nwalkers)
+        self.n_evals = nwalkers * (nstep + 1)
+        self.converged = False
+
+        while True:
+            iterations = min(block_steps, max_steps - nstep)
+            if max_evals is not None:
+                ## emcee evaluates every walker once per step, plus once at p0
+                iterations = min(iterations,
+                    (max_evals - nwalkers * (nstep + 1)) // nwalkers)
+            if iterations < 1:
+                if nstep==0:
+                    raise ValueError("max_evals={} is too small for {} "
+                        "walkers".format(max_evals, nwalkers))
+                elif nstep >= max_steps:
+                    logging.info('step limit reached before convergence')
+                else:
+                    logging.info('evaluation limit reached before convergence')
+                break
+
+            pos, prob, state = self._sample_blocks(sampler, pos, prob, state,
+                iterations, 'converge', iterations, storage)
+            nstep += iterations
+            self.n_evals = nwalkers * (nstep + 1)
+
+            if buffered:
+                chain = storage.chain
+            else:
+                chain = sampler.chain
+            if previous is not None:
+                chain = np.concatenate((previous, chain), axis=1)
+            ess = self._convergence_stats(chain, nwalkers)
+
+            if (nstep >= tau_factor * np.max(self.tau)) and (ess >= target_ess):
+                self.converged = True
+                logging.info('chains converged')
+                break
+            elif (max_time is not None) and (
+                time.time() - start_time >= max_time):
+                logging.info('time limit reached before convergence')
+                break
+
+        if buffered:
+            storage.keep(self.burn_in, self.thin)
+            return storage.chain
+        return chain[:, self.burn_in::self.thin, :]
+
+    def _convergence_stats(self, chain, nwalkers):
+        """
+        Sets tau (from the second half of chain), burn_in and thin, and 
+        returns the number of effective samples after burn-in
+        """
+        nstep = chain.shape[1]
+        self.tau = integrated_time(chain[:, nstep // 2:, :])
+        max_tau = np.max(self.tau)
+        self.burn_in = min(int(np.ceil(2.0 * max_tau)), nstep - 1)
+        self.thin = max(int(0.5 * np.min(self.tau)), 1)
+        ess = effective_samples(nwalkers, nstep - self.burn_in, self.tau)
+        logging.info('{} steps: max tau {:.1f} burn-in {} thin {} '
+            'effective samples {:.0f}'.format(nstep, max_tau,
+            self.burn_in, self.thin, ess))
+        return ess
+
     def plot_triangle(self, extents=None):
         """
         Calls triangle module to create a corner-plot of the results
         """
+        from plotting import pyplot, triangle
+        plt = pyplot()
         self.corner_fig = triangle.corner(self.cropchain, labels=self.all_params, quantiles=[.16, .5, .84],
                                           verbose=False, extents=extents)  # , truths=np.ones(3))
         plt.suptitle(self.plot_title)
@@ -286,6 +696,11 @@ class BDSampler(object):
         Calls Adrian's code to plot the development of the chains
         as well as 1D histograms of the results
         """
+        from plotting import pyplot
+        # https://github.com/adrn/streams/blob/master/streams/plot/emcee.py
+        # Want to update ^ so it shows the burn_in cut
+        from plotting.emcee_plot import emcee_plot
+        plt = pyplot()
         self.chain_fig = emcee_plot(self.chain, labels=self.all_params)
         plt.suptitle(self.plot_title)
 
@@ -293,18 +708,28 @@ class BDSampler(object):
         """
         Calculate the quantiles given by quantiles for the array x
 
-        From DFM's triangle code
+        From DFM's triangle code (now with a partition instead of a sort;
+        see synth_fit.quantiles)
         """
-        xsorted = sorted(x)
-        qvalues = [xsorted[int(q * len(xsorted))] for q in quantiles]
+        qvalues = partition_quantiles(np.asarray(x)[:, np.newaxis],
+            quantiles)[0]
         return zip(quantiles, qvalues)
 
     def get_quantiles(self):
         """ calculates (16th, 50th, 84th) quantiles for all parameters """
-        self.all_quantiles = np.ones((self.ndim, 3)) * -99.
-        for i in range(self.ndim):
-            quant_array = self.quantile(self.cropchain[:, i], [.16, .5, .84])
-            self.all_quantiles[i] = [quant_array[j][1] for j in range(3)]
+        self.all_quantiles = np.asarray(partition_quantiles(self.cropchain,
+            [.16, .5, .84]), dtype=np.float64)
+
+    def running_quantiles(self, quantiles=[.16, .5, .84]):
+        """
+        Approximate quantiles (ndim, len(quantiles)) of the samples drawn
+        so far, from the streaming summary kept with summarize=True; can
+        be called while mcmc_go is running (e.g. from another thread)
+        """
+        if getattr(self, 'sketch', None) is None or self.sketch.count==0:
+            raise ValueError("no running summary; call mcmc_go with "
+                "summarize=True")
+        return self.sketch.quantiles(quantiles)
 
     def get_error_and_unc(self):
         """ Calculates 1-sigma uncertainties for all parameters """
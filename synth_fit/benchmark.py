@@ -0,0 +1,657 @@
+# Module for benchmarking the fitting hot paths on synthetic model grids
+# (made up on the spot, so no data files are needed), to compare
+# optimizations and see how the costs scale with the grid and the data
+#
+# Run as:
+#    python -m synth_fit.benchmark run --ndim 2 3 --points 5 10 --npix 2000
+# and to keep a history of results, and check a new version against it:
+#    python -m synth_fit.benchmark run --save history.json --label v1.1
+#    python -m synth_fit.benchmark compare history.json
+################################################################################
+
+import argparse
+import collections
+import datetime
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy as np
+import scipy
+from scipy import stats
+import astropy
+from astropy import units as u
+import emcee
+
+from make_model import ModelGrid
+from smooth import falt2, variable_smooth, smooth_grid
+from calc_chisq import test_all
+from bdfit import BDSampler
+from lazy_grid import model_from_database
+from quantized_grid import quantize_grid
+
+flux_unit = u.erg / u.AA / u.cm**2 / u.s
+
+## Modules the likelihood code shouldn't need (see import_footprint)
+heavy_modules = ['matplotlib', 'emcee', 'pandas', 'astrodbkit', 'scipy',
+                 'numba']
+
+## Parameters of the synthetic grids, in this order, and their ranges
+grid_ranges = collections.OrderedDict([('teff', (1000., 2000.)),
+    ('logg', (3.5, 5.5)), ('f_sed', (1., 4.)), ('k_zz', (2., 8.))])
+
+
+class BenchmarkSkipped(Exception):
+    """ raised by a benchmark setup that can't run here """
+    pass
+
+
+def synthetic_flux(wave, teff, logg, f_sed=2., k_zz=4.):
+    """ a smooth, positive, made-up spectrum with some narrow features """
+    return ((teff / 1000.)**4 *
+            np.exp(-(wave - 1.0 - teff / 4000.)**2 / (0.3 + logg / 20.)) *
+            (1 + 0.1 * np.sin(wave * f_sed * 10.)) *
+            (1 + 0.02 * k_zz * np.cos(wave * 7.)) *
+            (1 + 0.05 * np.sin(wave * 400.)) + 1e-3)
+
+
+def synthetic_grid(ndim=2, points=8, npix=2000, completeness=1.0, seed=0):
+    """
+    Makes a model dictionary (as used by ModelGrid) of synthetic spectra
+
+    Parameters
+    ----------
+    ndim: integer (default=2)
+        number of grid parameters (2 to 4; teff, logg, f_sed, k_zz)
+
+    points: integer (default=8)
+        grid values along each parameter
+
+    npix: integer (default=2000)
+        pixels in every model spectrum (0.9 to 2.4 microns)
+
+    completeness: float (default=1.0)
+        fraction of the grid points that have a model (the rest are left
+        out at random)
+
+    seed: integer (default=0)
+
+    Returns
+    -------
+    model: dictionary
+        'wavelength', 'flux' (Quantities) and one array per parameter
+
+    """
+    if (ndim < 2) or (ndim > len(grid_ranges)):
+        raise ValueError("ndim must be between 2 and {}".format(
+            len(grid_ranges)))
+    params = grid_ranges.keys()[:ndim]
+    axes = [np.linspace(grid_ranges[p][0], grid_ranges[p][1], points)
+            for p in params]
+    values = np.array(list(itertools.product(*axes)))
+    if completeness < 1.0:
+        keep = np.random.RandomState(seed).rand(len(values)) < completeness
+        values = values[keep]
+    wave = np.linspace(0.9, 2.4, npix)
+    model = {'wavelength':wave * u.um,
+             'flux':np.array([synthetic_flux(wave, *v) for v in values]) *
+                 flux_unit}
+    for i, p in enumerate(params):
+        model[p] = values[:, i]
+    return model
+
+
+def synthetic_spectrum(model, params, npix=500, snr=50., seed=1):
+    """
+    A noisy spectrum between grid points, on its own wavelength array
+
+    Returns
+    -------
+    spectrum: dictionary
+        'wavelength', 'flux' and 'unc' Quantities
+
+    p: array
+        the parameters it was made with
+    """
+    p = np.array([np.percentile(np.unique(model[param]), 40)
+                  for param in params])
+    wave = np.linspace(1.0, 2.3, npix)
+    flux = synthetic_flux(wave, *p)
+    noise = np.random.RandomState(seed).randn(npix) * flux / snr
+    return {'wavelength':wave * u.um, 'flux':(flux + noise) * flux_unit,
+            'unc':flux / snr * flux_unit}, p
+
+
+def resample_grid(model, wave):
+    """ the grid on the wavelengths wave, as make_model_db leaves it """
+    resampled = dict(model)
+    resampled['wavelength'] = wave
+    resampled['flux'] = np.array([np.interp(wave.value,
+        model['wavelength'].value, f) for f in model['flux'].value]) * \
+        model['flux'].unit
+    return resampled
+
+
+def _write_model_db(model, params, filename, table='synthetic'):
+    """ writes the grid as a table of the model atmosphere database """
+    def blob(array):
+        out = io.BytesIO()
+        np.save(out, np.asarray(array))
+        return sqlite3.Binary(out.getvalue())
+
+    connection = sqlite3.connect(filename)
+    connection.execute("CREATE TABLE {} (id INTEGER PRIMARY KEY, {}, "
+        "wavelength ARRAY, flux ARRAY)".format(table, ', '.join(
+        '{} REAL'.format(p) for p in params)))
+    wave = blob(model['wavelength'].value)
+    connection.executemany("INSERT INTO {} VALUES ({})".format(table,
+        ','.join('?' * (len(params) + 3))),
+        [[i + 1] + [float(model[p][i]) for p in params] +
+         [wave, blob(model['flux'][i].value)]
+         for i in range(len(model['flux']))])
+    connection.commit()
+    connection.close()
+    return table
+
+
+## Benchmarks: name -> setup(context) returning the function to time
+benchmarks = collections.OrderedDict()
+
+
+def benchmark(name):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+@benchmark('ModelGrid.__call__')
+def _setup_call(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'])
+    p = np.concatenate([c['p'], np.ones(3), [np.log(0.01)]])
+    return lambda: grid(p)
+
+
+@benchmark('interp_models')
+def _setup_interp(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'])
+    return lambda: grid.interp_models(c['p'])
+
+
+## The same with the flux kept in float32 (see ModelGrid flux_dtype)
+@benchmark('ModelGrid.__call__ float32')
+def _setup_call_float32(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'],
+        flux_dtype=np.float32)
+    p = np.concatenate([c['p'], np.ones(3), [np.log(0.01)]])
+    return lambda: grid(p)
+
+
+@benchmark('interp_models float32')
+def _setup_interp_float32(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'],
+        flux_dtype=np.float32)
+    return lambda: grid.interp_models(c['p'])
+
+
+## and encoded as 16-bit integers (see synth_fit.quantized_grid)
+@benchmark('ModelGrid.__call__ int16')
+def _setup_call_int16(c):
+    grid = ModelGrid(c['spectrum'], quantize_grid(c['model']), c['params'])
+    p = np.concatenate([c['p'], np.ones(3), [np.log(0.01)]])
+    return lambda: grid(p)
+
+
+@benchmark('interp_models int16')
+def _setup_interp_int16(c):
+    grid = ModelGrid(c['spectrum'], quantize_grid(c['model']), c['params'])
+    return lambda: grid.interp_models(c['p'])
+
+
+## and with the fused kernel (see ModelGrid backend; the first call, 
+## which compiles it, is made before timing)
+@benchmark('ModelGrid.__call__ numba')
+def _setup_call_numba(c):
+    try:
+        grid = ModelGrid(c['spectrum'], c['model'], c['params'],
+            backend='numba')
+    except ImportError as err:
+        raise BenchmarkSkipped(str(err))
+    p = np.concatenate([c['p'], np.ones(3), [np.log(0.01)]])
+    grid(p)
+    return lambda: grid(p)
+
+
+## and with the PCA emulator (see ModelGrid.emulate)
+@benchmark('ModelGrid.__call__ pca')
+def _setup_call_pca(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'])
+    grid.emulate()
+    p = np.concatenate([c['p'], np.ones(3), [np.log(0.01)]])
+    return lambda: grid(p)
+
+
+## and with cubic-spline interpolation (see ModelGrid interpolation)
+@benchmark('ModelGrid.__call__ cubic')
+def _setup_call_cubic(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'],
+        interpolation='cubic')
+    p = np.concatenate([c['p'], np.ones(3), [np.log(0.01)]])
+    return lambda: grid(p)
+
+
+@benchmark('retrieve_model')
+def _setup_retrieve(c):
+    grid = ModelGrid(c['spectrum'], c['model'], c['params'])
+    return lambda: grid.retrieve_model(c['p'])
+
+
+## test_all and BDSampler are given the grid on the data wavelengths, the
+## way fits are set up (see make_model_db)
+@benchmark('test_all')
+def _setup_test_all(c):
+    from plotting import pyplot
+    plt = pyplot()
+    spectrum = c['spectrum']
+
+    def run():
+        test_all(spectrum['wavelength'], spectrum['flux'], spectrum['unc'],
+            c['resampled'], c['params'], shortname='benchmark')
+        plt.close('all')
+    return run
+
+
+@benchmark('falt2')
+def _setup_falt2(c):
+    model = c['model']
+    return lambda: falt2(model['wavelength'], model['flux'][0], c['resolution'])
+
+
+@benchmark('variable_smooth')
+def _setup_variable_smooth(c):
+    ## one falt2 per data pixel, so only a few pixels
+    model = c['model']
+    data_wave = c['spectrum']['wavelength'][:c['smooth_pixels']]
+    return lambda: variable_smooth(model['wavelength'], model['flux'][0],
+        data_wave)
+
+
+@benchmark('smooth_grid')
+def _setup_smooth_grid(c):
+    model = c['model']
+    rows = [model['flux'][i] for i in range(min(c['smooth_models'],
+                                                 len(model['flux'])))]
+    return lambda: smooth_grid({'wavelength':model['wavelength'],
+        'flux':list(rows)}, c['spectrum']['wavelength'], variable=False,
+        res=c['resolution'], incremental_outfile='none',
+        indiv_wave_arrays=False)
+
+
+@benchmark('make_model_db')
+def _setup_make_model_db(c):
+    try:
+        ## mcmc_fit imports these when make_model_db is called
+        import astrodbkit, pandas
+        from mcmc_fit.mcmc_fit import make_model_db
+    except ImportError as err:
+        raise BenchmarkSkipped('needs mcmc_fit ({})'.format(err))
+    filename = os.path.join(c['tmpdir'], 'model_atmospheres.db')
+    table = _write_model_db(c['model'], c['params'], filename)
+    return lambda: make_model_db(table, filename, param_lims=None,
+        rebin_models=c['model']['wavelength'].value, fill_holes=False)
+
+
+@benchmark('model_from_database')
+def _setup_model_from_database(c):
+    filename = os.path.join(c['tmpdir'], 'lazy_model_atmospheres.db')
+    table = _write_model_db(c['model'], c['params'], filename)
+    return lambda: model_from_database(filename, table)['flux'].value
+
+
+@benchmark('mcmc_go')
+def _setup_mcmc_go(c):
+    bdsamp = BDSampler('benchmark', c['spectrum'], c['resampled'], c['params'],
+        plot_title=os.path.join(c['tmpdir'], 'benchmark'))
+    return lambda: bdsamp.mcmc_go(nwalk_mult=2, nstep_mult=c['mcmc_steps'])
+
+
+def import_footprint(module, check=heavy_modules):
+    """
+    Imports module in a fresh interpreter (as a pool worker or batch job
+    would), and returns the seconds the import took and which of the
+    check modules it pulled in
+    """
+    code = ('import json, sys\n'
+            'from timeit import default_timer\n'
+            'start = default_timer()\n'
+            'import {}\n'
+            'elapsed = default_timer() - start\n'
+            'print(json.dumps([elapsed, [m for m in {!r} '
+            'if m in sys.modules]]))').format(module, list(check))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    elapsed, loaded = json.loads(output.strip().splitlines()[-1])
+    return elapsed, [str(m) for m in loaded]
+
+
+## Startup: a fresh interpreter importing the likelihood code, and the
+## sampler (the times include starting the interpreter)
+def _setup_import(module, needs=()):
+    def setup(c):
+        elapsed, loaded = import_footprint(module)
+        loaded = [m for m in loaded if m not in needs]
+        if loaded:
+            logging.warning('import %s loads %s', module, ', '.join(loaded))
+        return lambda: import_footprint(module)
+    return setup
+
+benchmark('import make_model')(_setup_import('synth_fit.make_model'))
+benchmark('import bdfit')(_setup_import('synth_fit.bdfit', ['emcee']))
+
+
+def time_function(function, repeat=5, min_time=0.2):
+    """
+    Times function: it is called in loops of `number` calls, with
+    number chosen so a loop takes about min_time / repeat seconds (at
+    least one call), and the loop is timed repeat times
+
+    Returns
+    -------
+    times: list
+        seconds per call, from each loop
+
+    number: integer
+        calls per loop
+    """
+    start = default_timer()
+    function()
+    first = default_timer() - start
+    number = int(max(min(min_time / repeat / max(first, 1e-9), 1e5), 1))
+    times = []
+    for i in range(repeat):
+        start = default_timer()
+        for j in xrange(number):
+            function()
+        times.append((default_timer() - start) / number)
+    return times, number
+
+
+def run_benchmarks(ndim=2, points=8, npix=2000, data_npix=500,
+                   completeness=1.0, names=None, repeat=5, min_time=0.2,
+                   seed=0):
+    """
+    Runs benchmarks on a synthetic grid
+
+    Parameters
+    ----------
+    ndim, points, npix, completeness, seed: see synthetic_grid
+
+    data_npix: integer (default=500)
+        pixels in the synthetic spectrum
+
+    names: list of strings (optional)
+        benchmarks to run (default: all of benchmarks)
+
+    repeat, min_time: see time_function
+
+    Returns
+    -------
+    results: list of dictionaries
+        one per benchmark, with 'name', 'config' (the grid settings),
+        'status' ('ok', 'skipped' or 'failed'), 'error', and for those
+        that ran, 'times' (seconds per call), 'number', 'best', 'median'
+        'mean' and 'std'
+
+    """
+    config = collections.OrderedDict([('ndim', ndim), ('points', points),
+        ('npix', npix), ('data_npix', data_npix),
+        ('completeness', completeness)])
+    model = synthetic_grid(ndim, points, npix, completeness, seed)
+    params = grid_ranges.keys()[:ndim]
+    spectrum, p = synthetic_spectrum(model, params, data_npix)
+    tmpdir = tempfile.mkdtemp(prefix='synth_fit_benchmark')
+    context = {'model':model, 'params':params, 'spectrum':spectrum, 'p':p,
+               'resampled':resample_grid(model, spectrum['wavelength']),
+               'resolution':0.002 * u.um, 'smooth_pixels':20,
+               'smooth_models':10, 'mcmc_steps':2, 'tmpdir':tmpdir}
+    config['nmodels'] = len(model['flux'])
+
+    results = []
+    try:
+        for name in (names or benchmarks.keys()):
+            result = collections.OrderedDict([('name', name),
+                ('config', config), ('status', 'ok'), ('error', '')])
+            try:
+                times, number = time_function(benchmarks[name](context),
+                    repeat, min_time)
+                result.update([('times', times), ('number', number),
+                    ('best', min(times)), ('median', float(np.median(times))),
+                    ('mean', float(np.mean(times))),
+                    ('std', float(np.std(times)))])
+            except BenchmarkSkipped as err:
+                result['status'], result['error'] = 'skipped', str(err)
+            except Exception as err:
+                logging.exception('benchmark %s failed', name)
+                result['status'] = 'failed'
+                result['error'] = '{}: {}'.format(type(err).__name__, err)
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in [('s', 1.), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
+
+
+def format_table(results):
+    """ the results as a text table, one line per benchmark and grid """
+    lines = ['{:<26} {:>4} {:>6} {:>6} {:>6} {:>5} {:>7} {:>10} {:>10} '
+        '{:>9}'.format('benchmark', 'ndim', 'points', 'npix', 'data', 'compl',
+        'models', 'best', 'median', 'std %')]
+    for r in results:
+        c = r['config']
+        line = '{:<26} {:>4} {:>6} {:>6} {:>6} {:>5.2f} {:>7}'.format(
+            r['name'], c['ndim'], c['points'], c['npix'], c['data_npix'],
+            c['completeness'], c['nmodels'])
+        if r['status']=='ok':
+            line += ' {:>10} {:>10} {:>9.1f}'.format(format_time(r['best']),
+                format_time(r['median']), 100 * r['std'] / r['mean'])
+        else:
+            line += '  {}: {}'.format(r['status'], r['error'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def environment():
+    """
+    Where a set of results came from: machine, Python and library versions
+    and the BLAS/LAPACK numpy is built with
+    """
+    info = collections.OrderedDict([
+        ('time', datetime.datetime.now().isoformat()),
+        ('host', platform.node()), ('platform', platform.platform()),
+        ('processor', platform.processor()),
+        ('cpus', multiprocessing.cpu_count()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__), ('scipy', scipy.__version__),
+        ('astropy', astropy.__version__), ('emcee', emcee.__version__)])
+    for name in ['blas_opt_info', 'lapack_opt_info']:
+        config = np.__config__.get_info(name)
+        info[name] = dict((k, config[k]) for k in ['libraries', 'language',
+                          'define_macros'] if k in config)
+    info['threads'] = dict((k, os.environ[k]) for k in ['OMP_NUM_THREADS',
+        'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'] if k in os.environ)
+    return info
+
+
+def load_history(filename):
+    """ the runs saved in a benchmark history file (oldest first) """
+    if os.path.exists(filename)==False:
+        return []
+    with open(filename) as f:
+        return json.load(f)['runs']
+
+
+def save_results(results, filename, label=''):
+    """
+    Appends a run (its results, with environment()) to the JSON history
+    in filename, and returns the run
+    """
+    runs = load_history(filename)
+    run = collections.OrderedDict([('id', len(runs)), ('label', label),
+        ('environment', environment()), ('results', results)])
+    runs.append(run)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'runs':runs}, f, indent=1)
+    os.rename(filename + '.tmp', filename)
+    logging.info('saved run {} to {}'.format(run['id'], filename))
+    return run
+
+
+def _result_key(result):
+    c = result['config']
+    return (result['name'],) + tuple(c[k] for k in ['ndim', 'points', 'npix',
+        'data_npix', 'completeness'])
+
+
+def compare_runs(baseline, current, alpha=0.01, threshold=0.05):
+    """
+    Compares the benchmarks two runs (from load_history) have in common.
+    A benchmark is flagged 'slower' (or 'faster') when its median time per
+    call changed by more than threshold and Welch's t-test on the log of
+    the loop times of the two runs gives p < alpha; otherwise it is 'same'
+    ('unknown' with fewer than 2 loop times in either run)
+
+    Returns
+    -------
+    comparisons: list of dictionaries
+        'name', 'config', 'baseline' and 'current' (median seconds per
+        call), 'ratio' (current / baseline), 'p' and 'verdict'
+
+    """
+    before = dict((_result_key(r), r) for r in baseline['results']
+                  if r['status']=='ok')
+    comparisons = []
+    for r in current['results']:
+        key = _result_key(r)
+        if (r['status']!='ok') or (key not in before):
+            continue
+        b = before[key]
+        ratio = r['median'] / b['median']
+        p = None
+        verdict = 'unknown'
+        if len(b['times']) > 1 and len(r['times']) > 1:
+            p = float(stats.ttest_ind(np.log(b['times']), np.log(r['times']),
+                equal_var=False)[1])
+            verdict = 'same'
+            if p < alpha and ratio > 1 + threshold:
+                verdict = 'slower'
+            elif p < alpha and ratio < 1 - threshold:
+                verdict = 'faster'
+        comparisons.append(collections.OrderedDict([('name', r['name']),
+            ('config', r['config']), ('baseline', b['median']),
+            ('current', r['median']), ('ratio', ratio), ('p', p),
+            ('verdict', verdict)]))
+    return comparisons
+
+
+def format_comparison(comparisons):
+    """ the comparisons as a text table """
+    lines = ['{:<26} {:>4} {:>6} {:>6} {:>6} {:>5} {:>10} {:>10} {:>7} '
+        '{:>8}  {}'.format('benchmark', 'ndim', 'points', 'npix', 'data',
+        'compl', 'baseline', 'current', 'ratio', 'p', 'verdict')]
+    for c in comparisons:
+        g = c['config']
+        lines.append('{:<26} {:>4} {:>6} {:>6} {:>6} {:>5.2f} {:>10} {:>10} '
+            '{:>7.3f} {:>8}  {}'.format(c['name'], g['ndim'], g['points'],
+            g['npix'], g['data_npix'], g['completeness'],
+            format_time(c['baseline']), format_time(c['current']),
+            c['ratio'], 'n/a' if c['p'] is None else '{:.2g}'.format(c['p']),
+            c['verdict'].upper() if c['verdict']=='slower' else c['verdict']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ runs the command line; returns the exit status (1 if compare
+    finds a slowdown) """
+    parser = argparse.ArgumentParser(description="Benchmark the fitting "
+        "hot paths on synthetic model grids")
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help="run benchmarks and print a table "
+        "(every combination of the grid settings given)")
+    run.add_argument('--ndim', type=int, nargs='+', default=[2])
+    run.add_argument('--points', type=int, nargs='+', default=[8],
+        help="grid values per parameter")
+    run.add_argument('--npix', type=int, nargs='+', default=[2000],
+        help="pixels per model spectrum")
+    run.add_argument('--data-npix', type=int, nargs='+', default=[500],
+        help="pixels in the spectrum being fit")
+    run.add_argument('--completeness', type=float, nargs='+', default=[1.0],
+        help="fraction of grid points with a model")
+    run.add_argument('--only', nargs='+', choices=benchmarks.keys(),
+        help="benchmarks to run (default: all)")
+    run.add_argument('--repeat', type=int, default=5)
+    run.add_argument('--min-time', type=float, default=0.2,
+        help="seconds to spend timing each benchmark (roughly)")
+    run.add_argument('--save', metavar='HISTORY',
+        help="append the results to this JSON history file")
+    run.add_argument('--label', default='',
+        help="label for the saved run (e.g. a version)")
+
+    compare = commands.add_parser('compare', help="compare two runs in a "
+        "history file; exits with status 1 if anything got slower")
+    compare.add_argument('history')
+    compare.add_argument('--baseline', type=int, default=-2,
+        help="id of the baseline run (default: the one before last)")
+    compare.add_argument('--current', type=int, default=-1,
+        help="id of the run to check (default: the last)")
+    compare.add_argument('--alpha', type=float, default=0.01,
+        help="significance level of the t-test")
+    compare.add_argument('--threshold', type=float, default=0.05,
+        help="smallest relative change that counts")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command=='compare':
+        runs = load_history(args.history)
+        if len(runs) < 2:
+            parser.error("{} holds {} run(s); need 2 to compare".format(
+                args.history, len(runs)))
+        baseline, current = runs[args.baseline], runs[args.current]
+        comparisons = compare_runs(baseline, current, args.alpha,
+            args.threshold)
+        print 'baseline: run {} {} ({})'.format(baseline['id'],
+            baseline['label'], baseline['environment']['time'])
+        print 'current:  run {} {} ({})'.format(current['id'],
+            current['label'], current['environment']['time'])
+        print format_comparison(comparisons)
+        return int(any(c['verdict']=='slower' for c in comparisons))
+
+    results = []
+    for ndim, points, npix, data_npix, completeness in itertools.product(
+            args.ndim, args.points, args.npix, args.data_npix,
+            args.completeness):
+        results.extend(run_benchmarks(ndim, points, npix, data_npix,
+            completeness, args.only, args.repeat, args.min_time))
+    print format_table(results)
+    if args.save:
+        save_results(results, args.save, args.label)
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -8,13 +8,8 @@ import logging
 import numpy as np
 from astropy import units as u
 import pickle
-from smooth import *
-import matplotlib.colors as colors
+from smooth import falt2
 
-from matplotlib.colors import ListedColormap
-from matplotlib.colors import LinearSegmentedColormap
-from pylab import *
-cmap = cm.get_cmap('RdPu')
 
 def discrete_cmap(N, base_cmap=None):
     """Create an N-bin discrete colormap from the specified input map"""
@@ -23,14 +18,75 @@ def discrete_cmap(N, base_cmap=None):
     #    return plt.cm.get_cmap(base_cmap, N)
     # The following works for string, None, or a colormap instance:
 
+    from plotting import pyplot
+    plt = pyplot()
     base = plt.cm.get_cmap(base_cmap)
     color_list = base(np.linspace(0, 1, N))
     cmap_name = base.name + str(N)
     return base.from_list(cmap_name, color_list, N)
 
-cmap = plt.get_cmap('RdPu')
-sub_cmap = LinearSegmentedColormap.from_list('trunc({n},{a:.2f},{b:.2f})'.format(n=cmap.name, a=0.2, b=1),cmap(np.linspace(0.2, 1, 6)))
-new_cmap = discrete_cmap(6, base_cmap=sub_cmap)
+## The colormap for test_all's plot, made on first use rather than at import
+_new_cmap = []
+
+def get_new_cmap():
+    if len(_new_cmap)==0:
+        from matplotlib.colors import LinearSegmentedColormap
+        from plotting import pyplot
+        cmap = pyplot().get_cmap('RdPu')
+        sub_cmap = LinearSegmentedColormap.from_list('trunc({n},{a:.2f},{b:.2f})'.format(n=cmap.name, a=0.2, b=1),cmap(np.linspace(0.2, 1, 6)))
+        _new_cmap.append(discrete_cmap(6, base_cmap=sub_cmap))
+    return _new_cmap[0]
+
+def subsample_grid(model_dict, params, max_models=100):
+    """
+    Returns a coarser version of model_dict for test_all to scan: every
+    other (then every third, ...) value of the parameter with the most
+    values is dropped until at most max_models grid points are left, and
+    only those flux rows are read (so a LazyFlux grid isn't read in full)
+
+    Parameters
+    ----------
+    model_dict: dictionary
+        model grid, as for test_all
+
+    params: list of strings
+
+    max_models: integer (default=100)
+
+    Returns
+    -------
+    model_dict: dictionary
+        with the same keys, holding the kept grid points
+
+    """
+    nmodels = len(model_dict['flux'])
+    values = [np.unique(model_dict[p]) for p in params]
+    strides = [1] * len(params)
+    def kept(i):
+        return len(values[i][::strides[i]])
+    while np.prod([kept(i) for i in range(len(params))]) > max_models:
+        ## coarsen the axis with the most values left (if any can be)
+        i = np.argmax([kept(i) for i in range(len(params))])
+        if kept(i)==1:
+            break
+        strides[i] += 1
+
+    keep = np.ones(nmodels, bool)
+    for p, v, stride in zip(params, values, strides):
+        keep &= np.in1d(np.asarray(model_dict[p]), v[::stride])
+    rows = np.where(keep)[0]
+
+    subset = {}
+    for k, v in model_dict.items():
+        if k=='flux':
+            subset[k] = v[rows]
+        elif (k!='wavelength') and (np.ndim(v)>0) and (len(v)==nmodels):
+            subset[k] = np.asarray(v)[rows]
+        else:
+            subset[k] = v
+    logging.info('calc_chisq.subsample_grid: scanning {} of {} models'.format(
+        len(rows), nmodels))
+    return subset
 
 def calc_chisq(data_flux,data_unc,model_flux):
     a = (data_flux-model_flux)**2
@@ -101,6 +157,10 @@ def test_all(data_wave, data_flux, data_unc, model_dict, params,
         logging.info('calc_chisq.test_all: INTERPOLATION NEEDED')
 
 
+    from plotting import pyplot
+    plt = pyplot()
+    new_cmap = get_new_cmap()
+
     ndim = len(params)
 
     num_models = len(model_dict['flux'])
@@ -137,7 +197,7 @@ def test_all(data_wave, data_flux, data_unc, model_dict, params,
         bad = np.isnan(mult1)
         mult = np.sum(mult1[~bad])
         sq1 = mod_flux*mod_flux/(data_unc**2)
-        mult2 = float(sum(sq1[~bad]))
+        mult2 = float(np.sum(sq1[~bad]))
         ck = mult/mult2
         mod_flux=mod_flux*ck
 
@@ -171,4 +231,4 @@ def test_all(data_wave, data_flux, data_unc, model_dict, params,
     fb = open('/Users/Dropbox/BDNYC/BDNYC_Research/Python/Modules/synth_fit/output/chisquares_{}'.format(shortname)+'.pkl','wb')
     pickle.dump(save_chisq,fb)
     fb.close()
-    return best_params,min(chisq)
+    return best_params,np.min(chisq)
@@ -0,0 +1,320 @@
+# Module for a long-lived local fitting service: it keeps model grids
+# loaded, set up and in shared memory, and runs the fits it is sent on a
+# pool of worker processes, so each fit skips the imports, grid loading
+# and grid setup that a fresh script pays for
+################################################################################
+
+import argparse
+import logging
+import multiprocessing
+from multiprocessing.connection import Client, Listener
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from make_model import ModelGrid
+from batch import load_grid, fit_object, write_outputs, grid_params
+
+
+def default_address():
+    """ Unix socket the daemon listens on, unless told otherwise """
+    return os.path.join(tempfile.gettempdir(),
+        'synth_fit_{}.sock'.format(os.getuid()))
+
+
+def default_authkey():
+    """ key clients must present (set SYNTH_FIT_AUTHKEY to change it) """
+    return os.environ.get('SYNTH_FIT_AUTHKEY', 'synth_fit')
+
+
+def _fit_job(job):
+    """ runs one fit in a worker process """
+    grid, name, spectrum, outdir, plot, return_chain, options = job
+    row, bdsamp = fit_object(grid, name, spectrum, outdir=outdir,
+        return_sampler=True, **options)
+    result = {'row':row, 'files':[]}
+    if bdsamp is not None:
+        write_outputs(bdsamp, outdir, plot)
+        base = os.path.join(outdir, name)
+        result['files'] = [f for f in [options.get('outfile'),
+            bdsamp.plot_title + '_chains.pkl', base + '_results.pkl',
+            base + '_triangle.pdf', base + '_chains.pdf']
+            if (f is not None) and os.path.exists(f)]
+        result['error_and_unc'] = bdsamp.error_and_unc
+        result['all_params'] = bdsamp.all_params
+        if return_chain:
+            result['chain'] = np.asarray(bdsamp.chain)
+    return result
+
+
+class FitDaemon(object):
+    """
+    Local fitting service. Model grids are loaded once (with load_grid
+    requests, or on the command line), set up as ModelGrids and moved
+    into shared memory; fit requests name a grid and send a spectrum, and
+    are run on the worker pool, several at once. Requests come in over a
+    Unix socket (multiprocessing.connection, with an authentication key),
+    one thread per client connection.
+
+    Start it with:
+       python -m synth_fit.daemon --grid bt_settl=bt_settl.pkl
+    and use it with FitClient:
+       client = FitClient()
+       result = client.fit('bt_settl', '1256-0224', spectrum, nstep_mult=20)
+
+    Parameters for __init__
+    -----------------------
+    address: string (default=None)
+        Unix socket path; default_address() if None
+
+    authkey: string (default=None)
+        key clients must present; default_authkey() if None
+
+    processes: integer (default=None)
+        worker processes (None means one per cpu)
+
+    outdir: string (default='.')
+        where fit outputs go, unless a request says otherwise
+
+    Creates
+    -------
+    grids (dictionary) : ModelGrids by name
+    n_fits (integer) : fits run so far
+
+    """
+
+    def __init__(self, address=None, authkey=None, processes=None, outdir='.'):
+        self.address = address or default_address()
+        self.authkey = authkey or default_authkey()
+        self.outdir = outdir
+        self.grids = {}
+        self.n_fits = 0
+        self._stopping = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.listener = Listener(self.address, 'AF_UNIX', authkey=self.authkey)
+        os.chmod(self.address, 0600)
+        self.pool = multiprocessing.Pool(processes)
+        logging.info('fit daemon listening on %s', self.address)
+
+    def load_grid(self, name, filename, params=None):
+        """
+        Loads a pickled model dictionary (see batch.load_grid), sets it up
+        as a ModelGrid and shares it with the workers; returns a summary
+        """
+        model = load_grid(filename)
+        if params is None:
+            params = [p for p in grid_params if p in model]
+        ## ModelGrid needs a spectrum to be set up; fits retarget it
+        placeholder = {'wavelength':model['wavelength'],
+                       'flux':model['flux'][0], 'unc':model['flux'][0]}
+        grid = ModelGrid(placeholder, model, params)
+        try:
+            grid.grid_index()
+        except ValueError as err:
+            logging.info('grid %s: %s', name, err)
+        grid.share()
+        with self._lock:
+            old = self.grids.pop(name, None)
+            self.grids[name] = grid
+        if old is not None and old.shared is not None:
+            old.shared.unlink()
+        logging.info('loaded grid %s from %s', name, filename)
+        return self._describe(name)
+
+    def _describe(self, name):
+        grid = self.grids[name]
+        return {'name':name, 'params':list(grid.params),
+                'nmodels':len(grid.model['flux']),
+                'npix':len(grid.model['wavelength']),
+                'limits':dict((p, (grid.plims[p]['min'], grid.plims[p]['max']))
+                              for p in grid.params)}
+
+    def fit(self, grid, name, spectrum, outdir=None, plot=False,
+            return_chain=False, **options):
+        """
+        Fits spectrum against the loaded grid on the worker pool, and
+        returns a dictionary with the row of results ('row', see
+        batch.fit_object), 'all_params', 'error_and_unc', the output
+        'files', and with return_chain=True the 'chain'
+        """
+        if grid not in self.grids:
+            raise KeyError("no grid {} loaded (have {})".format(grid,
+                sorted(self.grids.keys())))
+        outdir = outdir or self.outdir
+        if os.path.isdir(outdir)==False:
+            os.makedirs(outdir)
+        job = (self.grids[grid], name, spectrum, outdir, plot, return_chain,
+               options)
+        result = self.pool.apply_async(_fit_job, (job,)).get()
+        with self._lock:
+            self.n_fits += 1
+        return result
+
+    def handle(self, request):
+        """ carries out one request (a dictionary with a 'command') """
+        command = request.get('command')
+        if command=='ping':
+            return {'grids':sorted(self.grids.keys()), 'fits':self.n_fits}
+        elif command=='grids':
+            return [self._describe(name) for name in sorted(self.grids.keys())]
+        elif command=='load_grid':
+            return self.load_grid(request['name'], request['filename'],
+                request.get('params'))
+        elif command=='fit':
+            return self.fit(request['grid'], request['name'],
+                request['spectrum'], **request.get('options', {}))
+        elif command=='shutdown':
+            self.stop()
+            return 'stopping'
+        else:
+            raise ValueError("unknown command {}".format(command))
+
+    def _serve_connection(self, conn):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, IOError):
+                    break
+                start_time = time.time()
+                try:
+                    reply = {'ok':True, 'result':self.handle(request)}
+                except Exception as err:
+                    logging.exception('request %s failed',
+                        request.get('command'))
+                    reply = {'ok':False,
+                             'error':'{}: {}'.format(type(err).__name__, err)}
+                logging.info('%s done in %.2f s', request.get('command'),
+                    time.time() - start_time)
+                conn.send(reply)
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        """ accepts connections until a shutdown request (or stop()) """
+        try:
+            while self._stopping==False:
+                try:
+                    conn = self.listener.accept()
+                except Exception as err:
+                    if self._stopping==False:
+                        logging.info('refused connection: %s', err)
+                    continue
+                if self._stopping:
+                    conn.close()
+                    break
+                thread = threading.Thread(target=self._serve_connection,
+                    args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+
+    def stop(self):
+        """ makes serve_forever return after the current requests """
+        self._stopping = True
+        ## Wake up the accept() in serve_forever
+        try:
+            Client(self.address, 'AF_UNIX', authkey=self.authkey).close()
+        except Exception:
+            pass
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.pool.close()
+        self.pool.join()
+        for grid in self.grids.values():
+            if grid.shared is not None:
+                grid.shared.unlink()
+        logging.info('fit daemon stopped')
+
+
+class FitClient(object):
+    """
+    Connection to a running FitDaemon
+
+    Call as:
+       client = FitClient()
+       client.load_grid('bt_settl', 'bt_settl.pkl')
+       result = client.fit('bt_settl', '1256-0224', spectrum, nstep_mult=20)
+       print result['row']
+
+    Parameters for __init__
+    -----------------------
+    address, authkey: as for FitDaemon
+
+    """
+
+    def __init__(self, address=None, authkey=None):
+        self.conn = Client(address or default_address(), 'AF_UNIX',
+            authkey=authkey or default_authkey())
+
+    def request(self, command, **kwargs):
+        kwargs['command'] = command
+        self.conn.send(kwargs)
+        reply = self.conn.recv()
+        if reply['ok']==False:
+            raise RuntimeError(reply['error'])
+        return reply['result']
+
+    def ping(self):
+        return self.request('ping')
+
+    def grids(self):
+        return self.request('grids')
+
+    def load_grid(self, name, filename, params=None):
+        """ filename is read by the daemon, so give an absolute path """
+        return self.request('load_grid', name=name,
+            filename=os.path.abspath(filename), params=params)
+
+    def fit(self, grid, name, spectrum, **options):
+        """
+        Fits spectrum (a dictionary of 'wavelength', 'flux' and 'unc'
+        Quantities) against a loaded grid. options go to FitDaemon.fit
+        (outdir, plot, return_chain) and BDSampler.mcmc_go
+        """
+        return self.request('fit', grid=grid, name=name, spectrum=spectrum,
+            options=options)
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+    def close(self):
+        self.conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local fitting "
+        "service that keeps model grids loaded")
+    parser.add_argument('--grid', action='append', default=[],
+        metavar='NAME=FILE', help="pickled model grid to load (repeatable)")
+    parser.add_argument('--address', default=None,
+        help="Unix socket to listen on (default: {})".format(default_address()))
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--outdir', default='.',
+        help="directory for fit outputs")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    daemon = FitDaemon(args.address, processes=args.processes,
+        outdir=args.outdir)
+    for grid in args.grid:
+        name, filename = grid.split('=', 1)
+        daemon.load_grid(name, filename)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.close()
+
+
+if __name__=='__main__':
+    main()
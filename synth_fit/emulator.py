@@ -0,0 +1,139 @@
+# Module for emulating a model grid with a few eigenspectra: the grid,
+# resampled onto the data wavelengths, is decomposed by PCA, and a model
+# spectrum is the mean spectrum plus a weighted sum of the eigenspectra,
+# with only the weights interpolated between grid points
+################################################################################
+
+import logging
+
+import numpy as np
+
+## Rows resampled per go when an emulator is made
+resample_chunk = 256
+
+
+class PCAEmulator(object):
+    """
+    Principal component decomposition of a complete model grid on the
+    data wavelengths, for ModelGrid.emulate.
+
+    Only the shape of a model matters to lnprob (ModelGrid scales every
+    model to the data), so every grid spectrum is divided by its rms
+    before the decomposition. Eigenspectra are then added until each
+    grid spectrum is reproduced to within tolerance of its peak (or up
+    to ncomponents of them). The spectrum at any point in the grid is
+    the mean plus the eigenspectra weighted by the multilinear
+    interpolation (ModelGrid.corner_weights) of the corners' weights:
+    one (ncomponents, npix) matrix-vector product, whatever the length
+    of the model spectra and the number of corners. Leaving out the
+    smallest components also smooths over noise in the grid.
+
+    Parameters for __init__
+    -----------------------
+    grid: ModelGrid instance
+        with a complete grid and smooth=False (raises ValueError if not)
+
+    ncomponents: integer (optional)
+        number of eigenspectra to keep (default: as many as tolerance needs)
+
+    tolerance: float (default=1e-3)
+        largest reconstruction error allowed, if ncomponents isn't given
+
+    Creates
+    -------
+    wave (array) : the data wavelengths, in model units
+    params (list), points (array; (nmodels, ndim)) : the grid points
+    mean (array; npix)
+    eigenspectra (array; (ncomponents, npix))
+    weights (array; (nmodels, ncomponents)) : of every grid spectrum
+    error (array; nmodels) : largest error of each grid spectrum's
+        reconstruction, relative to its peak
+    ncomponents (integer) : number of eigenspectra kept
+    requested, tolerance : ncomponents and tolerance as given
+
+    """
+
+    def __init__(self, grid, ncomponents=None, tolerance=1e-3):
+        grid.grid_index()
+        if grid.smooth:
+            raise ValueError("the emulator can't smooth models")
+        self.tolerance = tolerance
+        self.requested = ncomponents
+        self.wave = np.array(grid.wave.value)
+        self.params = list(grid.params)
+        self.points = np.array([grid.plims[p]['vals'] for p in grid.params],
+            np.float64).T
+
+        shapes = resampled_shapes(grid)
+        peak = np.max(np.abs(shapes), axis=1)
+        self.mean = shapes.mean(axis=0)
+        shapes -= self.mean
+        u, sv, vt = np.linalg.svd(shapes, full_matrices=False)
+        weights = u * sv
+
+        ## shapes holds what the components so far leave out
+        limit = len(sv) if ncomponents is None else min(ncomponents, len(sv))
+        error = np.max(np.abs(shapes), axis=1) / peak
+        k = 0
+        while (k < limit) and ((ncomponents is not None) or
+                               (np.max(error) > tolerance)):
+            shapes -= np.outer(weights[:, k], vt[k])
+            error = np.max(np.abs(shapes), axis=1) / peak
+            k += 1
+        self.ncomponents = k
+        self.eigenspectra = np.ascontiguousarray(vt[:k])
+        self.weights = np.ascontiguousarray(weights[:, :k])
+        self.error = error
+
+        worst = np.argmax(error)
+        logging.info('emulating {} models with {} eigenspectra; largest '
+            'error {:.2g} at {}'.format(len(error), k, error[worst],
+            dict(zip(self.params, self.points[worst]))))
+
+    def matches(self, wave):
+        """ whether the emulator was made for these data wavelengths """
+        return ((len(wave)==len(self.wave)) and
+                np.all(np.asarray(wave)==self.wave))
+
+    def spectrum(self, rows, weights, out=None):
+        """
+        The emulated spectrum (in the shape-normalized units of the
+        decomposition) interpolated from grid rows with weights, as
+        returned by ModelGrid.corner_weights for one point
+        """
+        coeffs = np.dot(weights, self.weights[rows])
+        out = np.dot(coeffs, self.eigenspectra, out=out)
+        out += self.mean
+        return out
+
+    def report(self, limit=10):
+        """
+        Table of the grid points with the largest reconstruction errors
+        (all of them if limit is None), as a string
+        """
+        order = np.argsort(self.error)[::-1][:limit]
+        lines = ['{} eigenspectra, tolerance {:.2g}'.format(self.ncomponents,
+                 self.tolerance),
+                 ' '.join(['{:>10}'.format(p) for p in self.params]) +
+                 ' {:>10}'.format('error')]
+        for i in order:
+            lines.append(' '.join(['{:>10.4g}'.format(v) for v in
+                self.points[i]]) + ' {:>10.2g}'.format(self.error[i]))
+        return '\n'.join(lines)
+
+
+def resampled_shapes(grid):
+    """
+    The flux of every model in grid (a ModelGrid) on the data
+    wavelengths, each divided by its rms: an array (nmodels, npix)
+    """
+    lower, upper, t = grid._resample_weights
+    flux = grid.model['flux']
+    shapes = np.zeros((len(flux), len(t)))
+    for start in range(0, len(flux), resample_chunk):
+        rows = slice(start, min(start + resample_chunk, len(flux)))
+        chunk = np.asarray(flux[rows].value, np.float64)
+        shapes[rows] = (chunk[:, lower] +
+                        (chunk[:, upper] - chunk[:, lower]) * t)
+    shapes /= np.sqrt(np.mean(shapes**2, axis=1))[:, np.newaxis]
+    return shapes
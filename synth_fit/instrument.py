@@ -0,0 +1,145 @@
+# Module for timing the stages of a fit and counting what happens in them
+# (lnprob calls, rejected walkers and why, cache hits), to see where the
+# time goes when tuning walker numbers and grid sizes
+################################################################################
+
+import collections
+import json
+import logging
+import os
+from timeit import default_timer
+
+
+class Instrumentation(object):
+    """
+    Per-stage timers and named counters. Off by default; while off,
+    start() returns None and stop() and count() return straight away, so
+    instrumented code pays one method call per stage.
+
+    Call as:
+       from synth_fit.instrument import stats
+       stats.enable()
+       x = bdfit.BDSampler(obj_name, spectrum, model, params)
+       x.mcmc_go()
+       print stats.format_report(x.timing)
+
+    and in instrumented code:
+       started = stats.start()
+       ...
+       stats.stop('resample', started)
+       stats.count('reject.bounds')
+
+    Stages and counters only cover the process they run in: lnprob calls
+    made in pool worker processes are not seen by the parent. Counts from
+    several threads are not locked, so they can be slightly off.
+
+    Setting the environment variable SYNTH_FIT_INSTRUMENT=1 turns the
+    module-level instance (stats) on at import.
+
+    Creates
+    -------
+    enabled (boolean)
+    stages (dictionary) : [calls, total seconds] by stage name
+    counters (dictionary) : counts by name
+
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = collections.defaultdict(int)
+
+    def enable(self, reset=True):
+        if reset:
+            self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def start(self):
+        """ starting time for stop(), or None when switched off """
+        if self.enabled:
+            return default_timer()
+
+    def stop(self, stage, started):
+        """ adds the time since started (from start()) to stage """
+        if started is None:
+            return
+        elapsed = default_timer() - started
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def snapshot(self):
+        """ copy of the current totals, to report on what happens after """
+        return (dict((k, list(v)) for k, v in self.stages.items()),
+                dict(self.counters))
+
+    def report(self, since=None):
+        """
+        Structured report of the stages and counters (from since, a
+        snapshot(), onwards if given)
+
+        Returns
+        -------
+        report: dictionary
+            'stages': {stage: {'calls', 'total', 'mean'}} (seconds), and
+            'counters': {name: count}
+
+        """
+        stages, counters = self.snapshot()
+        if since is not None:
+            for stage, (calls, total) in since[0].items():
+                if stage in stages:
+                    stages[stage][0] -= calls
+                    stages[stage][1] -= total
+            for name, n in since[1].items():
+                if name in counters:
+                    counters[name] -= n
+        report = {'stages':{}, 'counters':{}}
+        for stage, (calls, total) in sorted(stages.items()):
+            if calls > 0:
+                report['stages'][stage] = {'calls':calls, 'total':total,
+                                           'mean':total / calls}
+        for name, n in sorted(counters.items()):
+            if n > 0:
+                report['counters'][name] = n
+        return report
+
+    def format_report(self, report=None):
+        """ the report as a text table, slowest stages first """
+        if report is None:
+            report = self.report()
+        lines = ['{:<20} {:>10} {:>12} {:>12}'.format('stage', 'calls',
+            'total (s)', 'mean (us)')]
+        for stage, entry in sorted(report['stages'].items(),
+                                   key=lambda s: -s[1]['total']):
+            lines.append('{:<20} {:>10d} {:>12.4f} {:>12.2f}'.format(stage,
+                entry['calls'], entry['total'], entry['mean'] * 1e6))
+        for name, n in sorted(report['counters'].items()):
+            lines.append('{:<20} {:>10d}'.format(name, n))
+        return '\n'.join(lines)
+
+    def write(self, filename, report=None):
+        """ writes the report to filename as JSON """
+        if report is None:
+            report = self.report()
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        logging.info('wrote timing report to {}'.format(filename))
+
+
+## The instance the fitting code reports to
+stats = Instrumentation(
+    enabled=os.environ.get('SYNTH_FIT_INSTRUMENT', '0') not in ['', '0'])
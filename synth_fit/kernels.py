@@ -0,0 +1,120 @@
+# Module for the fused likelihood kernel: interpolates a model spectrum
+# from its corner rows, resamples it, scales it to the data and works out
+# lnprob in one pass over the data pixels, compiled with numba when it
+# is installed (see ModelGrid's backend)
+################################################################################
+
+import logging
+
+import numpy as np
+
+## What ModelGrid's backend can be
+backends = ['numpy', 'numba', 'auto']
+
+## The compiled kernel, once made (see fused_kernel)
+_compiled = {}
+
+
+def fused_lnprob(block, rows, weights, lower, upper, t, flux, unc_sq,
+                 normalization, s_sq):
+    """
+    lnprob as ModelGrid.__call__ works it out, in one pass over the data
+    pixels (run as is, it is the reference for the compiled kernel)
+
+    The model spectrum at pixel j is
+       m_j = sum_k weights[k] * ((1 - t_j) * block[rows[k], lower_j]
+                                 + t_j * block[rows[k], upper_j])
+    and rather than keep it, the pass sums everything the scale factor
+    ck and chi-squared need:
+       ck = sum(flux*m/unc_sq) / sum(m*m/unc_sq)
+       chi_sq = sum((flux - ck*m*n)**2/var), var = (unc_sq + s_sq)*n**2
+              = sum(flux**2/var) - 2*ck*sum(flux*m*n/var)
+                + ck**2*sum((m*n)**2/var)
+    Expanding chi-squared cancels digits when the model fits the data to
+    much better than the data's signal to noise: at S/N 1e4 lnprob keeps
+    about 1e-8 of sum(flux**2/var), which is still far finer than the
+    differences between walkers.
+
+    Parameters
+    ----------
+    block: array (nmodels, npix_model)
+        the model flux (ModelGrid._block)
+
+    rows, weights: arrays (ncorners)
+        corner rows and their weights (ModelGrid._corners)
+
+    lower, upper, t: arrays (npix)
+        the np.interp weights of every data pixel (for data on the model
+        wavelengths, lower = upper = the pixel and t = 0)
+
+    flux, unc_sq, normalization: arrays (npix)
+        data flux, its uncertainty squared, and the normalization
+
+    s_sq: float
+        the extra variance, exp(ln(s))**2
+
+    Returns
+    -------
+    lnprob: float (-inf if the scaled model has negative total flux)
+
+    """
+    sum_fm, sum_mm, sum_m = 0.0, 0.0, 0.0
+    sum_ff, sum_fmn, sum_mmn, width = 0.0, 0.0, 0.0, 0.0
+    two_pi = 2 * np.pi
+    for j in range(flux.shape[0]):
+        lo, hi, tj = lower[j], upper[j], t[j]
+        m = 0.0
+        for k in range(rows.shape[0]):
+            below = block[rows[k], lo]
+            m += weights[k] * (below + (block[rows[k], hi] - below) * tj)
+        sum_fm += flux[j] * m / unc_sq[j]
+        sum_mm += m * m / unc_sq[j]
+        sum_m += m
+        mn = m * normalization[j]
+        var = (unc_sq[j] + s_sq) * normalization[j] * normalization[j]
+        sum_ff += flux[j] * flux[j] / var
+        sum_fmn += flux[j] * mn / var
+        sum_mmn += mn * mn / var
+        width += np.log(two_pi * var)
+    ck = sum_fm / sum_mm
+    if ck * sum_m < 0:
+        return -np.inf
+    chi_sq = sum_ff - 2 * ck * sum_fmn + ck * ck * sum_mmn
+    return -0.5 * (chi_sq + width)
+
+
+def fused_kernel():
+    """
+    fused_lnprob compiled with numba (made once per process, on first
+    use; it is compiled again for each dtype of model flux it is given)
+
+    Raises ImportError if numba is not installed.
+    """
+    if 'lnprob' not in _compiled:
+        import numba
+        _compiled['lnprob'] = numba.njit(nogil=True)(fused_lnprob)
+        logging.info('compiled the fused lnprob kernel with numba {}'.format(
+            numba.__version__))
+    return _compiled['lnprob']
+
+
+def select_backend(backend):
+    """
+    Which backend ModelGrid runs: 'numpy', or 'numba' (the fused kernel,
+    compiled); 'auto' is 'numba' if numba can be imported, and 'numpy' if
+    not. Raises ImportError for 'numba' without numba, and ValueError
+    for anything else.
+    """
+    if backend not in backends:
+        raise ValueError("backend must be one of {}, not {!r}".format(
+            ', '.join(backends), backend))
+    if backend=='numpy':
+        return backend
+    try:
+        fused_kernel()
+    except ImportError:
+        if backend=='numba':
+            raise ImportError("backend 'numba' needs numba installed")
+        logging.info('numba not available; using the numpy backend')
+        return 'numpy'
+    return 'numba'
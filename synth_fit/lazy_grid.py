@@ -0,0 +1,326 @@
+# Module for model grids whose spectra are read on demand: the parameter
+# table is kept in memory, and flux rows are fetched from the model
+# atmosphere database the first time they are used, cached, and fetched
+# together with their neighbours on the grid
+################################################################################
+
+import collections
+import io
+import logging
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from astropy import units as u
+
+from instrument import stats as instrument
+
+## Same parameters as mcmc_fit.make_model_db picks out of a grid table
+grid_params = ['teff', 'logg', 'f_sed', 'k_zz']
+
+## Keep the number of ? parameters per query under SQLite's limit of 999
+max_query_ids = 900
+
+
+class LazyFlux(object):
+    """
+    Stands in for the model['flux'] Quantity array of a model grid (as
+    used by ModelGrid and test_all), fetching rows only when they are
+    indexed. Rows are kept in a least-recently-used cache; on a miss,
+    the rows around the missing one on the grid (every cell within
+    `neighbours` steps along each parameter) are fetched in the same go,
+    since interpolation will ask for them next.
+
+    Indexing with an integer returns one row, with a slice, list, index
+    array or mask a 2D array of rows (all as Quantities). The value
+    attribute reads every row, for code that needs the whole grid at
+    once (e.g. ModelGrid.share).
+
+    Parameters for __init__
+    -----------------------
+    fetch: function
+        fetch(rows) returns an array (len(rows), npix) of the flux in
+        those rows; it is pickled with the LazyFlux, for worker processes
+
+    param_arrays: list of arrays
+        the grid parameter values of every row, used to find neighbours
+
+    npix: integer
+        length of every flux row
+
+    unit: astropy unit
+
+    cache_size: integer (default=1024)
+        maximum number of rows to keep
+
+    neighbours: integer (default=1)
+        how far around a missing row to prefetch (0 to fetch just the row)
+
+    dtype: numpy dtype (default=np.float64)
+        what the rows are kept and returned in (np.float32 halves the
+        memory the cache takes)
+
+    Creates
+    -------
+    shape, unit, dtype
+    stats (dictionary) : 'hits', 'misses', 'fetches' (calls of fetch)
+        and 'rows_fetched'
+
+    """
+
+    ndim = 2
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, fetch, param_arrays, npix, unit, cache_size=1024,
+                 neighbours=1, dtype=np.float64):
+        self.fetch = fetch
+        self.dtype = np.dtype(dtype)
+        self.unit = unit
+        self.cache_size = cache_size
+        self.neighbours = neighbours
+        self.shape = (len(param_arrays[0]), npix)
+
+        ## Position of every row on the grid, to look up its neighbours
+        axes = [np.unique(p) for p in param_arrays]
+        self._positions = np.transpose([np.searchsorted(axis, p)
+            for axis, p in zip(axes, param_arrays)])
+        self._row_at = dict((tuple(pos), row) for row, pos in
+                            enumerate(self._positions))
+        offsets = np.array(np.meshgrid(*[range(-neighbours, neighbours + 1)]
+            * len(axes), indexing='ij')).reshape((len(axes), -1)).T
+        self._offsets = offsets[np.any(offsets!=0, axis=1)]
+
+        self._init_cache()
+
+    def _init_cache(self):
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits':0, 'misses':0, 'fetches':0, 'rows_fetched':0}
+
+    def __getstate__(self):
+        ## Worker processes start with an empty cache
+        state = self.__dict__.copy()
+        for key in ['_cache', '_lock', 'stats']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def astype(self, dtype):
+        """ a LazyFlux for the same rows, kept in dtype (with its own cache) """
+        flux = LazyFlux.__new__(LazyFlux)
+        flux.__setstate__(self.__getstate__())
+        flux.dtype = np.dtype(dtype)
+        return flux
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return u.Quantity(self._rows([key % len(self)])[0], self.unit,
+                copy=False)
+        rows = np.atleast_1d(np.arange(len(self))[key])
+        return u.Quantity(self._rows(rows), self.unit, copy=False)
+
+    @property
+    def value(self):
+        """ the whole flux array (read in chunks; not cached) """
+        flux = np.zeros(self.shape, self.dtype)
+        for start in range(0, len(self), max_query_ids):
+            rows = range(start, min(start + max_query_ids, len(self)))
+            flux[start:start + len(rows)] = self.fetch(rows)
+        return flux
+
+    def neighbourhood(self, row):
+        """ rows within self.neighbours grid steps of row (excluding it) """
+        around = self._positions[row] + self._offsets
+        return [self._row_at[tuple(pos)] for pos in around
+                if tuple(pos) in self._row_at]
+
+    def _rows(self, rows):
+        with self._lock:
+            missing = [row for row in rows if row not in self._cache]
+            self.stats['hits'] += len(rows) - len(missing)
+            self.stats['misses'] += len(missing)
+            instrument.count('flux_cache.hits', len(rows) - len(missing))
+            instrument.count('flux_cache.misses', len(missing))
+            fetched = {}
+            if len(missing) > 0:
+                to_fetch = set(missing)
+                for row in missing:
+                    to_fetch.update([n for n in self.neighbourhood(row)
+                                     if n not in self._cache])
+                to_fetch = sorted(to_fetch)
+                for start in range(0, len(to_fetch), max_query_ids):
+                    chunk = to_fetch[start:start + max_query_ids]
+                    fetched.update(zip(chunk, self.fetch(chunk)))
+                    self.stats['fetches'] += 1
+                self.stats['rows_fetched'] += len(to_fetch)
+
+            out = np.zeros((len(rows), self.shape[1]), self.dtype)
+            for i, row in enumerate(rows):
+                if row in fetched:
+                    out[i] = fetched[row]
+                else:
+                    cached = self._cache.pop(row)
+                    self._cache[row] = cached
+                    out[i] = cached
+
+            for row, flux in fetched.items():
+                self._cache[row] = np.array(flux, self.dtype)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return out
+
+
+def _to_array(value):
+    """ array columns come back as arrays if astrodbkit's converters are
+    registered, otherwise as the bytes written by np.save """
+    if isinstance(value, (np.ndarray, list, tuple)):
+        return np.asarray(value, np.float64)
+    return np.asarray(np.load(io.BytesIO(value)), np.float64)
+
+
+class DatabaseRows(object):
+    """
+    Reads flux rows of one grid table in the model atmosphere database
+    (the fetch function of a LazyFlux), rebinned onto a common wavelength
+    array where they differ from it. The connection is opened on first
+    use in each process, and not pickled.
+
+    Parameters for __init__
+    -----------------------
+    db_path: string
+        path of the model atmosphere database, e.g. model_atmospheres.db
+
+    table: string
+        grid table, e.g. 'bt_settl_2013'
+
+    ids: array
+        the id of the table row behind every grid row
+
+    wavelength: array
+        wavelengths (in microns) that all rows are put on
+
+    """
+
+    def __init__(self, db_path, table, ids, wavelength):
+        self.db_path = db_path
+        self.table = table
+        self.ids = np.asarray(ids)
+        self.wavelength = np.asarray(wavelength)
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'], state['_pid'], state['_lock'] = None, None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def execute(self, sql, args=()):
+        with self._lock:
+            if self._pid!=os.getpid():
+                self._connection = sqlite3.connect(self.db_path,
+                    detect_types=sqlite3.PARSE_DECLTYPES,
+                    check_same_thread=False)
+                self._pid = os.getpid()
+            return self._connection.execute(sql, args).fetchall()
+
+    def __call__(self, rows):
+        ids = [int(i) for i in self.ids[rows]]
+        results = self.execute("SELECT id, wavelength, flux FROM {} WHERE id "
+            "IN ({})".format(self.table, ','.join('?' * len(ids))), ids)
+        by_id = dict((r[0], (r[1], r[2])) for r in results)
+        flux = np.zeros((len(ids), len(self.wavelength)))
+        for i, model_id in enumerate(ids):
+            wave, row_flux = [_to_array(v) for v in by_id[model_id]]
+            if ((len(wave)==len(self.wavelength)) and
+                np.allclose(wave, self.wavelength)):
+                flux[i] = row_flux
+            else:
+                from utilities import rebin_spec
+                flux[i] = rebin_spec([wave * u.um, row_flux * u.Unit('')],
+                    self.wavelength * u.um)[1].value
+        return flux
+
+
+def model_from_database(db_path, table, params=None, param_lims=None,
+                        wavelength=None, cache_size=1024, neighbours=1,
+                        dtype=np.float64):
+    """
+    Makes a model dictionary (as used by ModelGrid) for a grid table in
+    the model atmosphere database, reading only the parameter table up
+    front; flux rows are read as they are used (see LazyFlux)
+
+    Call as:
+       model = model_from_database('model_atmospheres.db', 'bt_settl_2013')
+       x = bdfit.BDSampler(obj_name, spectrum, model, ['teff', 'logg'])
+
+    Parameters
+    ----------
+    db_path: string
+        path of the model atmosphere database
+
+    table: string
+        grid table, e.g. 'bt_settl_2013'
+
+    params: list of strings (optional)
+        grid parameters (default: the table's columns among 'teff',
+        'logg', 'f_sed' and 'k_zz')
+
+    param_lims: list of tuples (optional)
+        (parameter, lower limit, upper limit, increment), as for
+        mcmc_fit.make_model_db; the whole table is used by default
+
+    wavelength: array (optional)
+        wavelengths in microns to rebin every spectrum to (default: those
+        of the first row)
+
+    cache_size, neighbours, dtype: see LazyFlux
+
+    Returns
+    -------
+    model: dictionary
+        'wavelength' (Quantity), 'flux' (LazyFlux), 'id' and one array
+        per parameter
+
+    """
+    rows = DatabaseRows(db_path, table, [], [])
+    columns = [c[1] for c in rows.execute("PRAGMA table_info({})".format(
+        table))]
+    if params is None:
+        params = [p for p in grid_params if p in columns]
+
+    where = ''
+    if param_lims:
+        where = ' WHERE ' + ' AND '.join([l[0] + ' IN (' + ','.join(map(str,
+            np.arange(l[1], l[2] + l[3], l[3]))) + ')' for l in param_lims])
+    table_rows = rows.execute("SELECT id, {} FROM {}{} ORDER BY id".format(
+        ', '.join(params), table, where))
+    if len(table_rows)==0:
+        raise ValueError("no models in {} match {}".format(table, param_lims))
+    ids = np.array([r[0] for r in table_rows])
+
+    if wavelength is None:
+        wavelength = _to_array(rows.execute("SELECT wavelength FROM {} WHERE "
+            "id=?".format(table), (int(ids[0]),))[0][0])
+    rows.ids, rows.wavelength = ids, np.asarray(wavelength)
+
+    model = {'id':ids, 'wavelength':rows.wavelength * u.um}
+    for i, p in enumerate(params):
+        model[p] = np.array([r[i + 1] for r in table_rows], np.float64)
+    model['flux'] = LazyFlux(rows, [model[p] for p in params],
+        len(rows.wavelength), u.erg / u.AA / u.cm**2 / u.s,
+        cache_size=cache_size, neighbours=neighbours, dtype=dtype)
+    logging.info('lazy grid {}: {} models, {} pixels'.format(table,
+        len(ids), len(rows.wavelength)))
+    return model
@@ -0,0 +1,270 @@
+# Module for fitting several objects against the same model grid in
+# lockstep: the walkers of all the objects are evaluated together, with
+# one interpolation of the grid for all of them
+################################################################################
+
+import logging
+import sys
+import threading
+
+import numpy as np
+
+
+class BatchLikelihood(object):
+    """
+    lnprob (as calculated by ModelGrid.__call__) for the walkers of many
+    objects that are fit against the same model grid, with spectra on
+    the same wavelength array.
+
+    The grid is resampled onto the data wavelengths once (interpolating
+    in wavelength and in the grid parameters are both linear, so the
+    order doesn't matter). A batch of walkers, from any of the objects,
+    is then interpolated in one go - one gather of corner spectra and a
+    weighted sum for all of them - and only the data terms (scaling,
+    normalization and chi-squared) are per object.
+
+    Grids that can't be interpolated this way (incomplete grids, snap or
+    smooth) fall back to calling each object's ModelGrid per walker.
+
+    Parameters for __init__
+    -----------------------
+    grids: list of ModelGrid instances
+        one per object, all made from the same model dictionary (e.g.
+        with ModelGrid.for_spectrum, or BDSampler.model)
+
+    Creates
+    -------
+    grids (list)
+    vectorized (boolean) : False if falling back to ModelGrid.__call__
+    resampled (array; (nmodels, npix)) : grid flux on the data wavelengths
+    flux, unc_sq (arrays; (nobjects, npix)) : data, in model units
+    norm_bin (integer array; npix) : which normalization applies to each pixel
+
+    """
+
+    def __init__(self, grids):
+        self.grids = grids
+        base = grids[0]
+        for grid in grids[1:]:
+            if (np.may_share_memory(grid.model['flux'], base.model['flux'])
+                ==False):
+                raise ValueError("all objects must be fit against the "
+                    "same model grid")
+            if ((len(grid.wave)!=len(base.wave)) or
+                (np.allclose(grid.wave.value, base.wave.value)==False)):
+                raise ValueError("all spectra must have the same wavelengths")
+
+        self.vectorized = (base.snap==False) and (base.smooth==False)
+        if self.vectorized:
+            try:
+                base.grid_index()
+            except ValueError as err:
+                logging.info('no batched interpolation: {}'.format(err))
+                self.vectorized = False
+        if self.vectorized==False:
+            logging.info('BatchLikelihood: evaluating walkers one by one')
+            return
+
+        model_wave = np.asarray(base.model['wavelength'].value)
+        ## kept in the grid's dtype; the sums below are float64
+        model_flux = np.asarray(base.model['flux'].value)
+        if base.interp:
+            ## np.interp weights for every data pixel, applied to all models
+            wave = base.wave.value
+            k = np.clip(np.searchsorted(model_wave, wave, 'right') - 1, 0,
+                len(model_wave) - 2)
+            t = np.clip((wave - model_wave[k]) /
+                (model_wave[k + 1] - model_wave[k]), 0.0, 1.0)
+            self.resampled = (model_flux[:, k] * (1 - t) +
+                model_flux[:, k + 1] * t).astype(model_flux.dtype)
+        else:
+            self.resampled = model_flux
+
+        self.flux = np.array([grid.flux.value for grid in grids])
+        self.unc_sq = np.array([grid.unc.value for grid in grids])**2
+        self.inv_var = 1.0 / self.unc_sq
+
+        ## Same bins as ModelGrid.calc_normalization (including where the
+        ## pixels outside the bins end up)
+        nnorm = max(len(base.wavelength_bins) - 1, 1)
+        self.norm_bin = np.zeros(len(base.wave), int)
+        if len(base.wavelength_bins) > 0:
+            bins = base.wavelength_bins.to(base.wave.unit).value
+            wave = base.wave.value
+            self.norm_bin[:] = nnorm - 1
+            for i in range(nnorm):
+                self.norm_bin[(wave > bins[i]) & (wave <= bins[i + 1])] = i
+
+        self.pmin = np.array([base.plims[p]['min'] for p in base.params])
+        self.pmax = np.array([base.plims[p]['max'] for p in base.params])
+
+    def __call__(self, positions, objects):
+        """
+        Parameters
+        ----------
+        positions: array (nwalkers, ndim)
+            walker positions (as passed to ModelGrid.__call__)
+
+        objects: integer array (nwalkers)
+            which object (index in grids) each walker belongs to
+
+        Returns
+        -------
+        lnprob: array (nwalkers)
+
+        """
+        positions = np.atleast_2d(positions)
+        objects = np.asarray(objects, int)
+        if self.vectorized==False:
+            return np.array([self.grids[o](p) for p, o in
+                             zip(positions, objects)])
+
+        ndim = len(self.pmin)
+        lnprob = np.ones(len(positions)) * -np.inf
+        model_p = positions[:, :ndim]
+        good = ((positions[:, -1] <= 1.0) &
+                np.all((model_p >= self.pmin) & (model_p <= self.pmax), axis=1))
+        if np.any(good)==False:
+            return lnprob
+
+        ## One gather and weighted sum of the corner spectra for all walkers
+        rows, weights = self.grids[0].corner_weights(model_p[good])
+        mod_flux = np.zeros((len(rows), self.resampled.shape[1]))
+        for k in range(rows.shape[1]):
+            mod_flux += weights[:, k, np.newaxis] * self.resampled[rows[:, k]]
+
+        ## Then the data terms, each walker against its own object
+        obj = objects[good]
+        flux, inv_var = self.flux[obj], self.inv_var[obj]
+        ck = (np.sum(flux * mod_flux * inv_var, axis=1) /
+              np.sum(mod_flux * mod_flux * inv_var, axis=1))
+        mod_flux *= ck[:, np.newaxis]
+
+        normalization = positions[good][:, ndim:-1][:, self.norm_bin]
+        s_sq = np.exp(positions[good][:, -1])**2
+        unc_sq = ((self.unc_sq[obj] + s_sq[:, np.newaxis]) * normalization**2)
+        flux_pts = (flux - mod_flux * normalization)**2 / unc_sq
+        width_term = np.log(2 * np.pi * unc_sq)
+        values = -0.5 * np.sum(flux_pts + width_term, axis=1)
+
+        ## a model with negative total flux is rejected, as in ModelGrid
+        values[np.sum(mod_flux, axis=1) < 0] = -np.inf
+        lnprob[good] = values
+        return lnprob
+
+
+class _LockstepPool(object):
+    """
+    Stands in for a process pool for one object's emcee sampler: map
+    hands the walkers over to the LockstepRunner and waits until they
+    have been evaluated together with the other objects' walkers
+    """
+
+    def __init__(self, runner, index):
+        self.runner = runner
+        self.index = index
+
+    def map(self, function, positions):
+        return self.runner._evaluate(self.index, positions)
+
+
+class LockstepRunner(object):
+    """
+    Runs BDSampler.mcmc_go for several objects at once, each in its own
+    thread, with every lnprob evaluation going through one
+    BatchLikelihood: each time the samplers ask for the lnprob of their
+    walkers, the requests of all the objects still running are gathered
+    and evaluated as a single batch.
+
+    Call as:
+       from synth_fit.lockstep import LockstepRunner
+       grid = ModelGrid(spectra[0], model, params)
+       samplers = [BDSampler(name, spec, grid, params) for ...]
+       LockstepRunner(samplers).run(nwalk_mult=20, nstep_mult=50)
+
+    Parameters for __init__
+    -----------------------
+    samplers: list of BDSampler instances
+        fit against the same grid, with spectra on the same wavelengths
+
+    Creates
+    -------
+    likelihood (BatchLikelihood instance)
+    n_batches (integer) : number of batched evaluations
+    n_evals (integer) : number of walker evaluations
+
+    """
+
+    def __init__(self, samplers):
+        self.samplers = samplers
+        self.likelihood = BatchLikelihood([s.model for s in samplers])
+        self.n_batches = 0
+        self.n_evals = 0
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._results = {}
+        self._active = 0
+
+    def run(self, **mcmc_kwargs):
+        """
+        Calls mcmc_go(**mcmc_kwargs) for all the samplers, in lockstep,
+        and returns once they have all finished. If any of them fails,
+        the others still run to the end and then the first error is raised.
+        """
+        errors = []
+
+        def go(index, sampler):
+            try:
+                sampler.mcmc_go(pool=_LockstepPool(self, index),
+                    **mcmc_kwargs)
+            except Exception:
+                logging.exception('lockstep fit of %s failed', sampler.name)
+                errors.append(sys.exc_info())
+            finally:
+                with self._condition:
+                    self._active -= 1
+                    self._evaluate_pending()
+
+        self._active = len(self.samplers)
+        threads = [threading.Thread(target=go, args=(i, sampler))
+                   for i, sampler in enumerate(self.samplers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logging.info('{} walker evaluations in {} batches'.format(
+            self.n_evals, self.n_batches))
+        if len(errors) > 0:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _evaluate(self, index, positions):
+        with self._condition:
+            self._pending[index] = np.asarray(positions)
+            self._evaluate_pending()
+            while (index in self._results)==False:
+                self._condition.wait()
+            result = self._results.pop(index)
+        if isinstance(result, Exception):
+            raise result
+        return list(result)
+
+    def _evaluate_pending(self):
+        """ evaluates the pending walkers once every running sampler has
+        asked; must be called holding self._condition """
+        if (len(self._pending)==0) or (len(self._pending) < self._active):
+            return
+        indices = sorted(self._pending.keys())
+        positions = [self._pending[i] for i in indices]
+        objects = np.repeat(indices, [len(p) for p in positions])
+        try:
+            lnprob = self.likelihood(np.concatenate(positions), objects)
+            splits = np.cumsum([len(p) for p in positions])[:-1]
+            for i, values in zip(indices, np.split(lnprob, splits)):
+                self._results[i] = values
+        except Exception as err:
+            for i in indices:
+                self._results[i] = err
+        self.n_batches += 1
+        self.n_evals += len(objects)
+        self._pending = {}
+        self._condition.notify_all()
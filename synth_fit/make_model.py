@@ -3,15 +3,26 @@
 # 2 December 2013, Stephanie Douglas
 ################################################################################
 
+import itertools
 import logging
+import threading
 
 import numpy as np
 from astropy import units as u
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
 
-from smooth import *
+from smooth import falt2
+from shared_grid import SharedGrid
+from lazy_grid import LazyFlux
+from quantized_grid import QuantizedFlux
+from kernels import select_backend, fused_kernel
+from emulator import PCAEmulator
+from spline_grid import SplineGrid
+from instrument import stats
+from tracing import get_tracer
+
+## Sampled tracing of the likelihood calls (see synth_fit.tracing)
+_trace = get_tracer('model_grid')
+_trace_retrieve = get_tracer('retrieve_model')
 
 class ModelGrid(object):
     """
@@ -30,6 +41,10 @@ class ModelGrid(object):
     model_dict: dictionary
         keys 'wavelength' and 'flux' should correspond to model wavelength and 
         flux arrays, and those should be astropy.units Quantities
+        (the flux may also be a synth_fit.lazy_grid.LazyFlux, which reads
+        spectra from the model database as they are needed, or a
+        synth_fit.quantized_grid.QuantizedFlux, which keeps them as 16-bit
+        integers and decodes them as they are needed)
         other keys should correspond to params
 
     params: array of strings
@@ -52,6 +67,27 @@ class ModelGrid(object):
         emcee output also stay on the grid, this needs to be set to 
         True in bdfit as well)
 
+    flux_dtype: numpy dtype (optional)
+        dtype to keep the model flux in, e.g. np.float32 to halve the
+        memory the grid takes and the memory traffic of interpolation
+        (see check_flux_dtype for the accuracy); the data, and the sums
+        in the normalization and lnprob, stay float64. By default the
+        flux is kept as given.
+
+    backend: string (default='numpy')
+        how __call__ works out lnprob: 'numpy', or 'numba' for the fused
+        kernel of synth_fit.kernels (interpolation, scaling and lnprob in
+        one pass over the pixels, compiled; used where the grid is in 
+        memory and there is no snapping or smoothing, with numpy for the
+        rest). 'auto' picks 'numba' if numba is installed.
+
+    interpolation: string (default='linear')
+        'linear' interpolates the grid multilinearly; 'cubic' with 
+        splines in every parameter (see synth_fit.spline_grid), which 
+        needs a complete grid and keeps a coefficient array as big as 
+        the flux, but is as fast and reaches the same accuracy on much 
+        coarser grids. Both are in teff**4 rather than teff.
+
     Creates
     -------
     wave (array; astropy.units quantity)
@@ -64,11 +100,23 @@ class ModelGrid(object):
     plims (dictionary) : limits of each parameter 
     smooth (boolean) 
     interp (boolean)
+    backend (string) : 'numpy' or 'numba'
+    interpolation (string) : 'linear' or 'cubic'
+    shared (SharedGrid instance or None) : set by share()
+    emulator (PCAEmulator instance or None) : set by emulate()
+    _block (array (nmodels, npix) or None) : the model flux, as a plain
+        C-contiguous array (a view of it; None for a LazyFlux or 
+        QuantizedFlux, which decode the rows they are asked for)
 
     """
 
+    ## Data-length arrays each thread evaluating lnprob works in (see _work)
+    work_keys = ['normalization', 'unc_sq', 'flux_pts', 'model', 'scratch',
+                 'lower', 'upper']
+
     def __init__(self,spectrum,model_dict,params,smooth=False,resolution=None,
-        snap=False,wavelength_bins=[0.9,1.4,1.9,2.5]*u.um):
+        snap=False,wavelength_bins=[0.9,1.4,1.9,2.5]*u.um,flux_dtype=None,
+        backend='numpy',interpolation='linear'):
         """
         NOTE: at this point I have not accounted for model parameters
         that are NOT being used for the fit - this means there will be 
@@ -107,8 +155,27 @@ class ModelGrid(object):
             emcee output also stay on the grid, this needs to be set to 
             True in bdfit as well)
 
+        flux_dtype: numpy dtype (optional)
+            dtype to keep the model flux in (e.g. np.float32)
+
+        backend: string (default='numpy')
+            'numpy', 'numba' or 'auto' (raises ImportError for 'numba' 
+            if numba isn't installed)
+
+        interpolation: string (default='linear')
+            'linear' or 'cubic' (raises ValueError for 'cubic' if the 
+            grid is incomplete)
+
         """
 
+        if flux_dtype is not None:
+            model_dict = with_flux_dtype(model_dict, flux_dtype)
+        if ((type(model_dict['flux'])==u.quantity.Quantity) and
+            (model_dict['flux'].flags.c_contiguous==False)):
+            ## Interpolation gathers rows of one C-contiguous block
+            model_dict = dict(model_dict)
+            model_dict['flux'] = u.Quantity(np.ascontiguousarray(
+                model_dict['flux'].value), model_dict['flux'].unit, copy=False)
         self.model = model_dict
         self.mod_keys = model_dict.keys()
         self.wavelength_bins = wavelength_bins
@@ -119,7 +186,8 @@ class ModelGrid(object):
         if ('flux' in self.mod_keys)==False:
             logging.info("ERROR! model flux must be keyed with 'flux'!")
         if ((type(self.model['wavelength'])!=u.quantity.Quantity) |
-            (type(self.model['flux'])!=u.quantity.Quantity) |
+            ((type(self.model['flux'])!=u.quantity.Quantity) &
+             (isinstance(self.model['flux'], (LazyFlux, QuantizedFlux))==False)) |
             (type(spectrum['wavelength'])!=u.quantity.Quantity) |
             (type(spectrum['flux'])!=u.quantity.Quantity) |
             (type(spectrum['unc'])!=u.quantity.Quantity)):
@@ -146,6 +214,43 @@ class ModelGrid(object):
         ## smooth==True -> the model has already been matched to the data resolution
         self.smooth = smooth
 
+        self._set_spectrum(spectrum)
+
+        self.is_grid_complete = self.check_grid_coverage()
+        if self.is_grid_complete==False:
+            self.snap = True
+            logging.info("Grid is incomplete; no interpolation on the model grid")
+        else:
+            logging.info("Grid is complete")
+            self.snap = snap
+        self.snap = snap
+
+        self.model_flux_units = self.model['flux'].unit
+
+        ## Set by share(); while None, the grid arrays are pickled in full
+        self.shared = None
+        self._set_block()
+
+        self.backend = select_backend(backend)
+
+        if interpolation not in ['linear', 'cubic']:
+            raise ValueError("interpolation must be 'linear' or 'cubic', not"
+                " {!r}".format(interpolation))
+        self.interpolation = interpolation
+        self._spline = None
+        if interpolation=='cubic':
+            ## the spline coefficients of the whole grid, worked out once
+            axes, index = self.grid_index()
+            flux = self._block
+            if flux is None:
+                flux = np.asarray(self.model['flux'].value)
+            self._spline = SplineGrid(flux, axes, index, self.params)
+
+        ## Set by emulate(); while None, models are interpolated
+        self.emulator = None
+
+    def _set_spectrum(self, spectrum):
+        """ sets up everything that depends on the data spectrum """
         ## convert data units to model units (here vs. at every interpolation)
         logging.debug("data units w {} f {} u {}".format(
             spectrum['wavelength'].unit, spectrum['flux'].unit,
@@ -172,16 +277,213 @@ class ModelGrid(object):
             self.interp = True
             logging.info('INTERPOLATION NEEDED')
 
-        self.is_grid_complete = self.check_grid_coverage()
-        if self.is_grid_complete==False:
-            self.snap = True
-            logging.info("Grid is incomplete; no interpolation on the model grid")
+        ## Plain arrays for the likelihood, and the np.interp weights of 
+        ## every data pixel (so resampling a model is two gathers)
+        self._flux_values = self.flux.value
+        self._unc_sq = self.unc.value**2
+        if self.interp:
+            model_wave = np.asarray(self.model['wavelength'].value)
+            wave = self.wave.value
+            lower = np.clip(np.searchsorted(model_wave, wave, 'right') - 1, 0,
+                len(model_wave) - 2)
+            self._resample_weights = (lower, lower + 1, np.clip(
+                (wave - model_wave[lower]) /
+                (model_wave[lower + 1] - model_wave[lower]), 0.0, 1.0))
         else:
-            logging.info("Grid is complete")
-            self.snap = snap
-        self.snap = snap
+            ## (for the fused kernel: every pixel its own)
+            pixels = np.arange(len(self.wave))
+            self._resample_weights = (pixels, pixels, np.zeros(len(pixels)))
+        self._norm_bins = {}
+        self._buffers = threading.local()
 
-        self.model_flux_units = self.model['flux'][0].unit
+    def _work(self):
+        """
+        This thread's work buffers: a dictionary of data-length float64 
+        arrays (keyed by work_keys) that __call__ and the functions it 
+        calls fill in place, so evaluating lnprob allocates no arrays 
+        the length of the spectrum. Made once per thread (emcee's 
+        threads each get their own), and again for another spectrum.
+        """
+        work = getattr(self._buffers, 'arrays', None)
+        if work is None:
+            work = dict([(key, np.zeros(len(self.wave))) for key in 
+                         self.work_keys])
+            self._buffers.arrays = work
+        return work
+
+    def _buffer(self, key, shape, dtype=np.float64):
+        """ 
+        A work buffer (see _work) of another shape or dtype, e.g. on the
+        model wavelengths; made the first time it is asked for
+        """
+        work = self._work()
+        buf = work.get(key)
+        if (buf is None) or (buf.shape!=shape) or (buf.dtype!=dtype):
+            buf = np.zeros(shape, dtype)
+            work[key] = buf
+        return buf
+
+    def _set_block(self):
+        """ points _block at the model flux (see Creates) """
+        if isinstance(self.model.get('flux'), (LazyFlux, QuantizedFlux)):
+            self._block = None
+        else:
+            self._block = np.asarray(self.model['flux'].value)
+
+    def for_spectrum(self, spectrum):
+        """
+        Returns a ModelGrid for a different data spectrum that reuses 
+        everything this one has worked out about the grid (parameter 
+        limits, grid coverage, shared arrays), so fitting many objects 
+        against one grid only sets the grid up once
+
+        Parameters
+        ----------
+        spectrum: dictionary of astropy.units Quantities
+            keys of 'wavelength', 'flux', and 'unc' give the relevant arrays
+
+        """
+        grid = ModelGrid.__new__(ModelGrid)
+        grid.__dict__.update(self.__dict__)
+        grid._set_spectrum(spectrum)
+        if (grid.emulator is not None) and (grid.emulator.matches(
+            grid.wave.value)==False):
+            grid.emulate(self.emulator.requested, self.emulator.tolerance)
+        return grid
+
+    def emulate(self, ncomponents=None, tolerance=1e-3):
+        """
+        Switches interpolation (interp_models, and so __call__) over to 
+        a PCA emulator of the grid on the data wavelengths (see 
+        synth_fit.emulator): only a few eigenspectrum weights are 
+        interpolated, and a model is one small matrix-vector product. 
+        Set emulator to None to interpolate the grid again.
+
+        Parameters
+        ----------
+        ncomponents: integer (optional)
+            number of eigenspectra to keep
+
+        tolerance: float (default=1e-3)
+            without ncomponents, eigenspectra are kept until every grid
+            spectrum is reproduced to within this fraction of its peak
+
+        Returns
+        -------
+        emulator: PCAEmulator instance
+            its error attribute (and report()) gives the reconstruction
+            error at every grid point
+
+        Raises ValueError for incomplete grids and with smooth=True.
+
+        """
+        self.emulator = PCAEmulator(self, ncomponents, tolerance)
+        return self.emulator
+
+    def share(self, name=None, directory=None):
+        """
+        Moves the model wavelength, flux and parameter arrays into 
+        shared memory (see synth_fit.shared_grid). Afterwards, pickling
+        this ModelGrid - which is what happens when emcee hands it to a
+        process pool - only sends the name of the shared grid, and each
+        worker attaches to the same copy of the grid without reading it.
+        (A QuantizedFlux shares its encoded rows; every process decodes
+        into a cache of its own. A LazyFlux is left as it is, and every
+        process reads rows from the database into its own cache.)
+
+        Parameters
+        ----------
+        name: string (optional)
+            identifier for the shared grid (random if not given)
+
+        directory: string (optional)
+            where to put the shared files; defaults to /dev/shm if 
+            available, otherwise the temporary directory
+
+        Returns
+        -------
+        shared: SharedGrid instance
+            owned by this process: the files are removed by 
+            shared.unlink(), when leaving a "with shared:" block, or at 
+            the latest when this process exits
+
+        Raises ValueError if the flux arrays are not all the same length.
+
+        """
+        if self.shared is not None:
+            return self.shared
+
+        arrays = {'wavelength':self.model['wavelength'].value}
+        units = {'wavelength':self.model['wavelength'].unit}
+        if isinstance(self.model['flux'], QuantizedFlux):
+            ## Share the encoded rows; each process decodes its own
+            arrays.update(self.model['flux'].arrays())
+        elif isinstance(self.model['flux'], LazyFlux):
+            ## A LazyFlux stays unshared (reading it into shared memory 
+            ## would read the whole table); it pickles small, and every 
+            ## process reads and caches its own rows
+            pass
+        else:
+            arrays['flux'] = self.model['flux'].value
+            units['flux'] = self.model['flux'].unit
+        for p in self.params:
+            arrays[p] = np.asarray(self.model[p],np.float64)
+        if self._spline is not None:
+            arrays['spline_coeffs'] = self._spline.coeffs
+
+        self.shared = SharedGrid.create(arrays, units=units, name=name,
+            directory=directory)
+        self._attach_shared()
+        logging.info('shared grid {} ({} bytes)'.format(self.shared.name,
+            self.shared.nbytes()))
+        return self.shared
+
+    def _attach_shared(self):
+        """ points the model dictionary and plims at the shared arrays """
+        model = dict(self.model)
+        shared = self.shared.model_dict()
+        if isinstance(model.get('flux'), QuantizedFlux):
+            model['flux'] = model['flux'].with_arrays(shared)
+            for key in QuantizedFlux.array_keys:
+                del shared[key]
+        if 'spline_coeffs' in shared:
+            self._spline = self._spline.with_coeffs(np.asarray(
+                shared.pop('spline_coeffs')))
+        model.update(shared)
+        self.model = model
+        self._set_block()
+        for p in self.params:
+            self.plims[p]['vals'] = self.model[p]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        ## Work buffers are per process (and thread), and _block is a
+        ## view of model['flux'] (set again by __setstate__)
+        del state['_buffers']
+        del state['_block']
+        if self.shared is not None:
+            ## Leave out the shared arrays; __setstate__ re-attaches to them
+            state['model'] = dict([(k, v) for k, v in self.model.items() 
+                if k not in self.shared.arrays])
+            if isinstance(self.model['flux'], QuantizedFlux):
+                state['model']['flux'] = self.model['flux'].without_arrays()
+            if self._spline is not None:
+                state['_spline'] = self._spline.without_coeffs()
+            state['plims'] = {}
+            for p in self.params:
+                state['plims'][p] = {'min':self.plims[p]['min'],
+                                     'max':self.plims[p]['max']}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buffers = threading.local()
+        self._norm_bins = {}
+        if state.get('shared') is None:
+            self.shared = None
+            self._set_block()
+        else:
+            self._attach_shared()
 
 
     def __call__(self,*args):
@@ -204,7 +506,9 @@ class ModelGrid(object):
         lnprob: log of posterior probability for this model + data
 
         """
-        logging.debug(str(args))
+        call_started = stats.start()
+        started = call_started
+        tracing = _trace.on and _trace.sample()
 
         # The first arguments correspond to the parameters of the model
         # the next two, if present, correspond to vsini and rv 
@@ -215,39 +519,63 @@ class ModelGrid(object):
         model_p = p[:self.ndim]
         lns = p[-1]
         norm_values = p[self.ndim:-1]
-        logging.debug('params {} normalization {} ln(s) {}'.format(
-            model_p,norm_values,lns))
 
 #        if (normalization<0.) or (normalization>2.0):
 #            return -np.inf
 
+        work = self._work()
         normalization = self.calc_normalization(norm_values,#[])
-            self.wavelength_bins)
+            self.wavelength_bins, out=work['normalization'])
 
         if (lns>1.0):
+            if tracing:
+                _trace.record('p {} rejected: ln(s) {} > 1', p, lns)
+            stats.count('reject.ln_s')
+            stats.stop('bounds', started)
+            stats.stop('__call__', call_started)
             return -np.inf
 
         ## Check if any of the parameters are outside the limits of the model
         for i in range(self.ndim):
             if ((model_p[i]>self.plims[self.params[i]]['max']) or 
                 (model_p[i]<self.plims[self.params[i]]['min'])):
-                logging.debug("bad param %s: %f, min: %f, max: %f", 
-                    self.params[i],model_p[i],self.plims[self.params[i]]['min'],
-                    self.plims[self.params[i]]['max'])
+                if tracing:
+                    _trace.record('p {} rejected: {} {} outside {} to {}', p,
+                        self.params[i], model_p[i],
+                        self.plims[self.params[i]]['min'],
+                        self.plims[self.params[i]]['max'])
+                stats.count('reject.bounds')
+                stats.stop('bounds', started)
+                stats.stop('__call__', call_started)
                 return -np.inf
+        stats.stop('bounds', started)
 
+        if ((self.backend=='numba') and 
+            ((self._block is not None) or (self._spline is not None)) and 
+            (self.snap==False) and (self.smooth==False) and 
+            (self.emulator is None)):
+            return self._fused_call(p, model_p, normalization, lns, tracing,
+                call_started)
+
+        ## (plain arrays here, work['model'] when a model is found)
         if self.snap:
             # new function that will just get the model from the grid
             # placeholder for now
-            mod_flux = self.retrieve_model(model_p)
+            mod_flux = self._retrieve_flux(model_p)
         else:
-            mod_flux = self.interp_models(model_p)
+            mod_flux = self._interp_flux(model_p)
 
         # if the model isn't found, interp_models returns an array of -99s
 #        logging.debug(str(type(mod_flux)))
 #        logging.debug(str(mod_flux.dtype))
 #        logging.debug(mod_flux)
-        if sum(mod_flux.value)<0: 
+        started = stats.start()
+        if np.sum(mod_flux,dtype=np.float64)<0: 
+            if tracing:
+                _trace.record('p {} rejected: negative model flux', p)
+            stats.count('reject.negative_flux')
+            stats.stop('likelihood', started)
+            stats.stop('__call__', call_started)
             return -np.inf
 
 #        mod_flux = mod_flux*normalization
@@ -257,25 +585,202 @@ class ModelGrid(object):
         # included in the definition of the gaussian used for chi^squared
         # And on the advice of Mike Cushing (who got it from David Hogg)
         # I'm changing it again, so that the normalization is accounted for
-        s = np.float64(np.exp(lns))*self.unc.unit
-        logging.debug("type unc {} s {} n {}".format(self.unc.value.dtype,
-            type(s.value),type(normalization)))
-        unc_sq = (self.unc**2 + s**2)  * normalization**2 
+        #    unc_sq = (unc**2 + s**2) * normalization**2
+        #    flux_pts = (flux - mod_flux*normalization)**2/unc_sq
+        #    width_term = log(2*pi*unc_sq)
+        # (all worked out in place in this thread's work buffers)
+        s_sq = np.float64(np.exp(lns))**2
+        unc_sq, flux_pts = work['unc_sq'], work['flux_pts']
+        np.add(self._unc_sq, s_sq, out=unc_sq)
+        np.multiply(normalization, normalization, out=flux_pts)
+        unc_sq *= flux_pts
 #        unc_sq = (self.unc**2) * normalization**2
 #        logging.debug("unc_sq {}".format(unc_sq))
-        logging.debug("units f {} mf {}".format(self.flux.unit,
-            mod_flux.unit))
-        flux_pts = (self.flux-mod_flux*normalization)**2/unc_sq
-        width_term = np.log(2*np.pi*unc_sq.value)
+        np.multiply(mod_flux, normalization, out=flux_pts)
+        np.subtract(self._flux_values, flux_pts, out=flux_pts)
+        flux_pts *= flux_pts
+        flux_pts /= unc_sq
+        width_term = unc_sq
+        width_term *= 2*np.pi
+        np.log(width_term, out=width_term)
 #        logging.debug("flux+pts {}".format(flux_pts))
 #        logging.debug("width_term {} flux pts {} units fp {}".format(
 #            np.sum(width_term),np.sum(flux_pts),flux_pts.unit))
         #logging.debug("units wt {}".format(width_term.unit))
-        lnprob = -0.5*(np.sum(flux_pts + width_term))
-        logging.debug('p {} lnprob {}'.format(str(args),str(lnprob)))
+        flux_pts += width_term
+        lnprob = -0.5*(np.sum(flux_pts))
+        if tracing:
+            _trace.record('p {} lnprob {}', p, lnprob)
+        stats.stop('likelihood', started)
+        stats.stop('__call__', call_started)
         return lnprob
         
 
+    def _fused_call(self, p, model_p, normalization, lns, tracing, 
+        call_started):
+        """ the rest of __call__ with the fused kernel (backend 'numba') """
+        started = stats.start()
+        corners = self._corners(model_p)
+        stats.stop('corner_search', started)
+        if corners is None:
+            stats.count('missing_model')
+            lnprob = -np.inf
+        else:
+            started = stats.start()
+            block, rows, weights = corners
+            lower, upper, t = self._resample_weights
+            lnprob = fused_kernel()(block, rows, weights, lower, upper,
+                t, self._flux_values, self._unc_sq, normalization,
+                np.float64(np.exp(lns))**2)
+            stats.stop('fused', started)
+        if lnprob==-np.inf:
+            if tracing:
+                _trace.record('p {} rejected: negative model flux', p)
+            stats.count('reject.negative_flux')
+        elif tracing:
+            _trace.record('p {} lnprob {}', p, lnprob)
+        stats.stop('__call__', call_started)
+        return lnprob
+
+    def grid_index(self):
+        """
+        Indexes a complete, regular grid: the sorted values of every 
+        parameter, and the row of model['flux'] at each combination of them
+
+        Returns
+        -------
+        axes: list of arrays
+            unique values of each parameter in params
+
+        index: integer array, shape (len(axes[0]), len(axes[1]), ...)
+            row in the flux array of each grid point
+
+        Raises ValueError if a grid point is missing or duplicated.
+
+        """
+        if isinstance(getattr(self, '_grid_index', None), ValueError):
+            raise self._grid_index
+        if getattr(self, '_grid_index', None) is None:
+            vals = [np.asarray(self.plims[p]['vals']) for p in self.params]
+            axes = [np.unique(v) for v in vals]
+            locs = tuple([np.searchsorted(axis, v) for axis, v in
+                          zip(axes, vals)])
+            shape = tuple([len(axis) for axis in axes])
+            counts = np.bincount(np.ravel_multi_index(locs, shape),
+                minlength=int(np.prod(shape)))
+            if np.any(counts!=1):
+                ## (remembered, so asking again is cheap)
+                self._grid_index = ValueError("model grid has {} missing and"
+                    " {} duplicated points".format(np.sum(counts==0),
+                    np.sum(counts>1)))
+                raise self._grid_index
+            index = np.zeros(shape, int)
+            index[locs] = np.arange(len(vals[0]))
+            self._grid_index = (axes, index)
+        return self._grid_index
+
+    def corner_weights(self, points):
+        """
+        Multilinear interpolation weights for many points at once (with 
+        the same teff**4 coefficient as interp_models)
+
+        Parameters
+        ----------
+        points: array (npoints, ndim)
+            model parameters, inside the grid
+
+        Returns
+        -------
+        rows: integer array (npoints, 2**ndim)
+            rows of model['flux'] at the corners around each point
+
+        weights: array (npoints, 2**ndim)
+            so the interpolated flux of point j is 
+            sum_k weights[j,k]*model['flux'][rows[j,k]]
+
+        """
+        axes, index = self.grid_index()
+        points = np.atleast_2d(points)
+        lower = np.zeros(points.shape, int)
+        coeff = np.zeros(points.shape)
+        for i, axis in enumerate(axes):
+            if len(axis)==1:
+                continue
+            x = points[:, i]
+            j = np.clip(np.searchsorted(axis, x, 'right') - 1, 0,
+                len(axis) - 2)
+            lo, hi = axis[j], axis[j + 1]
+            lower[:, i] = j
+            if self.params[i]=='teff':
+                coeff[:, i] = (x**4 - lo**4)*1.0/(hi**4 - lo**4)
+            else:
+                coeff[:, i] = (x - lo)*1.0/(hi - lo)
+
+        ## bits[k,i] is 1 where corner k takes the upper value of parameter i
+        ncorner = 2**self.ndim
+        bits = (np.arange(ncorner)[:, np.newaxis] >> 
+                np.arange(self.ndim)[::-1]) & 1
+        corner_locs = np.minimum(lower[:, np.newaxis, :] + bits,
+            np.array(index.shape) - 1)
+        rows = index[tuple([corner_locs[:, :, i] for i in range(self.ndim)])]
+        weights = np.prod(np.where(bits, coeff[:, np.newaxis, :],
+            1 - coeff[:, np.newaxis, :]), axis=2)
+        return rows, weights
+
+    def _corners(self, p):
+        """
+        The rows to interpolate one point p from, and their weights: 
+        returns the array they are rows of (_block, the spline 
+        coefficients, or None for model['flux'] when there's no block),
+        the rows and the weights - or None if a model that is needed is
+        missing. Incomplete grids get only the corners they need: one 
+        value of every parameter already on a grid value.
+        """
+        if self._spline is not None:
+            rows, weights = self._spline.rows_and_weights(p)
+            return self._spline.coeffs, rows, weights
+
+        try:
+            self.grid_index()
+        except ValueError:
+            pass
+        else:
+            rows, weights = self.corner_weights(p)
+            return self._block, rows[0], weights[0]
+
+        if getattr(self, '_row_at', None) is None:
+            ## rows by parameter values (None where duplicated)
+            self._row_at = {}
+            vals = zip(*[self.plims[par]['vals'] for par in self.params])
+            for row, cpar in enumerate(vals):
+                cpar = tuple(cpar)
+                self._row_at[cpar] = None if cpar in self._row_at else row
+
+        choices = []
+        for i in range(self.ndim):
+            vals = self.plims[self.params[i]]['vals']
+            if p[i] in vals:
+                choices.append([(p[i], 1.0)])
+                continue
+            dn_val = max(vals[vals<p[i]])
+            up_val = min(vals[vals>p[i]])
+            if self.params[i]=='teff':
+                coeff = (p[i]**4 - dn_val**4)*1.0/(up_val**4 - dn_val**4)
+            else:
+                coeff = (p[i] - dn_val)*1.0/(up_val - dn_val)
+            choices.append([(dn_val, 1 - coeff), (up_val, coeff)])
+
+        rows, weights = [], []
+        for corner in itertools.product(*choices):
+            cpar = tuple([c[0] for c in corner])
+            row = self._row_at.get(cpar)
+            if row is None:
+                logging.info('ERROR: Multi/No model {}'.format(cpar))
+                return None
+            rows.append(row)
+            weights.append(np.prod([c[1] for c in corner]))
+        return self._block, np.array(rows), np.array(weights)
+
     def interp_models(self,*args):
         """
         NOTE: at this point I have not accounted for model parameters
@@ -293,168 +798,119 @@ class ModelGrid(object):
              model flux corresponding to input parameters
 
         """
-
         p = np.asarray(args)[0]
-        logging.debug('params %s',str(p))
-
-        grid_edges = {}
-        edge_inds = {}
-        single_flags = np.array([],int)
-        # Get the "edge values" - the grid values above and below
-        # the desired values
-        for i in range(self.ndim):
-#            print self.params[i]
-#            print self.plims[self.params[i]]['vals']
-            if (p[i] in self.plims[self.params[i]]['vals']):
-                grid_edges[self.params[i]] = np.array([p[i]])
-                edge_inds[self.params[i]] = np.where(
-                    self.plims[self.params[i]]['vals']==[p[i]])[0]
-                single_flags = np.append(single_flags,i)
-            else:
-                dn_val = max(self.plims[self.params[i]]['vals'][
-                     self.plims[self.params[i]]['vals']<p[i]])
-                up_val = min(self.plims[self.params[i]]['vals'][
-                     self.plims[self.params[i]]['vals']>p[i]])
-#                logging.debug('up {} down {}'.format(up_val,dn_val))
-                grid_edges[self.params[i]] = np.array([dn_val,up_val])
-                edge_inds[self.params[i]] = np.array([np.where(
-                    self.plims[self.params[i]]['vals']==dn_val)[0],np.where(
-                    self.plims[self.params[i]]['vals']==up_val)[0]])
-#        logging.debug('skipping: {}'.format(single_flags))
-
-        # If all the paramters need to be interpolated (the usual case)
-        # then we need 2**ndim spectra (that's how many 'corners' there are)
-        # However, we have one less interpolation step for every parameter
-        # value that is an existing grid value (i.e. if Teff=1800, we don't
-        # need to interpolate because models at that Teff exist in our grid)
-        num_spectra = 2**(self.ndim-len(single_flags))
-        to_interp = np.delete(range(self.ndim),single_flags)
-#        logging.debug('%d spectra', num_spectra)
-
-        # Get the "corners" of the model grid - the model values that
-        # will be interpolated between.  This creates a bunch of tuples 
-        # (well really, rows in an array) that contain all the unique 
-        # combinations of the upper and lower values of each parameter.
-        # The values that don't need interpolation only appear once,
-        # and for the parameters that need interpolation, half the lines
-        # will have the upper value and half will have the lower value.
-        grid_corners = np.zeros(num_spectra*self.ndim).reshape(
-            num_spectra,self.ndim)
-        for i in single_flags:
-            grid_corners[:,i] = grid_edges[self.params[i]][0]
-        for i in to_interp:  
-            if num_spectra==2:
-                div_by = 1
-            else:
-                div_by = 2**(self.ndim-len(single_flags) - i - 1)
-            loc = ((np.arange(num_spectra)/div_by) % 2)
-            loc1 = np.where(loc==0)[0]
-            loc2 = np.where(loc)[0]
-#            logging.debug('div_by {} loc1 {} loc2 {}'.format(div_by,loc1,loc2))
-            grid_corners[loc1,i] = grid_edges[self.params[i]][0]
-            grid_corners[loc2,i] = grid_edges[self.params[i]][1]
-#        logging.debug('all corners: %s',str(grid_corners))
-
-        # Get the actual corner spectra to be interpolated
-        corner_spectra = {}
-        for cpar in grid_corners:
-            # cpar contains all the model parameters for a particular spectrum
-            # find_i is the location of that spectrum in the dictionary
-            find_i = np.ones(len(self.plims[self.params[0]]['vals']),bool)
-            for i in range(self.ndim):
-                find_i = (find_i & 
-                     (cpar[i]==self.plims[self.params[i]]['vals']))
-            find_i = np.where(find_i)[0]
-#            logging.debug(str(cpar))
-            if len(find_i)!=1:
-                logging.info('ERROR: Multi/No model {} {}'.format(cpar,find_i))
-                return np.ones(len(self.wave))*-99.0*self.flux.unit
-#            print find_i
-            corner_spectra[tuple(cpar)] = self.model['flux'][find_i]
-
-#        logging.debug('finished getting corner spectra')
-
-        # Interpolate at all paramters requiring interpolation, skip the rest
-        old_corners = np.copy(grid_corners)
-        old_spectra = dict(corner_spectra)
+        return u.Quantity(self._interp_flux(p), self.model_flux_units)
+
+    def _interp_flux(self, p):
+        """ 
+        interp_models for __call__: returns the model flux as a plain 
+        array, normalized into this thread's work['model'] (so it is only
+        good until the next call), or an array of -99s if a corner is 
+        missing
+        """
+        if self.emulator is not None:
+            return self._emulated_flux(p)
+
+        started = stats.start()
+
+        # Get the "corners" of the model grid around p - the rows of 
+        # the flux block that will be interpolated between - and the 
+        # weight of each, so the interpolated spectrum is their weighted
+        # sum. (Corners in a parameter that is already on a grid value 
+        # get no weight.)
+        # (With cubic interpolation, the rows are of the spline 
+        # coefficients, 4 per parameter, rather than the grid corners.)
+        corners = self._corners(p)
+        stats.stop('corner_search', started)
+        if corners is None:
+            stats.count('missing_model')
+            return np.ones(len(self.wave))*-99.0
+        block, rows, weights = corners
+
+        # Interpolate: gather the corner spectra into this thread's 
+        # work['corners'] and contract them with the weights
+        started = stats.start()
+        flux = self.model['flux']
+        spectra = self._buffer('corners', (len(rows), flux.shape[1]),
+            flux.dtype)
+        if block is None:
+            ## a LazyFlux or QuantizedFlux decodes rows; asked for one at a
+            ## time, so the neighbours a LazyFlux reads with the first 
+            ## corner serve the others
+            for k, row in enumerate(rows):
+                spectra[k] = flux[int(row)].value
+        else:
+            np.take(block, rows, axis=0, out=spectra, mode='clip')
+        mod_flux = np.dot(weights.astype(spectra.dtype, copy=False), spectra,
+            out=self._buffer('interpolated', spectra.shape[1:], spectra.dtype))
+        stats.stop('interpolate', started)
+
+        return self._finish_model(mod_flux)
+
+    def _emulated_flux(self, p):
+        """ _interp_flux with the emulator """
+        started = stats.start()
+        rows, weights = self.corner_weights(p)
+        mod_flux = self.emulator.spectrum(rows[0], weights[0],
+            out=self._buffer('emulated', (len(self.wave),)))
+        stats.stop('emulate', started)
+
+        started = stats.start()
+        mod_flux = self.normalize_model(mod_flux, out=self._work()['model'])
+        stats.stop('normalize', started)
+        return mod_flux
 
-        for i in range(self.ndim):
-#            logging.debug('now dealing with %d %s',i,self.params[i])
-            if i in to_interp:
-                # get the values to be interpolated between for this loop
-                interp1 = old_corners[0,0]
-                interp2 = old_corners[len(old_corners)/2,0]
-#                logging.debug('lower {}  upper {}'.format(interp1,interp2))
-
-                # coeff expresses how close the new value is to the lower value 
-                # relative to the distance between the upper and lower values
-                if self.params[i]=='teff':
-#                    logging.debug('NEW TEFF COEFF')
-                    coeff = (p[i]**4 - interp1**4)*1.0/(interp2**4 - interp1**4)
-                else:
-                    coeff = (p[i] - interp1)*1.0/(interp2 - interp1)
-#                logging.debug('{} coeff {}'.format(self.params[i],coeff))
-
-                # There will be half as many spectra after this.  
-                new_corners = old_corners[:len(old_corners)/2,1:]
-#                print 'new corners',new_corners
-                new_spectra = {}
-                for cpar in new_corners:
-#                    logging.debug('new params {} {}'.format(cpar, type(cpar)))
-                    ns1 = old_spectra[tuple(np.append(interp1,cpar))]
-                    ns2 = old_spectra[tuple(np.append(interp2,cpar))]
-
-                    # INTERPOLATE and save
-                    new_flux = ns1 + (ns2-ns1)*coeff
-
-                    new_spectra[tuple(cpar)] = new_flux
-
-#                logging.debug(str(new_spectra.keys()))
-                old_corners = new_corners
-                old_spectra = new_spectra
-#                logging.debug('remaining to interp {}'.format(old_spectra.keys()))
-
-            elif i in single_flags:
-                # No need to interpolate this variable, so skip it and
-                # copy the same spectra to a new dictionary with new indices
-                skip_var = old_corners[0,0]
-#                print i,self.params[i],skip_var
-                new_corners = old_corners[:,1:]
-#                print new_corners
-                new_spectra = {}
-                for cpar in new_corners:
-                    new_spectra[tuple(cpar)] = old_spectra[tuple(np.append(
-                        skip_var,cpar))]
-                old_corners = new_corners
-                old_spectra = new_spectra
-#                print old_spectra.keys()
-            else:
-                logging.debug('make_model WTF')
-        mod_flux = old_spectra[()][0]
-#        logging.debug('all done! %d %d', len(mod_flux), len(self.flux))
-#        logging.debug('all done! {} {}'.format(type(mod_flux), type(self.flux)))
+    def _finish_model(self, mod_flux):
+        """
+        Smooths a model spectrum (a plain array on the model wavelengths)
+        if needed, resamples it onto the data wavelengths and normalizes
+        it, into this thread's work['model']
+        """
+        work = self._work()
 
         # THIS IS WHERE THE CODE TAKES A LONG TIME
         if self.smooth:
 #            logging.debug('starting smoothing')
-            mod_flux = falt2(self.model['wavelength'],mod_flux,resolution) 
+            started = stats.start()
+            mod_flux = falt2(self.model['wavelength'],u.Quantity(mod_flux,
+                self.model_flux_units,copy=False),resolution).value
+            stats.stop('smooth', started)
 #            logging.debug('finished smoothing {}'.format(type(mod_flux)))
 #        else:
 #            logging.debug('no smoothing')
         if self.interp:
 #            logging.debug('starting interp')
-            mod_flux = np.interp(self.wave,self.model['wavelength'],mod_flux)
+            started = stats.start()
+            mod_flux = self._resample(mod_flux, work)
+            stats.stop('resample', started)
 #            logging.debug('finished interp')
 
-        mod_flux = self.normalize_model(mod_flux)
-
-        if type(mod_flux)!=u.quantity.Quantity:
-            mod_flux = mod_flux*self.model_flux_units
+        started = stats.start()
+        mod_flux = self.normalize_model(mod_flux, out=work['model'])
+        stats.stop('normalize', started)
 
 #        logging.debug('returning {}'.format(type(mod_flux)))
         return mod_flux
 
-    def normalize_model(self,model_flux,return_ck=False):
+    def _resample(self, mod_flux, work):
+        """
+        np.interp(self.wave, model wavelength, mod_flux), into 
+        work['upper'] (the weights are worked out in _set_spectrum)
+        """
+        lower, upper, t = self._resample_weights
+        if mod_flux.dtype!=np.float64:
+            ## np.take needs the output in the input's dtype
+            np.copyto(self._buffer('row', mod_flux.shape), mod_flux)
+            mod_flux = self._buffer('row', mod_flux.shape)
+        np.take(mod_flux, lower, out=work['lower'], mode='clip')
+        np.take(mod_flux, upper, out=work['upper'], mode='clip')
+        resampled = work['upper']
+        resampled -= work['lower']
+        resampled *= t
+        resampled += work['lower']
+        return resampled
+
+    def normalize_model(self,model_flux,return_ck=False,out=None):
         # Need to normalize (taking below directly from old makemodel code)
         #This defines a scaling factor; it expresses the ratio 
         #of the observed flux to the model flux in a way that  
@@ -475,10 +931,21 @@ class ModelGrid(object):
 #         model_flux = model_flux*ck
 #        logging.debug('finished renormalization') 
 
-        mult1 = sum(self.flux*model_flux/(self.unc**2))
-        mult = sum(model_flux*model_flux/(self.unc**2))
+        ## Sums in float64, whatever the model flux is kept in; the 
+        ## products are worked out in this thread's work['scratch'], and 
+        ## the scaled model goes into out (a new array if not given)
+        model_flux = getattr(model_flux, 'value', model_flux)
+        scratch = self._work()['scratch']
+        np.multiply(self._flux_values, model_flux, out=scratch)
+        scratch /= self._unc_sq
+        mult1 = np.sum(scratch,dtype=np.float64)
+        np.multiply(model_flux, model_flux, out=scratch)
+        scratch /= self._unc_sq
+        mult = np.sum(scratch,dtype=np.float64)
         ck = mult1/mult
-        model_flux = model_flux*ck
+        if out is None:
+            out = np.zeros(len(model_flux))
+        model_flux = np.multiply(model_flux, ck, out=out)
         
         if return_ck:
             return model_flux, ck
@@ -531,7 +998,7 @@ class ModelGrid(object):
         """
 
         close_val = arr[np.abs(arr-val).argmin()]
-        logging.debug("{} nearest {}".format(val,close_val))
+        logging.debug("%s nearest %s", val, close_val)
 
         indices = np.where(np.abs(arr-close_val)<=1e-5)[0]
         return indices
@@ -582,9 +1049,13 @@ class ModelGrid(object):
              model flux corresponding to input parameters
 
         """
-
         p = np.asarray(args)[0]
+        return u.Quantity(self._retrieve_flux(p), self.model_flux_units)
+
+    def _retrieve_flux(self, p):
+        """ retrieve_model for __call__ (see _interp_flux) """
 #        logging.debug('starting params %s',str(p))
+        started = stats.start()
 
         # p_loc is the location in the model grid that fits all the 
         # constraints up to that point. There aren't constraints yet,
@@ -605,36 +1076,24 @@ class ModelGrid(object):
                 for i in range(self.ndim)] for j in range(num_models)]
             p_loc = [self.find_nearest2(param_arrays,p)]
 
-        logging.debug(str(p_loc))
-        mod_flux = np.ones(len(self.wave))*-99.0*self.flux.unit
+        if _trace_retrieve.on and _trace_retrieve.sample():
+            _trace_retrieve.record('p {} model rows {}', p, p_loc)
+        mod_flux = np.ones(len(self.wave))*-99.0
         if len(p_loc)==1:
-            mod_flux = self.model['flux'][p_loc]
-            while len(mod_flux)==1:
-                mod_flux = mod_flux[0]
+            ## one row: a view of the flux block (or a decoded row)
+            if self._block is None:
+                mod_flux = self.model['flux'][int(p_loc[0])].value
+            else:
+                mod_flux = self._block[p_loc[0]]
         else:
             logging.info("MODEL NOT FOUND/DUPLICATE MODELS FOUND!!")
             logging.info("params {} location(s) {}".format(p, p_loc))
+            stats.count('missing_model')
+            stats.stop('nearest_model', started)
             return mod_flux
+        stats.stop('nearest_model', started)
 
-        if self.smooth:
-#            logging.debug('starting smoothing')
-            mod_flux = falt2(self.model['wavelength'],mod_flux,resolution) 
-#            logging.debug('finished smoothing')
-#        else:
-#            logging.debug('no smoothing')
-        if self.interp:
-            logging.debug('starting interp {} {} {}'.format(len(self.wave),
-                len(self.model['wavelength']),len(mod_flux)))
-            mod_flux = np.interp(self.wave,self.model['wavelength'],mod_flux)
-            logging.debug('finished interp')
-
-        mod_flux = self.normalize_model(mod_flux)
-
-        if type(mod_flux)!=u.quantity.Quantity:
-            mod_flux = mod_flux*self.model_flux_units
-
-#        logging.debug('returning {}'.format(type(mod_flux)))
-        return mod_flux
+        return self._finish_model(mod_flux)
 
     def snap_full_run(self,cropchain):
         """
@@ -681,7 +1140,7 @@ class ModelGrid(object):
 
 
     def calc_normalization(self,n_values,
-        wavelength_bins=[0.9,1.4,1.9,2.5]*u.um):
+        wavelength_bins=[0.9,1.4,1.9,2.5]*u.um,out=None):
         """
         calculates normalization as a function of wavelength
 
@@ -696,6 +1155,8 @@ class ModelGrid(object):
             the normalization for wavelengths below and above the minimum
             and maximum bin edges will be set to the same as the nearest bin
 
+        out: array (optional)
+            where to put the normalization (a new array if not given)
 
         Returns
         -------
@@ -705,18 +1166,113 @@ class ModelGrid(object):
 
         """
 
-        normalization = np.zeros(len(self.wave))
+        if out is None:
+            out = np.zeros(len(self.wave))
+        normalization = out
 
         if len(wavelength_bins)==0:
             normalization[:] = n_values
         else:
-            for i in range(len(n_values)):
-                norm_loc = np.where((self.wave>wavelength_bins[i]) &
-                    (self.wave<=wavelength_bins[i+1]))[0]
-                normalization[norm_loc] = n_values[i]
-            norm_loc = np.where(self.wave<=wavelength_bins[0])[0]
-            normalization[norm_loc] = n_values[i]
-            norm_loc = np.where(self.wave>wavelength_bins[-1])[0]
-            normalization[norm_loc] = n_values[i]
+            bins, uncovered = self._norm_bin(wavelength_bins, len(n_values))
+            np.take(np.asarray(n_values, np.float64), bins, out=normalization,
+                mode='clip')
+            if uncovered is not None:
+                normalization[uncovered] = 0.0
 
         return normalization
+
+    def _norm_bin(self, wavelength_bins, nvalues):
+        """
+        Which of nvalues normalizations applies to each pixel, for 
+        calc_normalization: pixels in bin i take the i-th, and pixels 
+        below and above the bins the last. Returns that and a mask of the
+        pixels none applies to (or None), worked out once per set of bins.
+        """
+        key = (id(wavelength_bins), nvalues)
+        cached = self._norm_bins.get(key)
+        if (cached is None) or (cached[0] is not wavelength_bins):
+            wave = self.wave.value
+            edges = wavelength_bins.to(self.wave.unit).value
+            bins = np.zeros(len(wave), int)
+            covered = np.zeros(len(wave), bool)
+            for i in range(nvalues):
+                in_bin = (wave>edges[i]) & (wave<=edges[i+1])
+                bins[in_bin] = i
+                covered |= in_bin
+            outside = (wave<=edges[0]) | (wave>edges[-1])
+            bins[outside] = nvalues - 1
+            covered |= outside
+            cached = (wavelength_bins, bins,
+                      None if np.all(covered) else ~covered)
+            self._norm_bins[key] = cached
+        return cached[1:]
+
+
+def with_flux_dtype(model_dict, dtype):
+    """
+    Returns a copy of model_dict with the flux kept in dtype (the other
+    arrays are not copied); a LazyFlux keeps the rows it reads in dtype
+    """
+    model_dict = dict(model_dict)
+    if model_dict['flux'].dtype!=np.dtype(dtype):
+        model_dict['flux'] = model_dict['flux'].astype(dtype)
+    return model_dict
+
+
+def check_flux_dtype(spectrum, model_dict, params, points, flux_dtype=np.float32,
+    **kwargs):
+    """
+    Accuracy check for keeping the model flux in flux_dtype: builds a
+    ModelGrid with the flux as given (normally float64) and one with it
+    in flux_dtype, and compares the model spectra and lnprob at points.
+
+    float32 keeps 24 bits of mantissa, so every stored flux value is
+    rounded by up to 6e-8 of itself; interpolating and resampling adds
+    a few roundings more. On the synthetic grids of synth_fit.benchmark
+    (2000 data pixels) the model spectra agree to ~2e-7 and lnprob to
+    ~1e-7 of its value (a few 1e-3 absolute) - far below the lnprob
+    differences between neighbouring walkers, so fits are unchanged.
+
+    Parameters
+    ----------
+    spectrum, model_dict, params: as for ModelGrid
+
+    points: array (npoints, ndim + nnorm + 1)
+        parameters, as passed to ModelGrid.__call__
+
+    flux_dtype: numpy dtype (default=np.float32)
+
+    **kwargs: passed to ModelGrid
+
+    Returns
+    -------
+    errors: dictionary
+        'flux': largest relative difference of the model spectrum at each
+        point; 'lnprob': absolute difference of lnprob at each point (nan
+        where either is -inf); 'max_flux' and 'max_lnprob' their maxima
+
+    """
+    reference = ModelGrid(spectrum, model_dict, params, **kwargs)
+    grid = ModelGrid(spectrum, model_dict, params, flux_dtype=flux_dtype,
+        **kwargs)
+    points = np.atleast_2d(points)
+    flux_errors, lnprob_errors = [], []
+    for p in points:
+        model_p = p[:grid.ndim]
+        if grid.snap:
+            expected, found = (reference.retrieve_model(model_p),
+                               grid.retrieve_model(model_p))
+        else:
+            expected, found = (reference.interp_models(model_p),
+                               grid.interp_models(model_p))
+        flux_errors.append(np.max(np.abs(found.value - expected.value) /
+            np.abs(expected.value)))
+        expected, found = reference(p), grid(p)
+        if np.isfinite(expected) and np.isfinite(found):
+            lnprob_errors.append(abs(found - expected))
+        else:
+            lnprob_errors.append(np.nan)
+    flux_errors, lnprob_errors = np.array(flux_errors), np.array(lnprob_errors)
+    return {'flux':flux_errors, 'lnprob':lnprob_errors,
+            'max_flux':np.nanmax(flux_errors),
+            'max_lnprob':np.nanmax(lnprob_errors)}
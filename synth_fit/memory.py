@@ -0,0 +1,336 @@
+# Module for working out how much memory a fit will need before running
+# it (to pack jobs onto nodes), and for measuring what a fit actually uses
+# in each of its stages
+################################################################################
+
+import collections
+import logging
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+from astropy import units as u
+
+from quantized_grid import QuantizedFlux
+
+## Rough allowances for what isn't a numpy array of known size
+matplotlib_figure_bytes = 30 * 2**20
+test_all_plot_bytes_per_model = 10 * 2**10
+test_all_row_bytes = 200
+
+
+def plan_memory(model, spectrum, params, nwalk_mult=20, nstep_mult=50,
+                converge=False, max_steps=100000, compact=False, thin=1,
+                smooth=False, processes=None, shared=False, plot=True,
+                wavelength_bins=[0.9, 1.4, 1.9, 2.5] * u.um):
+    """
+    Predicts the memory a fit of spectrum against model will need at
+    the peak of each of its stages (beyond what the Python process uses
+    before loading anything), from the sizes of the arrays involved.
+    The predictions are for the arrays the stages keep or copy, plus
+    rough allowances for plots; they don't include the interpreter and
+    its libraries, so compare them with a MemoryProfile of a small run.
+
+    Parameters
+    ----------
+    model: dictionary
+        model grid, as for ModelGrid (only the array shapes and the flux
+        dtype are used)
+
+    spectrum: dictionary
+        contains 'wavelength', 'flux' and 'unc' arrays
+
+    params: list of strings
+        grid parameters to fit
+
+    nwalk_mult, nstep_mult, converge, max_steps, compact, thin: as for
+        BDSampler.mcmc_go (with converge=True, the chain may grow to
+        max_steps, so that is what is planned for)
+
+    smooth: boolean (default=False)
+        as for BDSampler
+
+    processes: integer (default=None)
+        worker processes evaluating lnprob (mcmc_go's pool), if any
+
+    shared: boolean (default=False)
+        whether the grid is shared with the workers (ModelGrid.share);
+        otherwise every worker holds its own copy
+
+    plot: boolean (default=True)
+        whether the triangle and chain plots are made
+
+    Returns
+    -------
+    plan: OrderedDict
+        for each stage ('make_model_db', 'ModelGrid.__init__', 'test_all',
+        'mcmc_go', 'plotting'), an OrderedDict of the components resident
+        during it and their sizes in bytes, with their 'total'; then
+        'peak' (the largest total), and 'per_worker' (bytes each worker
+        process adds)
+
+    """
+    nmodels, npix = len(model['flux']), len(model['wavelength'])
+    data_npix = len(spectrum['wavelength'])
+    ndim_model = len(params)
+    nnorm = max(len(wavelength_bins) - 1, 1)
+    ndim = ndim_model + nnorm + 1
+    nwalkers = ndim * nwalk_mult
+    nsteps = max_steps if converge else ndim * nstep_mult
+    nburn = 0 if converge else nsteps / 10
+    ## the flux in whatever dtype it is kept in (see ModelGrid flux_dtype),
+    ## or encoded (plus its cache of decoded rows)
+    if isinstance(model['flux'], QuantizedFlux):
+        flux_bytes = (model['flux'].nbytes +
+            model['flux'].dtype.itemsize * model['flux'].cache_size * npix)
+    else:
+        flux_bytes = model['flux'].dtype.itemsize * nmodels * npix
+    grid = flux_bytes + 8 * nmodels * ndim_model + 8 * npix
+    data = 3 * 8 * data_npix
+
+    plan = collections.OrderedDict()
+    ## Rows fetched from the database, the DataFrame built from them, and
+    ## the rebinned grid that is returned
+    plan['make_model_db'] = collections.OrderedDict([('rows', 2 * grid),
+        ('dataframe', grid), ('rebinned grid', grid)])
+
+    ## ModelGrid keeps a reference to the grid, copies of the data in the
+    ## model units, and sorted parameter values
+    plan['ModelGrid.__init__'] = collections.OrderedDict([('grid', grid),
+        ('data', 2 * data), ('parameter values', 8 * nmodels * ndim_model)])
+
+    ## test_all resamples (and smooths) one model at a time, keeps a
+    ## chi-squared row per model, and draws a point per model
+    per_model = 8 * (npix + 6 * data_npix)
+    if smooth:
+        per_model += 8 * 12 * npix
+    plan['test_all'] = collections.OrderedDict([('grid', grid),
+        ('data', 2 * data), ('model temporaries', per_model),
+        ('chi-squared', nmodels * (8 + test_all_row_bytes)),
+        ('plot', nmodels * test_all_plot_bytes_per_model)])
+
+    ## The chain (float64 in emcee, float32 in a compact buffer) and its
+    ## lnprob, the burn-in (kept by emcee until reset), and the cropped
+    ## copy of the chain and the partition made for the quantiles
+    kept = nwalkers * (nsteps / thin)
+    if compact:
+        chain = 4 * kept * (ndim + 1)
+        burn = 0
+    else:
+        chain = 8 * kept * (ndim + 1)
+        burn = 8 * nwalkers * nburn * (ndim + 1)
+    ## one lnprob evaluation at a time holds about ten data-sized arrays
+    evaluation = 8 * 10 * data_npix
+    plan['mcmc_go'] = collections.OrderedDict([('grid', grid),
+        ('data', 2 * data), ('chain', chain), ('burn-in', burn),
+        ('chain copies', 2 * 8 * kept * ndim),
+        ('lnprob temporaries', evaluation if processes is None else 0)])
+
+    plan['plotting'] = collections.OrderedDict()
+    if plot:
+        plan['plotting'] = collections.OrderedDict([('grid', grid),
+            ('chain', chain), ('flattened chain', 8 * kept * ndim),
+            ('figures', 2 * matplotlib_figure_bytes)])
+
+    for stage in plan.keys():
+        plan[stage]['total'] = sum(plan[stage].values())
+    plan['peak'] = max(plan[stage]['total'] for stage in plan.keys())
+
+    ## Each worker unpickles the ModelGrid (the grid itself too, unless it
+    ## is shared) and evaluates its walkers one at a time
+    if processes is not None:
+        plan['per_worker'] = (0 if shared else grid) + 2 * data + evaluation
+    else:
+        plan['per_worker'] = 0
+    return plan
+
+
+def format_plan(plan):
+    """ the plan as a text table (MB) """
+    lines = []
+    for stage, components in plan.items():
+        if isinstance(components, dict):
+            lines.append('{:<20} {:>10.1f} MB'.format(stage,
+                components['total'] / 2.**20))
+            for name, size in components.items():
+                if name!='total':
+                    lines.append('    {:<16} {:>10.1f} MB'.format(name,
+                        size / 2.**20))
+        else:
+            lines.append('{:<20} {:>10.1f} MB'.format(stage,
+                components / 2.**20))
+    return '\n'.join(lines)
+
+
+def current_memory():
+    """
+    Resident memory of this process in bytes (from /proc on Linux; else
+    the peak so far, which is all getrusage gives)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ## kilobytes on Linux, bytes on OS X
+        return peak if os.uname()[0]=='Darwin' else peak * 1024
+
+
+class MemoryProfile(object):
+    """
+    Measures memory use by stage. Python 2 has no tracemalloc, so (unless
+    it is available) the resident memory of the process is sampled by a
+    background thread every interval seconds while a stage runs; with
+    tracemalloc, its traced and peak sizes are used instead.
+
+    Call as:
+       profile = MemoryProfile()
+       with profile.stage('test_all'):
+           ...
+       print profile.format_report()
+
+    or have profile_fit() run a fit stage by stage.
+
+    Parameters for __init__
+    -----------------------
+    interval: float (default=0.005)
+        seconds between samples
+
+    Creates
+    -------
+    stages (OrderedDict) : for each stage, 'start', 'end' and 'peak' memory
+        in bytes, 'increase' (peak - start) and 'time'
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stages = collections.OrderedDict()
+        try:
+            import tracemalloc
+            self._tracemalloc = tracemalloc
+        except ImportError:
+            self._tracemalloc = None
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def _measure(self):
+        if self._tracemalloc is not None:
+            return self._tracemalloc.get_traced_memory()[0]
+        return current_memory()
+
+    def report(self):
+        return self.stages
+
+    def format_report(self):
+        lines = ['{:<20} {:>10} {:>10} {:>10} {:>9}'.format('stage',
+            'start MB', 'peak MB', '+MB', 'time (s)')]
+        for name, s in self.stages.items():
+            lines.append('{:<20} {:>10.1f} {:>10.1f} {:>10.1f} {:>9.2f}'.format(
+                name, s['start'] / 2.**20, s['peak'] / 2.**20,
+                s['increase'] / 2.**20, s['time']))
+        return '\n'.join(lines)
+
+
+class _Stage(object):
+    """ context manager measuring one stage of a MemoryProfile """
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        profile = self.profile
+        tm = profile._tracemalloc
+        if tm is not None:
+            if tm.is_tracing()==False:
+                tm.start()
+            if hasattr(tm, 'reset_peak'):
+                tm.reset_peak()
+        self.start_time = time.time()
+        self.start = profile._measure()
+        self.peak = self.start
+        self._done = threading.Event()
+        if tm is None:
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while self._done.is_set()==False:
+            self.peak = max(self.peak, current_memory())
+            self._done.wait(self.profile.interval)
+
+    def __exit__(self, *exc_info):
+        profile = self.profile
+        self._done.set()
+        if profile._tracemalloc is None:
+            self._thread.join()
+            end = current_memory()
+            peak = max(self.peak, end)
+        else:
+            end, peak = profile._tracemalloc.get_traced_memory()
+        profile.stages[self.name] = collections.OrderedDict([
+            ('start', self.start), ('end', end), ('peak', peak),
+            ('increase', peak - self.start),
+            ('time', time.time() - self.start_time)])
+        logging.info('{}: peak {:.1f} MB (+{:.1f} MB)'.format(self.name,
+            peak / 2.**20, (peak - self.start) / 2.**20))
+        return False
+
+
+def profile_fit(name, spectrum, model, params, plot=True, profile=None,
+                db=None, **mcmc_kwargs):
+    """
+    Runs a fit one stage at a time ('make_model_db' if db is given,
+    'ModelGrid.__init__', 'test_all', 'mcmc_go' and, with plot=True,
+    'plotting'), measuring the memory each one uses
+
+    Parameters
+    ----------
+    name, spectrum, params: as for BDSampler
+
+    model: dictionary
+        the model grid (ignored if db is given)
+
+    db: dictionary (optional)
+        arguments for mcmc_fit.make_model_db, to load the grid with
+        (e.g. {'model_grid_name': 'bt_settl_2013',
+               'model_atmosphere_db': 'model_atmospheres.db'})
+
+    profile: MemoryProfile instance (optional)
+
+    **mcmc_kwargs: passed to BDSampler.mcmc_go
+
+    Returns
+    -------
+    profile: MemoryProfile instance
+    bdsamp: BDSampler instance
+
+    """
+    from make_model import ModelGrid
+    from bdfit import BDSampler
+    if profile is None:
+        profile = MemoryProfile()
+    if db is not None:
+        from mcmc_fit.mcmc_fit import make_model_db
+        with profile.stage('make_model_db'):
+            model = make_model_db(**db)
+    with profile.stage('ModelGrid.__init__'):
+        grid = ModelGrid(spectrum, model, params)
+    with profile.stage('test_all'):
+        bdsamp = BDSampler(name, spectrum, grid, params)
+    with profile.stage('mcmc_go'):
+        bdsamp.mcmc_go(**mcmc_kwargs)
+    if plot:
+        from plotting import pyplot
+        plt = pyplot()
+        with profile.stage('plotting'):
+            bdsamp.plot_triangle()
+            bdsamp.plot_chains()
+        plt.close('all')
+    return profile, bdsamp
@@ -0,0 +1,18 @@
+# Plotting for synth_fit. matplotlib is only imported when something is
+# actually plotted, so the fitting code (and pool workers) start up
+# without it
+################################################################################
+
+
+def pyplot():
+    """
+    matplotlib.pyplot, imported on first use; the non-interactive agg
+    backend is selected unless pyplot has already been set up by the
+    caller
+    """
+    import sys
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    return plt
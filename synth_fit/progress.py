@@ -0,0 +1,124 @@
+# Module for reporting on an MCMC run while it is going: throughput,
+# acceptance, autocorrelation time and the projected finish, after every
+# block of steps
+################################################################################
+
+import datetime
+import json
+import logging
+import time
+
+import numpy as np
+
+from autocorr import integrated_time
+
+
+class ProgressMonitor(object):
+    """
+    Reports on a BDSampler.mcmc_go run after every block of steps (pass
+    it, or just a callback or a filename, as mcmc_go's progress argument).
+    Each report is a dictionary with
+
+       phase: 'burn', 'run' or 'converge'
+       step, total_steps: steps done so far over all phases, and planned
+           (for converge=True, max_steps: an upper limit)
+       block_steps, block_time: steps in this block, and seconds they took
+       evals_per_sec: lnprob evaluations per second in this block
+       acceptance: acceptance fraction in this block
+       mean_acceptance: acceptance fraction over the phase so far
+       tau: integrated autocorrelation time of each parameter, from the
+           second half of the phase's chain so far (None if the steps
+           aren't stored, e.g. burn-in with compact=True)
+       elapsed: seconds since the run started
+       eta_seconds, eta: projected seconds left, and finishing time
+
+    Parameters for __init__
+    -----------------------
+    callback: function (optional)
+        called with each report
+
+    filename: string (optional)
+        file to append every report to, as a line of JSON
+
+    log: boolean (default=True)
+        log a one-line summary of every report
+
+    Creates
+    -------
+    reports (list) : every report so far
+
+    """
+
+    def __init__(self, callback=None, filename=None, log=True):
+        self.callback = callback
+        self.filename = filename
+        self.log = log
+        self.reports = []
+
+    def start(self, nwalkers, total_steps, steps_done=0):
+        """ called by mcmc_go before sampling """
+        self.nwalkers = nwalkers
+        self.total_steps = total_steps
+        self.step = steps_done
+        self.steps_timed = 0
+        self.start_time = time.time()
+
+    def update(self, phase, sampler, block_steps, block_time, accepted,
+               chain=None):
+        """
+        Makes, logs, writes and hands on the report for a block that has
+        just been sampled
+
+        Parameters
+        ----------
+        sampler: emcee.EnsembleSampler
+
+        accepted: array
+            sampler.naccepted before the block
+
+        chain: array (nwalkers, nsteps, ndim) (optional)
+            the chain of this phase so far
+
+        """
+        self.step += block_steps
+        self.steps_timed += block_steps
+        elapsed = time.time() - self.start_time
+        per_step = elapsed / self.steps_timed
+        eta_seconds = max(self.total_steps - self.step, 0) * per_step
+
+        tau = None
+        if chain is not None and chain.shape[1] >= 2:
+            tau = [float(t) for t in
+                   integrated_time(chain[:, chain.shape[1] // 2:, :])]
+
+        report = {'phase':phase, 'step':self.step,
+            'total_steps':self.total_steps, 'block_steps':block_steps,
+            'block_time':block_time,
+            'evals_per_sec':self.nwalkers * block_steps / max(block_time,
+                1e-9),
+            'acceptance':float(np.mean(sampler.naccepted - accepted)) /
+                block_steps,
+            'mean_acceptance':float(np.mean(sampler.acceptance_fraction)),
+            'tau':tau, 'elapsed':elapsed, 'eta_seconds':eta_seconds,
+            'eta':(datetime.datetime.now() + datetime.timedelta(
+                seconds=eta_seconds)).isoformat()}
+        self.reports.append(report)
+
+        if self.log:
+            logging.info('{} step {}/{}: {:.0f} evals/s, acceptance {:.2f}, '
+                'max tau {}, eta {:.0f} s'.format(phase, self.step,
+                self.total_steps, report['evals_per_sec'],
+                report['acceptance'], 'n/a' if tau is None else
+                '{:.1f}'.format(max(tau)), eta_seconds))
+        if self.filename is not None:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+        if self.callback is not None:
+            self.callback(report)
+        return report
+
+
+def read_progress(filename):
+    """ the reports written to filename by a ProgressMonitor """
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
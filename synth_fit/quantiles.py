@@ -0,0 +1,130 @@
+# Module containing functions for summarizing posterior samples: exact
+# quantiles for all parameters in one pass, and a mergeable sketch that
+# summarizes chain blocks as they are sampled
+################################################################################
+
+import numpy as np
+
+
+def quantiles(samples, qs):
+    """
+    Calculates the quantiles qs of every parameter in samples, with one
+    partition of the whole array rather than a full sort per parameter
+
+    Uses the same convention as BDSampler.quantile (from DFM's triangle
+    code): the q quantile of n samples is the sorted sample int(q*n)
+
+    Parameters
+    ----------
+    samples: array_like (nsamples, ndim)
+        e.g. BDSampler.cropchain
+
+    qs: list of floats
+        quantiles between 0 and 1
+
+    Returns
+    -------
+    values: array (ndim, len(qs))
+
+    """
+    samples = np.asarray(samples)
+    n = len(samples)
+    kth = [min(int(q * n), n - 1) for q in qs]
+    partitioned = np.partition(samples, sorted(set(kth)), axis=0)
+    return partitioned[kth].T
+
+
+class QuantileSketch(object):
+    """
+    Mergeable, bounded-memory summary of a stream of samples, from which
+    approximate quantiles of every parameter can be read at any time.
+
+    This is a compactor sketch (as in Munro & Paterson, and KLL): samples
+    enter level 0; when a level holds more than k samples per parameter
+    it is sorted, and every other sample (from a random offset) moves up
+    to the next level, where each counts twice as much. Memory is
+    O(k*log(n/k)) per parameter and the rank error is O(log(n/k)/k).
+    Two sketches are merged by joining their levels, so sketches of
+    separate blocks (or separate processes) can be combined.
+
+    Parameters for __init__
+    -----------------------
+    ndim: integer
+        number of parameters
+
+    k: integer (default=2048)
+        samples kept per level; larger is more accurate
+
+    seed: integer (optional)
+        seed for the random offsets
+
+    Creates
+    -------
+    levels (list of arrays, each (m, ndim))
+    count (integer) : number of samples summarized
+
+    """
+
+    def __init__(self, ndim, k=2048, seed=None):
+        self.ndim = ndim
+        self.k = k
+        self.levels = []
+        self.count = 0
+        self._random = np.random.RandomState(seed)
+
+    def update(self, samples):
+        """ adds samples (nsamples, ndim) to the summary """
+        samples = np.asarray(samples, dtype=np.float64).reshape(
+            (-1, self.ndim))
+        self._add(0, samples)
+        self.count += len(samples)
+        self._compress()
+
+    def merge(self, other):
+        """ adds everything summarized by another QuantileSketch """
+        for h, level in enumerate(other.levels):
+            self._add(h, level)
+        self.count += other.count
+        self._compress()
+
+    def _add(self, h, samples):
+        while len(self.levels) <= h:
+            self.levels.append(np.zeros((0, self.ndim)))
+        self.levels[h] = np.concatenate((self.levels[h], samples))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.k:
+                level = np.sort(level, axis=0)
+                m = len(level) - len(level) % 2
+                offset = self._random.randint(2)
+                self.levels[h] = level[m:]
+                self._add(h + 1, level[offset:m:2])
+            h += 1
+
+    def quantiles(self, qs):
+        """
+        Returns
+        -------
+        values: array (ndim, len(qs))
+            approximate quantiles, with the convention of quantiles()
+
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.ones(len(level)) * 2**h
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(values, axis=0)
+        values = values[order, np.arange(self.ndim)]
+        cum_weights = np.cumsum(weights[order], axis=0)
+        total = cum_weights[-1]
+
+        result = np.zeros((self.ndim, len(qs)))
+        for j, q in enumerate(qs):
+            ## first sample whose cumulative weight passes floor(q*n)
+            target = np.floor(q * total)
+            idx = np.minimum(np.sum(cum_weights <= target, axis=0),
+                len(values) - 1)
+            result[:, j] = values[idx, np.arange(self.ndim)]
+        return result
@@ -0,0 +1,258 @@
+# Module for model grids too big to keep in memory as floats: every
+# spectrum is stored as 16-bit integers with a scale and offset of its
+# own, and rows are decoded into a small cache as they are used
+################################################################################
+
+import collections
+import logging
+import threading
+
+import numpy as np
+from astropy import units as u
+
+from instrument import stats as instrument
+
+## Largest code used, so codes are symmetric about zero
+max_code = 32767
+
+## Rows encoded per go by quantize (limits the temporaries)
+encode_chunk = 256
+
+
+class QuantizedFlux(object):
+    """
+    Stands in for the model['flux'] Quantity array of a model grid (as
+    used by ModelGrid and test_all), keeping every row as int16 codes
+    with a per-row scale and offset, a quarter of the float64 size.
+    Indexed rows are decoded into a least-recently-used cache, so the
+    corners ModelGrid gathers for neighbouring walkers are only decoded
+    once.
+
+    The encoding is lossy, with the error bounded row by row:
+       log (the default): log(flux) = code * scale + offset; the
+           relative error is at most exp(scale / 2) - 1 at every pixel
+           (the flux must be positive); for rows spanning 4 decades, 7e-5
+       linear: flux = code * scale + offset; the error is at most half a
+           step, 1/65534 of the row's range. That bounds it relative to
+           the row's peak only: in a row spanning a few decades, the
+           faint pixels get percent-level relative errors. Only log
+           coding bounds the relative error at every pixel.
+    The largest error of each row is measured when it is encoded
+    (relative to the row's peak for linear, to each pixel for log).
+
+    Make one with quantize() or quantize_grid(). Indexing with an
+    integer returns one row, with a slice, list, index array or mask a
+    2D array of rows (all as Quantities). The value attribute decodes
+    every row.
+
+    Parameters for __init__
+    -----------------------
+    codes: int16 array (nmodels, npix)
+
+    scale, offset: arrays (nmodels)
+
+    unit: astropy unit
+
+    log: boolean (default=True)
+        whether the codes encode log(flux) (False: the flux itself)
+
+    error: array (nmodels) (optional)
+        largest error of each row, from quantize()
+
+    dtype: numpy dtype (default=np.float64)
+        what rows are decoded to
+
+    cache_size: integer (default=256)
+        maximum number of decoded rows to keep
+
+    Creates
+    -------
+    shape, unit, dtype, nbytes
+    stats (dictionary) : 'hits', 'misses'
+
+    """
+
+    ndim = 2
+
+    ## Keys of the encoded arrays in arrays() and with_arrays()
+    array_keys = ['flux_codes', 'flux_scale', 'flux_offset']
+
+    def __init__(self, codes, scale, offset, unit, log=True, error=None,
+                 dtype=np.float64, cache_size=256):
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+        self.unit = unit
+        self.log = log
+        self.error = error
+        self.dtype = np.dtype(dtype)
+        self.cache_size = cache_size
+        self.shape = codes.shape
+        self._init_cache()
+
+    def _init_cache(self):
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits':0, 'misses':0}
+
+    def __getstate__(self):
+        ## Worker processes start with an empty cache
+        state = self.__dict__.copy()
+        for key in ['_cache', '_lock', 'stats']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in [self.codes, self.scale,
+            self.offset] if arr is not None)
+
+    def astype(self, dtype):
+        """ the same encoded rows, decoded to dtype (with its own cache) """
+        return QuantizedFlux(self.codes, self.scale, self.offset, self.unit,
+            self.log, self.error, dtype, self.cache_size)
+
+    def arrays(self):
+        """ the encoded arrays, to share (see ModelGrid.share) """
+        return dict(zip(self.array_keys, [self.codes, self.scale,
+                                          self.offset]))
+
+    def with_arrays(self, arrays):
+        """ a QuantizedFlux like this one on arrays (e.g. shared ones) """
+        codes, scale, offset = [arrays[k] for k in self.array_keys]
+        return QuantizedFlux(codes, scale, offset, self.unit, self.log,
+            self.error, self.dtype, self.cache_size)
+
+    def without_arrays(self):
+        """ a copy to pickle without the encoded arrays """
+        flux = QuantizedFlux.__new__(QuantizedFlux)
+        flux.__setstate__(self.__getstate__())
+        flux.codes = flux.scale = flux.offset = None
+        return flux
+
+    def decode(self, rows):
+        """ the flux of rows (a list or index array), as an array """
+        flux = (self.codes[rows] * self.scale[rows, np.newaxis] +
+                self.offset[rows, np.newaxis])
+        if self.log:
+            np.exp(flux, out=flux)
+        return flux.astype(self.dtype, copy=False)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return u.Quantity(self._rows([key % len(self)])[0], self.unit,
+                copy=False)
+        rows = np.atleast_1d(np.arange(len(self))[key])
+        return u.Quantity(self._rows(rows), self.unit, copy=False)
+
+    @property
+    def value(self):
+        """ the whole flux array (decoded in chunks; not cached) """
+        flux = np.zeros(self.shape, self.dtype)
+        for start in range(0, len(self), encode_chunk):
+            rows = np.arange(start, min(start + encode_chunk, len(self)))
+            flux[rows] = self.decode(rows)
+        return flux
+
+    def _rows(self, rows):
+        ## Big requests (e.g. the whole grid) are decoded, not cached
+        if len(rows) > self.cache_size:
+            return self.decode(rows)
+
+        with self._lock:
+            out = np.zeros((len(rows), self.shape[1]), self.dtype)
+            missing = []
+            for i, row in enumerate(rows):
+                cached = self._cache.pop(row, None)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    self._cache[row] = cached
+                    out[i] = cached
+            self.stats['hits'] += len(rows) - len(missing)
+            self.stats['misses'] += len(missing)
+            instrument.count('quantized_cache.hits', len(rows) - len(missing))
+            instrument.count('quantized_cache.misses', len(missing))
+
+            if len(missing) > 0:
+                decoded = self.decode([rows[i] for i in missing])
+                for i, flux in zip(missing, decoded):
+                    out[i] = flux
+                    self._cache[rows[i]] = flux
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return out
+
+
+def quantize(flux, log=True, dtype=np.float64, cache_size=256):
+    """
+    Encodes a grid's flux as a QuantizedFlux
+
+    Parameters
+    ----------
+    flux: Quantity array (nmodels, npix)
+        or anything that can be sliced by rows into one (e.g. a LazyFlux,
+        which is then read a chunk of rows at a time)
+
+    log: boolean (default=True)
+        encode log(flux), for a bounded relative error at every pixel
+        (raises ValueError if any flux is not positive); with False the
+        flux is encoded linearly, and the error is only bounded relative
+        to each row's peak
+
+    dtype, cache_size: see QuantizedFlux
+
+    Returns
+    -------
+    flux: QuantizedFlux instance
+
+    """
+    nmodels, npix = flux.shape
+    codes = np.zeros((nmodels, npix), np.int16)
+    scale, offset, error = np.zeros(nmodels), np.zeros(nmodels), np.zeros(nmodels)
+    for start in range(0, nmodels, encode_chunk):
+        rows = slice(start, min(start + encode_chunk, nmodels))
+        values = np.asarray(flux[rows].value, np.float64)
+        if log:
+            if np.any(values <= 0):
+                raise ValueError("log encoding needs positive flux")
+            encoded = np.log(values)
+        else:
+            encoded = values
+        lo, hi = encoded.min(axis=1), encoded.max(axis=1)
+        offset[rows] = 0.5 * (hi + lo)
+        ## flat rows get a step of 1, and decode exactly
+        step = np.where(hi > lo, (hi - lo) / (2.0 * max_code), 1.0)
+        scale[rows] = step
+        codes[rows] = np.clip(np.round((encoded - offset[rows, np.newaxis]) /
+            step[:, np.newaxis]), -max_code, max_code)
+
+        decoded = (codes[rows] * step[:, np.newaxis] +
+                   offset[rows, np.newaxis])
+        if log:
+            error[rows] = np.max(np.abs(np.exp(decoded - encoded) - 1), axis=1)
+        else:
+            peak = np.maximum(np.max(np.abs(values), axis=1), 1e-300)
+            error[rows] = np.max(np.abs(decoded - values), axis=1) / peak
+
+    logging.info('quantized {} models: {} bytes, largest error {:.2g}'.format(
+        nmodels, codes.nbytes + scale.nbytes + offset.nbytes, error.max()))
+    return QuantizedFlux(codes, scale, offset, flux.unit, log, error, dtype,
+        cache_size)
+
+
+def quantize_grid(model_dict, log=True, dtype=np.float64, cache_size=256):
+    """
+    Returns a copy of model_dict with the flux encoded as a QuantizedFlux
+    (see quantize; the other arrays are not copied)
+    """
+    model_dict = dict(model_dict)
+    model_dict['flux'] = quantize(model_dict['flux'], log, dtype, cache_size)
+    return model_dict
@@ -0,0 +1,198 @@
+# Module for placing the arrays of a model grid in shared memory, so that
+# worker processes can attach to one copy of the grid instead of each
+# receiving (and holding) their own
+################################################################################
+
+import atexit
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import uuid
+
+import numpy as np
+from astropy import units as u
+
+
+def default_directory():
+    """
+    Returns the directory used to hold shared grids: /dev/shm when it
+    exists (RAM-backed on Linux, so the files are true shared memory),
+    otherwise the system temporary directory (a plain memory-mapped file)
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    else:
+        return tempfile.gettempdir()
+
+
+class SharedGrid(object):
+    """
+    Handle on a set of model grid arrays stored as memory-mapped files.
+
+    The grid is written once with SharedGrid.create(); any process can
+    then attach to it by name with SharedGrid(name), and reads the arrays
+    zero-copy through the OS page cache. Pickling a SharedGrid only sends
+    its name and directory, so it can be passed to a process pool cheaply.
+
+    The process that calls create() owns the files: they are removed by
+    unlink(), on leaving a with-block, or when the owner exits (so a 
+    crashed fit does not leave the grid behind in /dev/shm). Processes 
+    that attach by name never remove them.
+
+    Call as:
+       from synth_fit.shared_grid import SharedGrid
+       with SharedGrid.create(arrays, units=units) as shared:
+           # ... in a worker process
+           model_dict = SharedGrid(shared.name).model_dict()
+
+    Parameters for __init__
+    -----------------------
+    name: string
+        identifier of the shared grid (returned by create)
+
+    directory: string (default=None)
+        where the grid files live; if None, default_directory() is used
+
+    Creates
+    -------
+    name (string)
+    directory (string)
+    path (string) : directory holding the array files
+    arrays (dictionary) : read-only numpy memmaps, keyed like the model dict
+    units (dictionary) : astropy units for the arrays that carry them
+    owner_pid (integer or None) : process that created (and will remove)
+        the files; None when attached by name
+
+    """
+
+    header_file = 'header.pkl'
+
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.owner_pid = None
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+        self.path = os.path.join(directory, name)
+
+        header_path = os.path.join(self.path, self.header_file)
+        if os.path.exists(header_path)==False:
+            raise IOError("no shared grid {} in {}".format(name, directory))
+        open_header = open(header_path, 'rb')
+        header = pickle.load(open_header)
+        open_header.close()
+
+        self.units = header['units']
+        self.arrays = {}
+        for key, (dtype, shape) in header['arrays'].items():
+            self.arrays[key] = np.memmap(self._array_path(key), mode='r',
+                dtype=np.dtype(dtype), shape=tuple(shape))
+        logging.debug('attached shared grid %s', self.path)
+
+    @classmethod
+    def create(cls, arrays, units=None, name=None, directory=None):
+        """
+        Writes arrays into memory-mapped files and returns a SharedGrid
+        attached to them
+
+        Parameters
+        ----------
+        arrays: dictionary
+            numpy arrays to share (e.g. 'wavelength', 'flux' and one array
+            per model parameter)
+
+        units: dictionary (optional)
+            astropy units for any of the arrays; model_dict() will return
+            those arrays as Quantities
+
+        name: string (optional)
+            identifier for the grid; a random one is generated if None
+
+        directory: string (optional)
+            where to write the files; see default_directory()
+
+        """
+        if name is None:
+            name = 'synth_fit_grid_{}'.format(uuid.uuid4().hex)
+        if directory is None:
+            directory = default_directory()
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            raise IOError("shared grid {} already exists in {}".format(
+                name, directory))
+        os.makedirs(path)
+
+        header = {'arrays':{}, 'units':dict(units or {})}
+        for key, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            if arr.dtype==object:
+                shutil.rmtree(path)
+                raise ValueError("cannot share {}: arrays must be ".format(key)
+                    + "numeric and rectangular")
+            header['arrays'][key] = (arr.dtype.str, arr.shape)
+            mm = np.memmap(os.path.join(path, key + '.dat'), mode='w+',
+                dtype=arr.dtype, shape=arr.shape)
+            mm[...] = arr
+            mm.flush()
+            del mm
+
+        ## The header goes last, so a half-written grid can't be attached
+        open_header = open(os.path.join(path, cls.header_file), 'wb')
+        pickle.dump(header, open_header, protocol=2)
+        open_header.close()
+        logging.info('created shared grid %s', path)
+
+        shared = cls(name, directory)
+        shared.owner_pid = os.getpid()
+        atexit.register(shared._unlink_at_exit)
+        return shared
+
+    def _array_path(self, key):
+        return os.path.join(self.path, key + '.dat')
+
+    def __reduce__(self):
+        return (SharedGrid, (self.name, self.directory))
+
+    def nbytes(self):
+        """ total size of the shared arrays in bytes """
+        return sum(arr.nbytes for arr in self.arrays.values())
+
+    def model_dict(self):
+        """
+        Returns a model dictionary (as used by ModelGrid) whose arrays
+        are views on the shared files; arrays with units are wrapped as
+        Quantities without copying
+        """
+        model_dict = {}
+        for key, arr in self.arrays.items():
+            if key in self.units:
+                model_dict[key] = u.Quantity(arr, self.units[key], copy=False)
+            else:
+                model_dict[key] = arr
+        return model_dict
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlink()
+        return False
+
+    def _unlink_at_exit(self):
+        ## Forked workers inherit the atexit hook, but only the owner 
+        ## removes the files
+        if self.owner_pid==os.getpid():
+            self.unlink()
+
+    def unlink(self):
+        """
+        Removes the shared files. Processes that are still attached keep
+        their mappings until they exit, but nothing new can attach.
+        """
+        self.arrays = {}
+        self.owner_pid = None
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+            logging.info('removed shared grid %s', self.path)
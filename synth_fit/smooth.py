@@ -7,11 +7,13 @@ import logging
 
 import numpy as np
 from astropy import units as u
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
 import cPickle
 
+from tracing import get_tracer
+
+## Sampled tracing of the smoothing calls (see synth_fit.tracing)
+_trace = get_tracer('smooth')
+
 
 def falt2(w, f, res):
     """
@@ -35,8 +37,6 @@ def falt2(w, f, res):
         smoothed model flux array, matched to input w
 
     """
-    logging.debug('{} {} {}'.format(res, w.unit, f.unit))
-
     output_unit = f.unit
 
     #w = w.to(u.AA)
@@ -53,19 +53,14 @@ def falt2(w, f, res):
 
     while len(w.value)==1:
         w = w[0]
-        logging.debug('un-nested w! {}'.format(len(w.value)))
 #    plt.figure()
 #    plt.step(w,f,label='input')
 
-    logging.debug(str(w))
     nw = (max(w) - min(w))/(fwhm*0.1)
     nw2 = np.floor(nw) + 1.0
-    logging.debug('nw {} {} {} {}'.format(nw, nw2-1, fwhm, res))
 
     #Creating a wavelength grid
     wtar = np.arange(nw2)*fwhm*0.1 + w[0]
-    logging.debug('len w {} wtar {}'.format(len(w),len(wtar)))
-    logging.debug('{} {}'.format(w[0:10],wtar[0:10]))
 
     #print wtar
     while len(wtar.value)==1:
@@ -73,11 +68,10 @@ def falt2(w, f, res):
         #print 'un-nested wtar!', len(wtar.value)
     while len(f.value)==1:
         f = f[0]
-        logging.debug('un-nested f! {}'.format(len(f)))
-
 
-    logging.debug('len w {} wtar {} f {}'.format(len(w), len(wtar), len(f)))
-    logging.debug('0th w {} wtar {} f {}'.format(w[0],wtar[0],f[0]))
+    if _trace.on and _trace.sample():
+        _trace.record('falt2 res {} fwhm {} len w {} wtar {} f {}', res, fwhm,
+            len(w), len(wtar), len(f))
     #Interpolating to match a flux array to the wavelength grid
     ftar = np.interp(wtar, w, f)
 #    plt.step(wtar,ftar,label='interpolated')
@@ -92,7 +86,6 @@ def falt2(w, f, res):
     fconvol2 = fconvol/(1.0/(0.1*fwhm))
 #    plt.step(wtar,fconvol2,label='convolved')
 
-    logging.debug('w {} wtar {} fconvol2 {}'.format(len(w), len(wtar), len(fconvol2)))
     ftar2 = np.interp(w, wtar, fconvol2)*output_unit
     #print ftar2
 #    plt.step(w,ftar2,label='final')
@@ -147,7 +140,10 @@ def variable_smooth(w, f, data_wave, delta_pixels=2, res_scale=1):
     # need to fill in first 2 elements so keep same array length
     # the end elements are very noisy anyway so it shouldn't be an issue
     res[:2] = res[2:4] 
-    logging.debug(str(res[:10]))
+    tracing = _trace.on and _trace.sample()
+    if tracing:
+        _trace.record('variable_smooth {} pixels, R {} to {}', dlen,
+            np.min(res), np.max(res))
 
     # For each resolution in the array, smooth the model to the correct
     # resolution and interpolate onto the wavelength grid
@@ -156,19 +152,15 @@ def variable_smooth(w, f, data_wave, delta_pixels=2, res_scale=1):
         # pass to falt2
         #res_i = (2.35482*res[i]/np.sqrt(2.0))*data_wave.unit
         res_i = data_wave[i]/res[i]
-        logging.debug(str(res_i))
-        logging.debug('units w {} f {} res_i {}'.format(w.unit,f.unit,res_i.unit))
         smoothed_flux = falt2(w, f, res_i)
-        logging.debug('{} w {} f {} smoothed {}'.format(i, len(w),len(f),
-            len(smoothed_flux)))
 
         # interpolate
         new_flux[i] = np.interp(np.asarray(data_wave[i]),w,smoothed_flux)
-        check_flux = np.interp(np.asarray(data_wave[i]),w,f)
-        logging.debug('{} lambda {} newflux {} checkflux {}'.format(
-            i,data_wave[i],new_flux[i],check_flux))
+        if tracing:
+            check_flux = np.interp(np.asarray(data_wave[i]),w,f)
+            _trace.record('{} lambda {} newflux {} checkflux {}', i,
+                data_wave[i], new_flux[i], check_flux)
 
-    logging.debug(str(new_flux))
     # Return calculated array
     return new_flux
 
@@ -201,7 +193,6 @@ def smooth_model(w, f, data_wave, res):
 
     smoothed_flux = falt2(w, f, res)
     new_flux = np.interp(data_wave,w,smoothed_flux)
-    logging.debug(str(new_flux))
     return new_flux
 
 
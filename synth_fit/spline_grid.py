@@ -0,0 +1,131 @@
+# Module for cubic-spline interpolation of a model grid in its
+# parameters: the tensor-product B-spline coefficients of every pixel are
+# worked out once for the whole flux block, so a model at any point is a
+# weighted sum of a fixed number of coefficient rows (4 per parameter)
+################################################################################
+
+import logging
+
+import numpy as np
+
+
+class SplineGrid(object):
+    """
+    Tensor-product spline (cubic along every parameter with at least 4
+    grid values, of lower degree along the others) through every pixel
+    of a complete model grid, for ModelGrid's interpolation='cubic'.
+
+    Teff is splined in teff**4 (as ModelGrid's multilinear interpolation
+    uses teff**4 coefficients), other parameters as they are. The
+    splines have not-a-knot ends, so they go through the grid spectra.
+
+    Parameters for __init__
+    -----------------------
+    flux: array (nmodels, npix)
+        the model flux
+
+    axes: list of arrays
+        sorted values of every parameter (ModelGrid.grid_index)
+
+    index: integer array
+        row of flux at each grid point (ModelGrid.grid_index)
+
+    params: list of strings
+        the parameter names, in the order of axes
+
+    Creates
+    -------
+    coeffs (array; (nmodels, npix)) : the B-spline coefficients, one row
+        per grid point in C order of axes, in flux's dtype
+    knots (list of arrays), degrees (list of integers) : of each axis
+    coordinates (list of arrays) : the grid values, as splined
+    params (list), shape (tuple) : the parameters, and the number of grid
+        values of each
+
+    """
+
+    def __init__(self, flux, axes, index, params):
+        from scipy.interpolate import make_interp_spline
+
+        self.params = list(params)
+        self.shape = tuple([len(axis) for axis in axes])
+        self.coordinates = [self.coordinate(i, axis) for i, axis in
+                            enumerate(axes)]
+        coeffs = np.asarray(flux[index.ravel()], np.float64).reshape(
+            self.shape + (flux.shape[1],))
+        self.knots, self.degrees = [], []
+        for i, x in enumerate(self.coordinates):
+            degree = min(3, len(x) - 1)
+            if degree > 0:
+                ## (the spline keeps the axis it is along first)
+                spline = make_interp_spline(x, np.moveaxis(coeffs, i, 0),
+                    k=degree)
+                coeffs, knots = np.moveaxis(spline.c, 0, i), spline.t
+            else:
+                knots = np.array(x)
+            self.knots.append(knots)
+            self.degrees.append(degree)
+        self.coeffs = np.ascontiguousarray(coeffs.reshape(-1,
+            flux.shape[1]), dtype=flux.dtype)
+        logging.info('spline coefficients for {} models, degrees {}'.format(
+            len(self.coeffs), self.degrees))
+
+    def with_coeffs(self, coeffs):
+        """ a SplineGrid like this one on coeffs (e.g. shared ones) """
+        spline = SplineGrid.__new__(SplineGrid)
+        spline.__dict__.update(self.__dict__)
+        spline.coeffs = coeffs
+        return spline
+
+    def without_coeffs(self):
+        """ a copy to pickle without the coefficients """
+        return self.with_coeffs(None)
+
+    def coordinate(self, i, values):
+        """ what parameter i is splined in """
+        values = np.asarray(values, np.float64)
+        if self.params[i]=='teff':
+            return values**4
+        return values
+
+    def rows_and_weights(self, p):
+        """
+        Rows of coeffs and their weights for the model at p (one value
+        per parameter): the model is sum_k weights[k]*coeffs[rows[k]]
+        """
+        rows, weights = np.zeros(1, int), np.ones(1)
+        for i in range(len(self.shape)):
+            if self.degrees[i]==0:
+                first, values = 0, np.ones(1)
+            else:
+                first, values = basis(self.knots[i], self.degrees[i],
+                    self.coordinate(i, p[i]))
+            axis_rows = first + np.arange(len(values))
+            rows = (rows[:, np.newaxis]*self.shape[i] + axis_rows).ravel()
+            weights = (weights[:, np.newaxis]*values).ravel()
+        return rows, weights
+
+
+def basis(knots, degree, x):
+    """
+    The B-spline basis functions that are non-zero at x (the Cox-de Boor
+    recursion): returns the index of the first of them, and their values
+    (degree + 1 of them, summing to 1). Outside the knots, the end
+    spans are used.
+    """
+    ncoeffs = len(knots) - degree - 1
+    span = int(np.clip(np.searchsorted(knots, x, 'right') - 1, degree,
+        ncoeffs - 1))
+    values = np.zeros(degree + 1)
+    values[0] = 1.0
+    left, right = np.zeros(degree + 1), np.zeros(degree + 1)
+    for j in range(1, degree + 1):
+        left[j] = x - knots[span + 1 - j]
+        right[j] = knots[span + j] - x
+        saved = 0.0
+        for r in range(j):
+            temp = values[r] / (right[r + 1] + left[j - r])
+            values[r] = saved + right[r + 1] * temp
+            saved = left[j - r] * temp
+        values[j] = saved
+    return span - degree, values
@@ -0,0 +1,112 @@
+# Module for tracing what happens inside the likelihood calls: a sample
+# of the calls (every Nth) is recorded into a ring buffer per subsystem,
+# and only formatted into text when it is read out
+################################################################################
+
+import collections
+import logging
+import os
+from timeit import default_timer
+
+
+class Tracer(object):
+    """
+    Sampled trace records for one subsystem ('model_grid',
+    'retrieve_model', 'smooth'). Off by default; instrumented code checks
+    the on attribute before doing anything else, so while it's off a call
+    pays for one attribute lookup:
+
+       if _trace.on and _trace.sample():
+           _trace.record('p {} lnprob {}', p, lnprob)
+
+    sample() picks every Nth call. record() keeps the format string and
+    its arguments (by reference, not copied) with a timestamp; they are
+    only formatted by lines() or log().
+
+    Parameters for __init__
+    -----------------------
+    name: string
+        the subsystem
+
+    Creates
+    -------
+    on (boolean)
+    every (integer) : one call in every is recorded
+    calls (integer) : calls seen by sample() since enable()
+    records (deque) : (time, format string, arguments), oldest first
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.on = False
+        self.every = 1
+        self.calls = 0
+        self.records = collections.deque(maxlen=1000)
+
+    def enable(self, every=1, size=1000):
+        self.every = max(int(every), 1)
+        self.calls = 0
+        self.records = collections.deque(maxlen=size)
+        self.on = True
+
+    def disable(self):
+        self.on = False
+
+    def sample(self):
+        """ True for every `every`th call """
+        self.calls += 1
+        return (self.calls % self.every)==0
+
+    def record(self, message, *args):
+        self.records.append((default_timer(), message, args))
+
+    def lines(self):
+        """ the records, formatted """
+        return ['{:.6f} {}: {}'.format(t, self.name, message.format(*args))
+                for t, message, args in list(self.records)]
+
+    def log(self, level=logging.DEBUG):
+        """ sends the records to the log """
+        for line in self.lines():
+            logging.log(level, line)
+
+
+_tracers = {}
+
+
+def get_tracer(name):
+    """ the Tracer for subsystem name (made the first time) """
+    if name not in _tracers:
+        _tracers[name] = Tracer(name)
+    return _tracers[name]
+
+
+def enable(name, every=1, size=1000):
+    """
+    Starts recording every Nth call of subsystem name, keeping the last
+    size records
+    """
+    get_tracer(name).enable(every, size)
+
+
+def disable(name):
+    get_tracer(name).disable()
+
+
+def dump(names=None):
+    """ formatted records of the named subsystems (default: all) """
+    if names is None:
+        names = sorted(_tracers.keys())
+    return sum([get_tracer(name).lines() for name in names], [])
+
+
+def _enable_from_environment(setting):
+    """ e.g. SYNTH_FIT_TRACE='model_grid:100,smooth' """
+    for entry in setting.split(','):
+        if entry.strip()=='':
+            continue
+        name, _, every = entry.partition(':')
+        enable(name.strip(), int(every or 1))
+
+_enable_from_environment(os.environ.get('SYNTH_FIT_TRACE', ''))
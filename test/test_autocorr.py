@@ -0,0 +1,66 @@
+import numpy as np
+
+from synth_fit.autocorr import integrated_time, effective_samples
+
+
+def ar1_chain(phi, nwalkers=32, nsteps=5000, ndim=2, seed=42):
+    # AR(1) chains have a known integrated autocorrelation time (1+phi)/(1-phi)
+    rs = np.random.RandomState(seed)
+    chain = np.zeros((nwalkers, nsteps, ndim))
+    noise = rs.randn(nwalkers, nsteps, ndim)
+    for i in range(1, nsteps):
+        chain[:, i] = phi * chain[:, i - 1] + noise[:, i]
+    return chain
+
+
+def test_integrated_time_ar1():
+    phi = 0.9
+    tau = integrated_time(ar1_chain(phi))
+    assert np.allclose(tau, (1 + phi) / (1 - phi), rtol=0.1)
+
+
+def test_integrated_time_white_noise_and_stuck_walkers():
+    chain = np.random.RandomState(0).randn(16, 2000, 3)
+    chain[:4] = 1.0
+    tau = integrated_time(chain)
+    assert np.all(np.isfinite(tau))
+    assert np.allclose(tau, 1.0, atol=0.2)
+    assert effective_samples(16, 2000, tau) > 16 * 2000 / 1.3
+
+
+def gaussian_lnprob(p):
+    return -0.5 * np.sum(p ** 2)
+
+
+def converge_run(**kwargs):
+    import emcee
+    from synth_fit.bdfit import BDSampler
+    np.random.seed(1)
+    # Only the sampling loop is under test, so skip BDSampler.__init__
+    bdsamp = BDSampler.__new__(BDSampler)
+    bdsamp.backend = None
+    sampler = emcee.EnsembleSampler(8, 2, gaussian_lnprob)
+    p0 = np.random.randn(8, 2)
+    settings = dict(max_steps=100000, block_steps=50, target_ess=200, tau_factor=20, max_time=None, max_evals=None)
+    settings.update(kwargs)
+    chain = bdsamp._run_until_converged(sampler, p0, None, None, 0, **settings)
+    nstep = sampler.chain.shape[1]
+    assert chain.shape[1] == -(-(nstep - bdsamp.burn_in) // bdsamp.thin)
+    assert bdsamp.n_evals == 8 * (nstep + 1)
+    return bdsamp, chain
+
+
+def test_run_until_converged():
+    bdsamp, chain = converge_run()
+    assert bdsamp.converged
+    assert bdsamp.thin >= 1 and bdsamp.burn_in > 0
+
+
+def test_run_until_converged_budgets():
+    bdsamp, chain = converge_run(max_evals=1000)
+    assert not bdsamp.converged
+    assert bdsamp.n_evals <= 1000
+
+    bdsamp, chain = converge_run(max_steps=60, target_ess=10 ** 6)
+    assert not bdsamp.converged
+    assert bdsamp.n_evals == 8 * 61
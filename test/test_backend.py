@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+
+from synth_fit.backend import ChainBackend
+from synth_fit.bdfit import BDSampler
+
+
+def gaussian_lnprob(p):
+    return -0.5 * np.sum((p - 1.0) ** 2)
+
+
+def toy_sampler(tmpdir):
+    # A BDSampler with a cheap lnprob in place of the ModelGrid
+    bdsamp = BDSampler.__new__(BDSampler)
+    bdsamp.name = 'toy'
+    bdsamp.plot_title = str(tmpdir.join('toy'))
+    bdsamp.snap = False
+    bdsamp.model = gaussian_lnprob
+    bdsamp.all_params = ['a', 'b', 'ln(s)']
+    bdsamp.ndim = 3
+    bdsamp.start_p = np.ones(3)
+    return bdsamp
+
+
+def test_checkpoint_and_resume(tmpdir):
+    filename = str(tmpdir.join('toy.chain'))
+    bdsamp = toy_sampler(tmpdir)
+    bdsamp.mcmc_go(nwalk_mult=4, nstep_mult=20, backend=filename, block_steps=15)
+    full_chain = np.copy(bdsamp.chain)
+    assert np.all(ChainBackend(filename).get_chain('run') == full_chain)
+    assert ChainBackend(filename).get_lnprob('run').shape == full_chain.shape[:2]
+
+    # Simulate a run killed part way through writing its fourth run block
+    backend = ChainBackend(filename)
+    header, blocks = backend.read()
+    backend.reset(12, 3)
+    for block in blocks[:4]:
+        backend.append(block['phase'], block['chain'], block['lnprob'], block['pos'], block['prob'], block['rstate'])
+    size = os.path.getsize(filename)
+    with open(filename, 'ab') as open_file:
+        open_file.write(b'\x80\x02}q\x00(U\x04kind')
+    assert backend.get_state()['nsteps'] == {'burn': 6, 'run': 45}
+
+    # The stored random state makes the resumed run identical to the original
+    resumed = toy_sampler(tmpdir)
+    resumed.mcmc_go(nwalk_mult=4, nstep_mult=20, backend=ChainBackend(filename), block_steps=15, resume=True)
+    assert resumed.chain.shape == full_chain.shape
+    assert np.allclose(resumed.chain, full_chain)
+    assert os.path.getsize(filename) > size
+    assert ChainBackend(filename).get_state()['nsteps'] == {'burn': 6, 'run': 60}
+
+
+def test_compact_thinned_chain(tmpdir):
+    bdsamp = toy_sampler(tmpdir)
+    bdsamp.mcmc_go(nwalk_mult=4, nstep_mult=20, compact=True, thin=4)
+    assert bdsamp.chain.shape == (12, 15, 3)
+    assert bdsamp.chain.dtype == np.float32
+    assert np.shares_memory(bdsamp.chain, bdsamp.buffer.samples)
+    assert np.shares_memory(bdsamp.cropchain, bdsamp.buffer.samples)
+    assert bdsamp.cropchain.shape == (12 * 15, 3)
+    assert bdsamp.buffer.iterations == 60
+    assert np.all(bdsamp.buffer.lnprobability < 0)
+
+
+def test_compact_resume(tmpdir):
+    filename = str(tmpdir.join('toy.chain'))
+    bdsamp = toy_sampler(tmpdir)
+    bdsamp.mcmc_go(nwalk_mult=4, nstep_mult=20, backend=filename, block_steps=16, compact=True, thin=4)
+    full_chain = np.copy(bdsamp.chain)
+
+    backend = ChainBackend(filename)
+    header, blocks = backend.read()
+    backend.reset(12, 3)
+    for block in blocks[:3]:
+        backend.append(block['phase'], block['chain'], block['lnprob'], block['pos'], block['prob'], block['rstate'],
+                       iterations=block['iterations'])
+    assert backend.get_state()['nsteps'] == {'burn': 6, 'run': 32}
+
+    resumed = toy_sampler(tmpdir)
+    resumed.mcmc_go(nwalk_mult=4, nstep_mult=20, backend=backend, block_steps=16, compact=True, thin=4, resume=True)
+    assert np.all(resumed.chain == full_chain)
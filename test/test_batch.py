@@ -0,0 +1,49 @@
+import astropy.units as q
+import numpy as np
+
+from synth_fit import batch
+from synth_fit.make_model import ModelGrid
+from test.test_shared_grid import fake_grid
+
+
+def test_for_spectrum_reuses_grid():
+    model, spectrum = fake_grid()
+    mg = ModelGrid(spectrum, model, ['teff', 'logg'])
+    other = dict(spectrum, flux=spectrum['flux'] * 2)
+    mg2 = mg.for_spectrum(other)
+    assert mg2.plims is mg.plims
+    assert np.all(mg2.flux == 2 * mg.flux)
+    p = np.array([1725., 4.2, 1., 1., 1., -3.])
+    assert mg2(p) == ModelGrid(other, model, ['teff', 'logg'])(p)
+
+
+def test_fit_batch(tmpdir):
+    model, spectrum = fake_grid()
+    bad = dict(spectrum, flux=spectrum['flux'].value * q.m)
+    spectra = [('a', spectrum), ('bad', bad), ('c', dict(spectrum, flux=spectrum['flux'] * 3))]
+    outfile = str(tmpdir.join('results.csv'))
+    table = batch.fit_batch(model, spectra, outfile=outfile, processes=2, outdir=str(tmpdir),
+                            nwalk_mult=2, nstep_mult=2)
+
+    assert list(table['name']) == ['a', 'bad', 'c']
+    assert list(table['status']) == ['ok', 'failed', 'ok']
+    assert 'UnitConversionError' in table['error'][1]
+    assert np.isnan(table['teff'][1])
+    assert np.all(table['teff_plus'][[0, 2]] >= 0)
+    assert tmpdir.join('a_chains.pkl').check()
+    assert len(open(outfile).readlines()) == 4
+
+
+def test_pipelined_outputs(tmpdir):
+    model, spectrum = fake_grid()
+    filename = str(tmpdir.join('obj.txt'))
+    np.savetxt(filename, np.transpose([spectrum[k].value for k in ['wavelength', 'flux', 'unc']]))
+    spectra = [('obj', filename), ('missing', str(tmpdir.join('missing.txt')))]
+    for processes in [2, 0]:
+        outdir = tmpdir.join('out{}'.format(processes))
+        table = batch.fit_batch(model, spectra, outfile=None, processes=processes, outdir=str(outdir),
+                                plot=True, nwalk_mult=2, nstep_mult=2)
+        assert list(table['status']) == ['ok', 'failed']
+        assert table['error'][1].startswith('load: IOError')
+        for suffix in ['_chains.pkl', '_results.pkl', '_triangle.pdf', '_chains.pdf']:
+            assert outdir.join('obj' + suffix).check()
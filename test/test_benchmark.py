@@ -0,0 +1,76 @@
+import numpy as np
+
+from synth_fit import benchmark, kernels
+from synth_fit.make_model import ModelGrid
+
+
+def test_synthetic_grid():
+    model = benchmark.synthetic_grid(ndim=3, points=4, npix=300, completeness=0.5)
+    assert 0 < len(model['flux']) < 4 ** 3
+    assert model['flux'].shape[1] == 300
+    assert sorted(k for k in model if k not in ['wavelength', 'flux']) == ['f_sed', 'logg', 'teff']
+    assert np.all(model['flux'].value > 0)
+
+
+def test_run_benchmarks():
+    names = ['ModelGrid.__call__', 'retrieve_model', 'falt2', 'make_model_db', 'model_from_database']
+    results = benchmark.run_benchmarks(ndim=2, points=4, npix=300, data_npix=100, names=names,
+                                       repeat=2, min_time=0.01)
+    assert [r['name'] for r in results] == names
+    by_name = dict((r['name'], r) for r in results)
+    assert by_name['ModelGrid.__call__']['status'] == 'ok'
+    assert len(by_name['falt2']['times']) == 2
+    assert by_name['make_model_db']['status'] in ['ok', 'skipped']
+    assert by_name['model_from_database']['config']['nmodels'] == 16
+    table = benchmark.format_table(results).splitlines()
+    assert len(table) == len(names) + 1
+
+
+def test_synthetic_spectrum_fits_grid():
+    model = benchmark.synthetic_grid(ndim=2, points=5, npix=400)
+    spectrum, p = benchmark.synthetic_spectrum(model, ['teff', 'logg'], npix=150)
+    grid = ModelGrid(spectrum, model, ['teff', 'logg'])
+    good = grid(np.concatenate([p, [1, 1, 1, np.log(1e-4)]]))
+    bad = grid(np.concatenate([p + [300, 0], [1, 1, 1, np.log(1e-4)]]))
+    assert good > bad
+
+
+def fake_run(times, name='falt2'):
+    config = {'ndim': 2, 'points': 4, 'npix': 300, 'data_npix': 100, 'completeness': 1.0, 'nmodels': 16}
+    return [{'name': name, 'config': config, 'status': 'ok', 'error': '', 'times': times,
+             'median': float(np.median(times))}]
+
+
+def test_history_and_compare(tmpdir):
+    history = str(tmpdir.join('history.json'))
+    rng = np.random.RandomState(0)
+    base = benchmark.save_results(fake_run(list(1e-3 * (1 + 0.01 * rng.randn(10)))), history, 'v1')
+    same = benchmark.save_results(fake_run(list(1e-3 * (1 + 0.01 * rng.randn(10)))), history)
+    slow = benchmark.save_results(fake_run(list(1.2e-3 * (1 + 0.01 * rng.randn(10)))), history)
+    runs = benchmark.load_history(history)
+    assert [r['id'] for r in runs] == [0, 1, 2]
+    assert runs[0]['label'] == 'v1'
+    assert 'numpy' in runs[0]['environment'] and 'blas_opt_info' in runs[0]['environment']
+
+    assert benchmark.compare_runs(runs[0], runs[1])[0]['verdict'] == 'same'
+    comparison = benchmark.compare_runs(runs[1], runs[2])[0]
+    assert comparison['verdict'] == 'slower' and comparison['p'] < 0.01
+    assert benchmark.compare_runs(runs[2], runs[0])[0]['verdict'] == 'faster'
+    assert 'SLOWER' in benchmark.format_comparison([comparison])
+    assert benchmark.main(['compare', history]) == 1
+    assert benchmark.main(['compare', history, '--baseline', '0', '--current', '1']) == 0
+
+
+def test_likelihood_imports_are_light():
+    elapsed, loaded = benchmark.import_footprint('synth_fit.make_model')
+    assert loaded == []
+    assert elapsed > 0
+    elapsed, loaded = benchmark.import_footprint('synth_fit.bdfit')
+    assert loaded == ['emcee']
+
+
+def test_numba_benchmark():
+    results = benchmark.run_benchmarks(ndim=2, points=4, npix=300, data_npix=100,
+                                       names=['ModelGrid.__call__ numba'], repeat=2, min_time=0.01)
+    expected = 'ok' if kernels.select_backend('auto') == 'numba' else 'skipped'
+    assert results[0]['status'] == expected
@@ -0,0 +1,41 @@
+import cPickle
+import threading
+
+import pytest
+
+from synth_fit.daemon import FitDaemon, FitClient
+from test.test_shared_grid import fake_grid
+
+
+def test_daemon_fits(tmpdir):
+    model, spectrum = fake_grid()
+    grid_file = str(tmpdir.join('grid.pkl'))
+    with open(grid_file, 'wb') as f:
+        cPickle.dump(model, f)
+    address = str(tmpdir.join('fit.sock'))
+    daemon = FitDaemon(address, authkey='test', processes=1, outdir=str(tmpdir))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    try:
+        client = FitClient(address, authkey='test')
+        summary = client.load_grid('fake', grid_file, params=['teff', 'logg'])
+        assert summary['params'] == ['teff', 'logg']
+        assert client.ping() == {'grids': ['fake'], 'fits': 0}
+
+        for name in ['a', 'b']:
+            result = client.fit('fake', name, spectrum, nwalk_mult=2, nstep_mult=2, return_chain=True)
+            assert result['row']['status'] == 'ok'
+            assert result['all_params'][:2] == ['teff', 'logg']
+            assert result['chain'].shape[-1] == len(result['all_params'])
+            assert str(tmpdir.join(name + '_chains.pkl')) in result['files']
+        assert client.ping()['fits'] == 2
+
+        with pytest.raises(RuntimeError) as err:
+            client.fit('missing', 'c', spectrum)
+        assert 'no grid missing' in str(err.value)
+        client.shutdown()
+        client.close()
+    finally:
+        daemon.stop()
+        thread.join()
+    assert tmpdir.join('fit.sock').check() is False
@@ -0,0 +1,15 @@
+import sys
+
+import synth_fit
+
+
+def test_package_imports_submodules_lazily():
+    assert synth_fit.bdfit.BDSampler is sys.modules['synth_fit.bdfit'].BDSampler
+    assert synth_fit.calc_chisq.test_all is not None
+    assert hasattr(synth_fit, 'not_a_module') == False
+
+
+def test_plotting_uses_agg():
+    from synth_fit.plotting import pyplot
+    plt = pyplot()
+    assert plt.get_backend().lower() == 'agg'
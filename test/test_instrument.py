@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+
+from synth_fit.bdfit import BDSampler
+from synth_fit.instrument import Instrumentation, stats
+from synth_fit.make_model import ModelGrid
+from test.test_shared_grid import fake_grid
+
+
+def test_switched_off():
+    timers = Instrumentation()
+    assert timers.start() is None
+    timers.stop('stage', None)
+    timers.count('reject.bounds')
+    assert timers.report() == {'stages': {}, 'counters': {}}
+
+
+def test_report_since_snapshot():
+    timers = Instrumentation(enabled=True)
+    timers.stop('a', timers.start())
+    timers.count('hits', 3)
+    mark = timers.snapshot()
+    timers.stop('a', timers.start())
+    timers.stop('b', timers.start())
+    timers.count('hits')
+    report = timers.report(since=mark)
+    assert report['stages']['a']['calls'] == 1
+    assert report['stages']['b']['calls'] == 1
+    assert report['counters'] == {'hits': 1}
+    assert 'stage' in timers.format_report(report)
+
+
+def test_model_grid_stages(tmpdir):
+    model, spectrum = fake_grid()
+    mg = ModelGrid(spectrum, model, ['teff', 'logg'])
+    stats.enable()
+    try:
+        mg(np.array([1725., 4.2, 1., 1., 1., -3.]))
+        mg(np.array([2500., 4.2, 1., 1., 1., -3.]))
+        mg(np.array([1725., 4.2, 1., 1., 1., 2.]))
+        report = stats.report()
+        assert report['stages']['__call__']['calls'] == 3
+        for stage in ['bounds', 'corner_search', 'interpolate', 'normalize', 'likelihood']:
+            assert report['stages'][stage]['calls'] >= 1
+        assert report['counters'] == {'reject.bounds': 1, 'reject.ln_s': 1}
+
+        bdsamp = BDSampler('obj', spectrum, model, ['teff', 'logg'], plot_title=str(tmpdir.join('obj')))
+        bdsamp.mcmc_go(nwalk_mult=2, nstep_mult=2)
+        assert bdsamp.timing['stages']['test_all']['calls'] == 1
+        assert bdsamp.timing['stages']['mcmc_go']['calls'] == 1
+        # only this run: 12 walkers, 12 steps plus burn-in of 1 and the initial evaluation
+        assert bdsamp.timing['stages']['__call__']['calls'] == 12 * (12 + 1 + 1)
+        assert json.load(open(str(tmpdir.join('obj_timing.json')))) == json.loads(json.dumps(bdsamp.timing))
+    finally:
+        stats.disable()
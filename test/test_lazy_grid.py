@@ -0,0 +1,92 @@
+import io
+import pickle
+import sqlite3
+
+import numpy as np
+
+from synth_fit.lazy_grid import model_from_database
+from synth_fit.make_model import ModelGrid
+from test.test_shared_grid import fake_grid
+
+
+def array_blob(arr):
+    # Arrays are stored the way astrodbkit stores them
+    out = io.BytesIO()
+    np.save(out, arr)
+    return sqlite3.Binary(out.getvalue())
+
+
+def model_db(path, model):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE grid (id INTEGER PRIMARY KEY, teff REAL, logg REAL, wavelength ARRAY, flux ARRAY)')
+    w = model['wavelength'].value
+    for i, (t, g, f) in enumerate(zip(model['teff'], model['logg'], model['flux'].value)):
+        conn.execute('INSERT INTO grid VALUES (?,?,?,?,?)', (i + 10, t, g, array_blob(w), array_blob(f)))
+    conn.commit()
+    conn.close()
+
+
+def test_lazy_grid_matches_loaded_grid(tmpdir):
+    model, spectrum = fake_grid()
+    path = str(tmpdir.join('models.db'))
+    model_db(path, model)
+    lazy = model_from_database(path, 'grid', cache_size=20)
+    assert list(lazy['id']) == range(10, 45)
+
+    mg = ModelGrid(spectrum, model, ['teff', 'logg'])
+    lazy_mg = ModelGrid(spectrum, lazy, ['teff', 'logg'])
+    p = np.array([1725., 4.2, 1., 1., 1., -3.])
+    assert lazy_mg(p) == mg(p)
+
+    # Only the corner rows and their neighbours were read, in one query
+    stats = lazy['flux'].stats
+    assert stats['fetches'] == 1
+    assert stats['rows_fetched'] == 9
+    lazy_mg(np.array([1750., 4.4, 1., 1., 1., -3.]))
+    assert stats['fetches'] == 1 and stats['hits'] == 3 + 4
+
+    # A limited cache still gives the same answers, and pickles without its rows
+    for teff in range(1400, 2001, 50):
+        assert lazy_mg(np.array([teff, 5.2, 1., 1., 1., -3.])) == mg(np.array([teff, 5.2, 1., 1., 1., -3.]))
+    assert len(lazy['flux']._cache) <= 20
+    unpickled = pickle.loads(pickle.dumps(lazy_mg, 2))
+    assert unpickled(p) == mg(p)
+    assert np.all(lazy['flux'].value == model['flux'].value)
+
+    limited = model_from_database(path, 'grid', param_lims=[('teff', 1500, 1700, 100)])
+    assert sorted(set(limited['teff'])) == [1500, 1600, 1700]
+
+
+def test_lazy_grid_float32(tmpdir):
+    model, spectrum = fake_grid()
+    path = str(tmpdir.join('models.db'))
+    model_db(path, model)
+    lazy = model_from_database(path, 'grid', dtype=np.float32)
+    assert lazy['flux'][3].dtype == np.float32
+    assert lazy['flux'].value.dtype == np.float32
+    assert np.allclose(lazy['flux'][3].value, model['flux'][3].value, rtol=1e-6)
+
+
+def test_lazy_grid_fit_setup(tmpdir, monkeypatch):
+    from synth_fit import bdfit
+    model, spectrum = fake_grid()
+    path = str(tmpdir.join('models.db'))
+    model_db(path, model)
+    lazy = model_from_database(path, 'grid', neighbours=0)
+
+    # The starting point comes from a coarse scan, not from reading every model
+    monkeypatch.setattr(bdfit, 'lazy_scan_models', 12)
+    bdsamp = bdfit.BDSampler('lazy', spectrum, lazy, ['teff', 'logg'], plot_title=str(tmpdir.join('lazy')))
+    assert lazy['flux'].stats['rows_fetched'] <= 12
+    assert 1400 <= bdsamp.start_p[0] <= 2000
+
+    given = bdfit.BDSampler('lazy', spectrum, lazy, ['teff', 'logg'], plot_title=str(tmpdir.join('lazy')),
+                            start_p=[1700., 4.5])
+    assert list(given.start_p[:2]) == [1700., 4.5]
+
+    # Sharing leaves the LazyFlux to read its own rows in every process
+    grid = given.model
+    with grid.share(directory=str(tmpdir)):
+        assert 'flux' not in grid.shared.arrays
+        p = np.array([1725., 4.2, 1., 1., 1., -3.])
+        assert pickle.loads(pickle.dumps(grid, 2))(p) == grid(p)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from synth_fit.bdfit import BDSampler
+from synth_fit.lockstep import BatchLikelihood, LockstepRunner
+from synth_fit.make_model import ModelGrid
+from test.test_shared_grid import fake_grid
+
+
+def object_spectra(spectrum, n):
+    random = np.random.RandomState(5)
+    return [dict(spectrum, flux=spectrum['flux'] * (1 + 0.02 * random.randn(len(spectrum['flux']))))
+            for i in range(n)]
+
+
+def test_batch_likelihood_matches_model_grid():
+    model, spectrum = fake_grid()
+    # Data on a coarser wavelength array than the models
+    spectrum = dict((k, v[5:-5:3]) for k, v in spectrum.items())
+    grid = ModelGrid(spectrum, model, ['teff', 'logg'])
+    grids = [grid.for_spectrum(s) for s in object_spectra(spectrum, 3)]
+    likelihood = BatchLikelihood(grids)
+    assert likelihood.vectorized
+
+    positions = np.array([[1725., 4.2, 1., 1.1, 0.9, -3.],
+                          [1400., 3.5, 1., 1., 1., -4.],
+                          [2000., 5.0, 0.9, 1., 1., -2.],
+                          [1850., 4.75, 1., 1., 1., 2.],  # ln(s) too large
+                          [2050., 4.5, 1., 1., 1., -3.]])  # off the grid
+    objects = np.array([0, 1, 2, 1, 0])
+    expected = [grids[o](p) for p, o in zip(positions, objects)]
+    lnprob = likelihood(positions, objects)
+    assert np.allclose(lnprob[:3], expected[:3], rtol=1e-10)
+    assert np.all(np.isinf(lnprob[3:])) and np.all(np.isinf(expected[3:]))
+
+
+def test_lockstep_runner(tmpdir):
+    model, spectrum = fake_grid()
+    grid = ModelGrid(spectrum, model, ['teff', 'logg'])
+    samplers = [BDSampler('obj{}'.format(i), s, grid, ['teff', 'logg'], plot_title=str(tmpdir.join(str(i))))
+                for i, s in enumerate(object_spectra(spectrum, 3))]
+    runner = LockstepRunner(samplers)
+    runner.run(nwalk_mult=2, nstep_mult=3)
+
+    # The start, then 1 burn-in and 18 steps of two half-ensembles each
+    assert runner.n_batches == 1 + 2 * (1 + 18)
+    assert runner.n_evals == 3 * 12 * (1 + 1 + 18)
+    for sampler in samplers:
+        assert sampler.chain.shape == (12, 18, 6)
+        assert np.all(np.isfinite(sampler.all_quantiles))
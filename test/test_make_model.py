@@ -0,0 +1,210 @@
+import pickle
+import threading
+
+import numpy as np
+import pytest
+
+from synth_fit import kernels
+from synth_fit.make_model import ModelGrid, check_flux_dtype
+from test.test_shared_grid import fake_grid
+
+points = np.array([[1725., 4.2, 1., 1.1, 0.9, -3.],
+                   [1400., 3.5, 1., 1., 1., -4.],
+                   [1850., 4.75, 0.95, 1., 1.05, -2.]])
+
+
+def test_float32_flux():
+    model, spectrum = fake_grid()
+    grid = ModelGrid(spectrum, model, ['teff', 'logg'], flux_dtype=np.float32)
+    assert grid.model['flux'].dtype == np.float32
+    assert model['flux'].dtype == np.float64
+    assert grid.interp_models(points[0, :2]).dtype == np.float64
+
+    errors = check_flux_dtype(spectrum, model, ['teff', 'logg'], points)
+    assert errors['max_flux'] < 1e-6
+    reference = ModelGrid(spectrum, model, ['teff', 'logg'])
+    assert errors['max_lnprob'] < 1e-6 * max(abs(reference(p)) for p in points)
+
+
+def lnprob_reference(grid, p):
+    # lnprob as ModelGrid.__call__ works it out, with new arrays throughout
+    mod_flux = grid.interp_models(p[:grid.ndim]).value
+    normalization = np.zeros(len(grid.wave))
+    normalization[:] = p[grid.ndim + 2]
+    for i in range(3):
+        in_bin = ((grid.wave > grid.wavelength_bins[i]) & (grid.wave <= grid.wavelength_bins[i + 1]))
+        normalization[in_bin] = p[grid.ndim + i]
+    unc_sq = (grid.unc.value ** 2 + np.exp(p[-1]) ** 2) * normalization ** 2
+    return -0.5 * np.sum((grid.flux.value - mod_flux * normalization) ** 2 / unc_sq + np.log(2 * np.pi * unc_sq))
+
+
+def test_work_buffers():
+    model, spectrum = fake_grid()
+    w = np.linspace(0.95, 2.3, 150)
+    flux = np.interp(w, model['wavelength'].value, spectrum['flux'].value)
+    resampled = {'wavelength': w * model['wavelength'].unit, 'flux': flux * spectrum['flux'].unit,
+                 'unc': 0.02 * flux * spectrum['flux'].unit}
+    grid = ModelGrid(resampled, model, ['teff', 'logg'])
+    assert grid.interp
+
+    # the resampled model matches np.interp
+    expected = np.interp(w, model['wavelength'].value, model['flux'][12].value)
+    expected = grid.normalize_model(expected)
+    assert np.allclose(grid.interp_models([1600., 4.5]).value, expected, rtol=1e-12)
+
+    # every call works in the same buffers, and the results stay right
+    grid(points[0])
+    buffers = dict(grid._work())
+    for p in points:
+        assert np.isclose(grid(p), lnprob_reference(grid, p), rtol=1e-12)
+    assert all(grid._work()[key] is buffers[key] for key in buffers)
+
+    # interp_models hands out copies of them
+    first = grid.interp_models(points[0, :2])
+    grid.interp_models(points[1, :2])
+    assert np.shares_memory(first.value, buffers['model']) == False
+    assert np.allclose(first.value, grid.interp_models(points[0, :2]).value)
+
+    # other threads get buffers of their own
+    other = []
+    thread = threading.Thread(target=lambda: other.append(grid._work()))
+    thread.start()
+    thread.join()
+    assert other[0]['model'] is not buffers['model']
+
+
+def test_corner_gather():
+    model, spectrum = fake_grid()
+    grid = ModelGrid(spectrum, model, ['teff', 'logg'])
+    assert grid._block.flags.c_contiguous
+    assert np.shares_memory(grid._block, model['flux'].value)
+
+    # a weighted sum of the four corners (teff**4 weights in teff)
+    teff, logg = 1725., 4.2
+    t = (teff ** 4 - 1700. ** 4) / (1800. ** 4 - 1700. ** 4)
+    g = (logg - 4.) / 0.5
+    row = dict(((tt, gg), i) for i, (tt, gg) in enumerate(zip(model['teff'], model['logg'])))
+    flux = model['flux'].value
+    expected = ((1 - t) * (1 - g) * flux[row[1700., 4.]] + (1 - t) * g * flux[row[1700., 4.5]] +
+                t * (1 - g) * flux[row[1800., 4.]] + t * g * flux[row[1800., 4.5]])
+    assert np.allclose(grid.interp_models([teff, logg]).value, grid.normalize_model(expected), rtol=1e-12)
+    corners = grid._work()['corners']
+    grid(points[0])
+    assert grid._work()['corners'] is corners
+
+    # one row, as a 1D spectrum
+    assert grid.retrieve_model([1700., 4.]).shape == (200,)
+
+    # incomplete grids interpolate between the corners they have
+    keep = ~((model['teff'] == 2000.) & (model['logg'] == 5.5))
+    incomplete = dict(model, flux=model['flux'][keep], teff=model['teff'][keep], logg=model['logg'][keep])
+    partial = ModelGrid(spectrum, incomplete, ['teff', 'logg'])
+    assert np.allclose(partial.interp_models([teff, logg]).value, grid.interp_models([teff, logg]).value,
+                       rtol=1e-12)
+    assert np.allclose(partial.interp_models([1700., logg]).value, grid.interp_models([1700., logg]).value,
+                       rtol=1e-12)
+    assert np.all(partial.interp_models([1950., 5.25]).value == -99)
+
+
+def test_fused_kernel(monkeypatch):
+    model, spectrum = fake_grid()
+    w = np.linspace(0.95, 2.3, 150)
+    flux = np.interp(w, model['wavelength'].value, spectrum['flux'].value)
+    resampled = {'wavelength': w * model['wavelength'].unit, 'flux': flux * spectrum['flux'].unit,
+                 'unc': 0.02 * flux * spectrum['flux'].unit}
+
+    with pytest.raises(ValueError):
+        ModelGrid(spectrum, model, ['teff', 'logg'], backend='fortran')
+    if kernels.select_backend('auto') == 'numpy':
+        with pytest.raises(ImportError):
+            ModelGrid(spectrum, model, ['teff', 'logg'], backend='numba')
+
+    # The kernel as plain python stands in for the compiled one
+    monkeypatch.setitem(kernels._compiled, 'lnprob', kernels.fused_lnprob)
+    for spec in [spectrum, resampled]:
+        # (the numpy backend interpolates float32 flux in float32)
+        for dtype, rtol in [(np.float64, 1e-9), (np.float32, 1e-6)]:
+            grid = ModelGrid(spec, model, ['teff', 'logg'], flux_dtype=dtype)
+            fused = ModelGrid(spec, model, ['teff', 'logg'], flux_dtype=dtype, backend='numba')
+            assert fused.backend == 'numba'
+            for p in points:
+                assert np.isclose(fused(p), grid(p), rtol=rtol)
+            assert fused(points[0] + [1000., 0, 0, 0, 0, 0]) == -np.inf
+
+
+def test_pca_emulator():
+    model, spectrum = fake_grid()
+    grid = ModelGrid(spectrum, model, ['teff', 'logg'])
+    expected = [grid(p) for p in points]
+    linear = grid.interp_models(points[0, :2]).value
+
+    emulator = grid.emulate(tolerance=1e-5)
+    assert 0 < emulator.ncomponents < len(model['flux'])
+    assert emulator.eigenspectra.shape == (emulator.ncomponents, 200)
+    assert emulator.error.shape == (len(model['flux']),)
+    assert np.max(emulator.error) <= 1e-5
+    assert len(emulator.report(limit=5).splitlines()) == 7
+
+    # grid points come back as they are, to the tolerance
+    on_grid = grid.interp_models([1700., 4.5]).value
+    exact = grid.normalize_model(model['flux'][(model['teff'] == 1700.) & (model['logg'] == 4.5)][0].value)
+    assert np.max(np.abs(on_grid - exact)) < 2e-5 * np.max(exact)
+    # and in between the emulator interpolates shapes rather than spectra
+    assert np.allclose(grid.interp_models(points[0, :2]).value, linear, rtol=0.01)
+    for p, lnprob in zip(points, expected):
+        assert np.isclose(grid(p), lnprob, rtol=0.05)
+
+    # fewer components are worse
+    assert np.max(grid.emulate(ncomponents=2).error) > 1e-5
+
+    # a spectrum on other wavelengths gets an emulator of its own
+    w = np.linspace(0.95, 2.3, 150)
+    flux = np.interp(w, model['wavelength'].value, spectrum['flux'].value)
+    other = grid.for_spectrum({'wavelength': w * model['wavelength'].unit, 'flux': flux * spectrum['flux'].unit,
+                               'unc': 0.02 * flux * spectrum['flux'].unit})
+    assert other.emulator.eigenspectra.shape[1] == 150
+
+    grid.emulator = None
+    assert np.all(grid.interp_models(points[0, :2]).value == linear)
+
+
+def test_cubic_interpolation(tmpdir, monkeypatch):
+    model, spectrum = fake_grid()
+    w = model['wavelength'].value
+    linear = ModelGrid(spectrum, model, ['teff', 'logg'])
+    cubic = ModelGrid(spectrum, model, ['teff', 'logg'], interpolation='cubic')
+    assert cubic._spline.degrees == [3, 3]
+    assert cubic._spline.coeffs.shape == model['flux'].shape
+
+    # through the grid spectra, and far closer than linear in between
+    for teff, logg in [(1700., 4.5), (1400., 5.5), (2000., 3.5)]:
+        assert np.allclose(cubic.interp_models([teff, logg]).value, linear.interp_models([teff, logg]).value,
+                           rtol=1e-10)
+    for teff, logg in [(1725., 4.2), (1450., 3.9), (1960., 5.3)]:
+        truth = linear.normalize_model(np.exp(-(w - 1.0 - teff / 4000.) ** 2 / (0.3 + logg / 20.)))
+        cubic_error = np.max(np.abs(cubic.interp_models([teff, logg]).value - truth))
+        linear_error = np.max(np.abs(linear.interp_models([teff, logg]).value - truth))
+        assert cubic_error < linear_error / 10
+    # a fixed-size gather: 4 rows per parameter
+    rows, weights = cubic._spline.rows_and_weights([1725., 4.2])
+    assert len(rows) == 16 and np.isclose(np.sum(weights), 1)
+
+    # shared with the grid, and the same after pickling
+    p = points[0]
+    expected = cubic(p)
+    cubic.share(directory=str(tmpdir))
+    try:
+        copy = pickle.loads(pickle.dumps(cubic, 2))
+        assert copy._spline.coeffs.base is not None
+        assert np.shares_memory(copy._spline.coeffs, copy.shared.arrays['spline_coeffs'])
+        assert copy(p) == expected
+    finally:
+        cubic.shared.unlink()
+
+    # the fused kernel takes the spline coefficients too
+    monkeypatch.setitem(kernels._compiled, 'lnprob', kernels.fused_lnprob)
+    fused = ModelGrid(spectrum, model, ['teff', 'logg'], interpolation='cubic', backend='numba')
+    assert np.isclose(fused(p), expected, rtol=1e-9)
+
+    with pytest.raises(ValueError):
+        ModelGrid(spectrum, model, ['teff', 'logg'], interpolation='quintic')
@@ -0,0 +1,47 @@
+import numpy as np
+
+from synth_fit import memory
+from synth_fit.benchmark import synthetic_grid, synthetic_spectrum
+
+
+def test_plan_memory():
+    model = synthetic_grid(ndim=2, points=10, npix=1000)
+    spectrum, p = synthetic_spectrum(model, ['teff', 'logg'], npix=200)
+    plan = memory.plan_memory(model, spectrum, ['teff', 'logg'], nwalk_mult=20, nstep_mult=50)
+    # 2 grid parameters, 3 normalizations and ln(s): 120 walkers, 300 steps
+    assert plan['mcmc_go']['chain'] == 8 * 120 * 300 * 7
+    assert plan['ModelGrid.__init__']['grid'] == 8 * 100 * 1002 + 8 * 1000
+    float32 = memory.plan_memory(dict(model, flux=model['flux'].astype(np.float32)), spectrum, ['teff', 'logg'])
+    assert float32['ModelGrid.__init__']['grid'] == 4 * 100 * 1000 + 8 * 100 * 2 + 8 * 1000
+    assert plan['peak'] == max(plan[s]['total'] for s in ['make_model_db', 'ModelGrid.__init__', 'test_all',
+                                                          'mcmc_go', 'plotting'])
+    assert plan['per_worker'] == 0
+
+    compact = memory.plan_memory(model, spectrum, ['teff', 'logg'], compact=True, processes=4, shared=True)
+    assert compact['mcmc_go']['chain'] == plan['mcmc_go']['chain'] / 2
+    assert compact['mcmc_go']['burn-in'] == 0
+    assert 0 < compact['per_worker'] < plan['ModelGrid.__init__']['grid']
+    assert 'mcmc_go' in memory.format_plan(plan)
+
+
+def test_memory_profile():
+    profile = memory.MemoryProfile(interval=0.001)
+    with profile.stage('allocate'):
+        block = np.ones(2 ** 23)  # 64 MB
+        del block
+    with profile.stage('nothing'):
+        pass
+    stages = profile.report()
+    assert stages['allocate']['increase'] > 48 * 2 ** 20
+    assert stages['nothing']['increase'] < 16 * 2 ** 20
+    assert 'allocate' in profile.format_report()
+
+
+def test_profile_fit(tmpdir):
+    model = synthetic_grid(ndim=2, points=4, npix=300)
+    spectrum, p = synthetic_spectrum(model, ['teff', 'logg'], npix=300)
+    spectrum['wavelength'] = model['wavelength']
+    profile, bdsamp = memory.profile_fit('obj', spectrum, model, ['teff', 'logg'], plot=False,
+                                         nwalk_mult=2, nstep_mult=2, outfile=str(tmpdir.join('chain.pkl')))
+    assert list(profile.stages.keys()) == ['ModelGrid.__init__', 'test_all', 'mcmc_go']
+    assert bdsamp.chain.shape == (12, 12, 6)
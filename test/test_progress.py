@@ -0,0 +1,33 @@
+import numpy as np
+
+from synth_fit.progress import ProgressMonitor, read_progress
+from test.test_backend import toy_sampler
+
+
+def test_progress_reports(tmpdir):
+    filename = str(tmpdir.join('progress.jsonl'))
+    seen = []
+    bdsamp = toy_sampler(tmpdir)
+    bdsamp.mcmc_go(nwalk_mult=4, nstep_mult=20, block_steps=10,
+                   progress=ProgressMonitor(callback=seen.append, filename=filename))
+
+    # one block of burn-in (6 steps), then 6 blocks of 10
+    reports = read_progress(filename)
+    assert [r['phase'] for r in reports] == ['burn'] + ['run'] * 6
+    assert [r['step'] for r in reports] == [6, 16, 26, 36, 46, 56, 66]
+    assert all(r['total_steps'] == 66 for r in reports)
+    assert reports[-1]['eta_seconds'] == 0
+    assert all(0 <= r['acceptance'] <= 1 and r['evals_per_sec'] > 0 for r in reports)
+    assert len(reports[-1]['tau']) == 3
+    assert len(seen) == 7 and seen[-1]['step'] == 66
+    assert bdsamp.chain.shape == (12, 60, 3)
+
+
+def test_progress_converge(tmpdir):
+    bdsamp = toy_sampler(tmpdir)
+    bdsamp.mcmc_go(nwalk_mult=4, converge=True, block_steps=50, max_steps=150, progress=True)
+    reports = bdsamp.progress.reports
+    assert [r['phase'] for r in reports] == ['converge'] * len(reports)
+    assert reports[-1]['step'] == bdsamp.n_evals / 12 - 1
+    assert reports[0]['total_steps'] == 150
+    assert np.isclose(reports[-1]['mean_acceptance'], np.mean([r['acceptance'] for r in reports]))
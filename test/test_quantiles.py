@@ -0,0 +1,41 @@
+import numpy as np
+
+from synth_fit.quantiles import QuantileSketch, quantiles
+from test.test_backend import toy_sampler
+
+
+def test_partition_quantiles_match_sorted():
+    samples = np.random.RandomState(1).randn(1001, 4)
+    qs = [.16, .5, .84]
+    expected = [[sorted(samples[:, i])[int(q * 1001)] for q in qs] for i in range(4)]
+    assert np.all(quantiles(samples, qs) == expected)
+
+
+def test_sketch_blocks_and_merge():
+    random = np.random.RandomState(2)
+    samples = random.randn(200000, 2) * [1., 10.] + [0., 5.]
+    qs = [.05, .16, .5, .84, .95]
+    exact = quantiles(samples, qs)
+
+    # Fed block by block, the sketch stays small and close to the exact quantiles
+    sketch = QuantileSketch(2, k=512, seed=3)
+    for block in np.split(samples[:100000], 20):
+        sketch.update(block)
+    other = QuantileSketch(2, k=512, seed=4)
+    other.update(samples[100000:])
+    sketch.merge(other)
+    assert sketch.count == 200000
+    assert sum(len(level) for level in sketch.levels) < 512 * 12
+    for i in range(2):
+        ranks = np.searchsorted(np.sort(samples[:, i]), sketch.quantiles(qs)[i]) / 200000.
+        assert np.all(np.abs(ranks - qs) < 0.01)
+    assert np.allclose(sketch.quantiles(qs), exact, atol=0.05 * np.array([[1.], [10.]]))
+
+
+def test_running_quantiles(tmpdir):
+    bdsamp = toy_sampler(tmpdir)
+    bdsamp.mcmc_go(nwalk_mult=4, nstep_mult=20, block_steps=10, summarize=True)
+    assert bdsamp.sketch.count == bdsamp.chain.shape[0] * bdsamp.chain.shape[1]
+    assert np.allclose(bdsamp.running_quantiles([.5]), quantiles(bdsamp.chain.reshape((-1, 3)), [.5]))
+    assert bdsamp.all_quantiles.shape == (3, 3)
+    assert np.all(bdsamp.all_quantiles[:, 0] <= bdsamp.all_quantiles[:, 2])
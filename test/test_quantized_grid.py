@@ -0,0 +1,53 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from synth_fit.make_model import ModelGrid
+from synth_fit.quantized_grid import quantize, quantize_grid
+from test.test_shared_grid import fake_grid
+
+
+def test_error_bounds():
+    model, spectrum = fake_grid()
+    flux = model['flux'].value
+    linear = quantize(model['flux'], log=False)
+    assert linear.codes.dtype == np.int16
+    assert linear.nbytes < flux.nbytes / 3
+    decoded = linear.value
+    assert np.all(np.abs(decoded - flux).max(axis=1) <= 1.0001 * flux.max(axis=1) / 65534)
+    assert np.allclose(linear.error, np.abs(decoded - flux).max(axis=1) / flux.max(axis=1))
+
+    log = quantize(model['flux'])
+    relative = np.abs(log.value / flux - 1).max(axis=1)
+    assert np.all(relative <= np.exp(log.scale / 2) - 1 + 1e-12)
+    assert np.allclose(log.error, relative)
+
+    with pytest.raises(ValueError):
+        quantize(-model['flux'])
+
+
+def test_decode_cache():
+    model, spectrum = fake_grid()
+    flux = quantize(model['flux'], cache_size=4)
+    assert flux[3].unit == model['flux'].unit
+    assert np.allclose(flux[[3, 5]].value, model['flux'][[3, 5]].value, rtol=1e-4)
+    flux[[3, 5, 6]]
+    assert flux.stats == {'hits': 3, 'misses': 3}
+    assert len(flux._cache) == 3
+
+
+def test_quantized_model_grid(tmpdir):
+    model, spectrum = fake_grid()
+    p = np.array([1725., 4.2, 1., 1.1, 0.9, -3.])
+    expected = ModelGrid(spectrum, model, ['teff', 'logg'])(p)
+    grid = ModelGrid(spectrum, quantize_grid(model), ['teff', 'logg'])
+    assert abs(grid(p) - expected) < 1e-4 * abs(expected)
+    full_size = len(pickle.dumps(grid, 2))
+
+    # Shared, pickles carry neither the codes nor the decoded rows
+    with grid.share(directory=str(tmpdir)):
+        copy = pickle.loads(pickle.dumps(grid, 2))
+        assert len(pickle.dumps(grid, 2)) < full_size - grid.model['flux'].codes.nbytes
+        assert copy(p) == grid(p)
+        assert np.shares_memory(copy.model['flux'].codes, copy.shared.arrays['flux_codes'])
@@ -0,0 +1,57 @@
+import pickle
+
+import astropy.units as q
+import numpy as np
+
+from synth_fit.make_model import ModelGrid
+from synth_fit.shared_grid import SharedGrid
+
+flux_unit = q.erg / q.AA / q.cm ** 2 / q.s
+
+
+def fake_grid(npix=200):
+    # A small, complete teff/logg grid of smooth fake spectra
+    w = np.linspace(0.9, 2.4, npix)
+    teff, logg = [a.ravel() for a in np.meshgrid(np.arange(1400., 2001., 100.), np.arange(3.5, 5.51, 0.5),
+                                                  indexing='ij')]
+    flux = np.array([np.exp(-(w - 1.0 - t / 4000.) ** 2 / (0.3 + g / 20.)) * (t / 1000.) ** 4
+                     for t, g in zip(teff, logg)])
+    model = {'wavelength': w * q.um, 'flux': flux * flux_unit, 'teff': teff, 'logg': logg}
+    spectrum = {'wavelength': w * q.um, 'flux': flux[12] * flux_unit, 'unc': 0.02 * flux[12] * flux_unit + 1e-3 * flux_unit}
+    return model, spectrum
+
+
+def test_share_and_attach(tmpdir):
+    model, spectrum = fake_grid()
+    mg = ModelGrid(spectrum, model, ['teff', 'logg'])
+    p = np.array([1725., 4.2, 1., 1., 1., -3.])
+    expected = mg(p)
+
+    full_size = len(pickle.dumps(mg, 2))
+    shared = mg.share(directory=str(tmpdir))
+    try:
+        # Pickles only carry the name of the grid, and re-attach on load
+        assert len(pickle.dumps(mg, 2)) < full_size / 4
+        mg2 = pickle.loads(pickle.dumps(mg, 2))
+        assert mg2(p) == expected
+        assert np.shares_memory(mg2.model['flux'], mg2.shared.arrays['flux'])
+
+        attached = SharedGrid(shared.name, directory=str(tmpdir))
+        assert np.all(attached.model_dict()['flux'] == model['flux'])
+    finally:
+        shared.unlink()
+
+
+def test_shared_files_removed(tmpdir):
+    arrays = {'flux': np.ones((3, 4))}
+    with SharedGrid.create(arrays, directory=str(tmpdir)) as shared:
+        assert tmpdir.join(shared.name).check()
+    assert not tmpdir.join(shared.name).check()
+
+    # A process that exits without unlinking still cleans up after itself
+    import subprocess
+    import sys
+    script = ("import numpy as np; from synth_fit.shared_grid import SharedGrid; "
+              "print(SharedGrid.create({{'flux': np.ones(3)}}, directory={!r}).name)".format(str(tmpdir)))
+    name = subprocess.check_output([sys.executable, '-c', script]).decode().split()[-1]
+    assert not tmpdir.join(name).check()
@@ -0,0 +1,55 @@
+import io
+import sqlite3
+
+import astropy.units as q
+import numpy as np
+
+from mcmc_fit.spectra import SpectrumStore, parse_unit
+from test.test_lazy_grid import array_blob
+
+# astrodbkit's converter for ARRAY columns
+sqlite3.register_converter('ARRAY', lambda blob: np.load(io.BytesIO(blob)))
+
+
+def spectra_db(path, n):
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE spectra (id INTEGER PRIMARY KEY, source_id INTEGER, wavelength_units TEXT, '
+                 'flux_units TEXT, wavelength ARRAY, flux ARRAY, unc ARRAY, header TEXT)')
+    for i in range(1, n + 1):
+        w = np.linspace(1, 2, 5)
+        conn.execute('INSERT INTO spectra VALUES (?,?,?,?,?,?,?,?)',
+                     (i, i, 'um', 'ergs-1cm-2A-1', array_blob(w), array_blob(w * i), array_blob(w * 0.1), 'x'))
+    return conn
+
+
+def test_parse_unit():
+    assert parse_unit('ergs-1cm-2A-1') == q.erg / q.s / q.cm ** 2 / q.AA
+    assert parse_unit('Wm-2um-1') == q.W / q.m ** 2 / q.um
+    assert parse_unit('AA') == q.AA
+
+
+def test_prefetch_in_bulk(tmpdir):
+    conn = spectra_db(':memory:', 1000)
+    store = SpectrumStore(conn, cache_dir=str(tmpdir))
+    ids = range(1, 1001) + [5000]
+    assert store.prefetch(ids) == [5000]
+    assert store.n_queries == 2
+    spectrum = store.get(7)
+    assert np.allclose(spectrum['flux'].to(q.W / q.m ** 2 / q.um).value, np.linspace(1, 2, 5) * 7 * 10)
+    assert spectrum['wavelength'].unit == q.um
+    assert store.n_queries == 2
+
+    # A new store finds everything in the disk cache
+    conn.close()
+    cached = SpectrumStore(None, cache_dir=str(tmpdir))
+    assert cached.prefetch(range(1, 1001)) == []
+    assert np.all(cached.get(7)['flux'] == spectrum['flux'])
+
+
+def test_plain_connection():
+    conn = spectra_db(':memory:', 3)
+    conn.row_factory = None
+    store = SpectrumStore(conn)
+    assert store.prefetch([1, 3]) == []
+    assert np.allclose(store.get(3)['flux'].value, np.linspace(1, 2, 5) * 3)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from synth_fit import tracing
+from synth_fit.make_model import ModelGrid
+from test.test_shared_grid import fake_grid
+
+
+def test_off_by_default():
+    tracer = tracing.Tracer('test')
+    assert tracer.on is False
+    assert tracer.lines() == []
+
+
+def test_sampling_and_ring_buffer():
+    tracer = tracing.Tracer('test')
+    tracer.enable(every=3, size=2)
+    for i in range(12):
+        if tracer.sample():
+            tracer.record('call {} value {}', i, np.arange(i))
+    # every 3rd call, and only the last 2 records are kept
+    assert [l.split(': ', 1)[1] for l in tracer.lines()] == ['call 8 value [0 1 2 3 4 5 6 7]',
+                                                             'call 11 value [ 0  1  2  3  4  5  6  7  8  9 10]']
+
+
+def test_model_grid_trace():
+    model, spectrum = fake_grid()
+    mg = ModelGrid(spectrum, model, ['teff', 'logg'])
+    p = np.array([1725., 4.2, 1., 1., 1., -3.])
+    tracing.enable('model_grid', every=2)
+    try:
+        lnprob = [mg(p), mg(p), mg(np.array([2500., 4.2, 1., 1., 1., -3.])), mg(np.array([2500., 4.2, 1., 1., 1., -3.]))]
+        lines = tracing.dump(['model_grid'])
+        assert len(lines) == 2
+        assert 'lnprob {}'.format(lnprob[1]) in lines[0]
+        assert 'rejected: teff 2500.0 outside 1400.0 to 2000.0' in lines[1]
+    finally:
+        tracing.disable('model_grid')
+    mg(p)
+    assert len(tracing.dump(['model_grid'])) == 2